@@ -0,0 +1,134 @@
+"""ابزارهای مشترک بنچمارک‌ها: ربات ساختگی، آپدیت ساختگی و آماده‌سازی ربات روی دیتابیس موقت
+
+همه چیز بدون شبکه اجرا می‌شود؛ Bot API با شیء FakeBot با تأخیر ثابت جایگزین می‌شود.
+"""
+import asyncio
+import logging
+import os
+import sys
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+class FakeBot:
+    """جایگزین Bot با تأخیر ثابت برای هر فراخوانی API"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        self._message_id = 0
+
+    async def _call(self, chat_id):
+        self.calls += 1
+        self._message_id += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return SimpleNamespace(chat_id=chat_id, message_id=self._message_id, photo=[])
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        if hasattr(photo, "read"):
+            photo.read()
+        return await self._call(chat_id)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return await self._call(chat_id)
+
+    async def send_document(self, chat_id, document, **kwargs):
+        if hasattr(document, "read"):
+            document.read()
+        return await self._call(chat_id)
+
+    async def edit_message_media(self, chat_id, message_id, **kwargs):
+        return await self._call(chat_id)
+
+
+def make_update(bot, user_id, data):
+    """آپدیت کال‌بک ساختگی؛ خروجی: (update، لیست پاسخ‌های answer)"""
+    answers = []
+
+    async def answer(text=None, show_alert=False):
+        answers.append(text)
+
+    async def edit_message_reply_markup(reply_markup=None):
+        await bot._call(user_id)
+
+    query = SimpleNamespace(
+        data=data,
+        from_user=SimpleNamespace(id=user_id, username=f"user{user_id}"),
+        message=SimpleNamespace(chat_id=user_id, message_id=1),
+        answer=answer,
+        edit_message_reply_markup=edit_message_reply_markup,
+    )
+    update = SimpleNamespace(callback_query=query, effective_message=query.message)
+    return update, answers
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def load_bot(workdir, events):
+    """بارگذاری main روی دیتابیس موقت workdir با اجراهای events"""
+    os.chdir(workdir)
+    # main فقط در اولین import این پوشه‌ها را می‌سازد
+    for folder in ("receipts", "qrcodes", "event_posters"):
+        os.makedirs(folder, exist_ok=True)
+    import config
+    import main as bot
+
+    logging.disable(logging.INFO)
+    config.EVENTS = events
+    bot.DB_FILE = os.path.join(workdir, "tickets.db")
+    reset_runtime(bot)
+    bot.init_db()
+    bot.event_catalog.load()
+    bot.availability.load()
+    return bot
+
+
+def reset_runtime(bot, overload_levels=None):
+    """وضعیت‌های سراسری تازه (برای هر سناریو یا هر دیتابیس جدید)"""
+    bot.db_writer = bot.DbWriter()
+    bot.executors.clear()
+    bot.executors.update({
+        name: bot.WorkloadExecutor(name, workers, max_queue)
+        for name, (workers, max_queue) in bot.EXECUTOR_POOLS.items()
+    })
+    levels = bot.OVERLOAD_LEVELS if overload_levels is None else overload_levels
+    bot.overload = bot.OverloadController(levels, bot.OVERLOAD_WINDOW)
+    bot.single_flight = bot.SingleFlight()
+    bot.seat_writes = bot.EventWriteStats()
+    # صف انتظار جداگانه سنجیده می‌شود؛ اینجا همه کاربران مستقیم وارد می‌شوند
+    bot.waiting_room = bot.WaitingRoom(
+        capacity=10 ** 6, session=bot.WAITING_ROOM_SESSION, claim=bot.WAITING_ROOM_CLAIM)
+
+
+async def start_application(bot, api, errors):
+    """اجرای Application واقعی ربات روی سرور ساختگی api؛ خطاهای هندلرها در errors شمرده می‌شوند"""
+    application = bot.build_application("123456:SIMULATED-TOKEN", api.base_url, api.base_file_url)
+    bot.app = application
+
+    async def count_error(update, context):
+        errors[type(context.error).__name__] += 1
+
+    application.add_error_handler(count_error)
+    await application.initialize()
+    await application.post_init(application)
+    await application.updater.start_polling(poll_interval=0.0, timeout=5)
+    await application.start()
+    return application
+
+
+async def stop_application(bot, application):
+    await application.updater.stop()
+    await application.stop()
+    await application.post_stop(application)
+    await application.shutdown()
+    if bot.scheduler is not None:
+        bot.scheduler.shutdown(wait=False)
@@ -0,0 +1,317 @@
+"""شبیه‌ساز بار سرتاسری: Application واقعی ربات روی سرور ساختگی Bot API
+
+اجرا:
+    python benchmarks/e2e.py [--users 500] [--ramp 10] [--rows 20] [--cols 30]
+                             [--latency 0.02] [--rate-limit 0.01] [--output e2e.json]
+
+همان Application ساخته شده در main (build_application) با همه هندلرها اجرا می‌شود و
+به جای api.telegram.org به سرور محلی benchmarks/fake_bot_api.py وصل می‌شود. هر کاربر
+ساختگی مسیر کامل خرید را طی می‌کند: /start ← دیدن اجراها ← اجرا (و صف انتظار) ← بلوک ←
+صندلی ← تأیید ← عکس رسید ← تأیید ادمین ← دریافت بلیت. در پایان گذردهی، صدک‌های تأخیر هر
+مرحله (از ارسال آپدیت تا پاسخ ربات)، نرخ خطا، پاسخ‌های 429 و فروش دوباره یک صندلی گزارش
+می‌شود.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from common import load_bot, percentile, start_application, stop_application  # noqa: E402
+from fake_bot_api import FakeBotApi  # noqa: E402
+
+EVENT_ID = 1000
+STEPS = ("start", "events", "event", "block", "seat", "confirm", "receipt", "ticket")
+
+
+class SessionFailed(Exception):
+    def __init__(self, stage, reason):
+        super().__init__(f"{stage}: {reason}")
+        self.stage = stage
+        self.reason = reason
+
+
+def buttons(message, prefix):
+    """داده دکمه‌های اینلاین پیام که با prefix شروع می‌شوند"""
+    markup = message.get("reply_markup") or {}
+    return [button["callback_data"] for row in markup.get("inline_keyboard", []) for button in row
+            if button.get("callback_data", "").startswith(prefix)]
+
+
+def text_of(message):
+    return message.get("text") or message.get("caption") or ""
+
+
+class SimulatedUser:
+    """یک کاربر ساختگی که پیام‌های ربات را می‌خواند و دکمه‌ها را می‌زند"""
+
+    def __init__(self, api, user_id, args, stats):
+        self.api = api
+        self.user_id = user_id
+        self.args = args
+        self.stats = stats
+        self.inbox = api.inbox(user_id)
+        self.cursor = 0
+        self.rng = random.Random(user_id)
+
+    async def think(self):
+        await asyncio.sleep(self.rng.uniform(*self.args.think))
+
+    async def step(self, stage, send, predicate, timeout=None):
+        """ارسال آپدیت و انتظار برای پاسخ مطابق predicate؛ تأخیر در آمار مرحله ثبت می‌شود"""
+        started = time.perf_counter()
+        send()
+        try:
+            message, self.cursor = await self.inbox.expect(
+                predicate, timeout or self.args.step_timeout, self.cursor)
+        except asyncio.TimeoutError:
+            raise SessionFailed(stage, "timeout")
+        self.stats.latency[stage].append(time.perf_counter() - started)
+        return message
+
+    async def press(self, stage, message, data, predicate, timeout=None):
+        """کلیک با تلاش مجدد وقتی ربات با «آهسته‌تر» یا «شلوغ است» پاسخ می‌دهد"""
+        for _ in range(self.args.retries):
+            reply = await self.step(
+                stage, lambda: self.api.press(self.user_id, message, data),
+                lambda m: "callback_answer" in m or predicate(m), timeout)
+            if "callback_answer" not in reply:
+                return reply
+            self.stats.pushback[stage] += 1
+            await asyncio.sleep(self.args.backoff)
+        raise SessionFailed(stage, "pushback")
+
+    async def run(self, confirmed):
+        api, user_id = self.api, self.user_id
+        await self.step("start", lambda: api.send_text(user_id, "/start"), lambda m: "text" in m)
+        await self.think()
+        events = await self.step("events", lambda: api.send_text(user_id, "📅 دیدن اجراها"),
+                                 lambda m: buttons(m, f"event|{EVENT_ID}"))
+        await self.think()
+
+        seat_view = await self.open_event(events)
+        if buttons(seat_view, "block|"):
+            await self.think()
+            block = self.rng.choice(buttons(seat_view, "block|"))
+            seat_view = await self.press("block", seat_view, block,
+                                         lambda m: buttons(m, "seat|") or buttons(m, "queue|"))
+
+        for _ in range(self.args.seat_attempts):
+            choices = buttons(seat_view, "seat|")
+            if not choices:
+                raise SessionFailed("seat", "sold out")
+            await self.think()
+            data = self.rng.choice(choices)
+            reply = await self.press("seat", seat_view, data,
+                                     lambda m: buttons(m, "confirm|") or "در دسترس نیست" in text_of(m))
+            if not buttons(reply, "confirm|"):
+                self.stats.conflicts["seat"] += 1
+                seat_view = self.drop_button(seat_view, data)
+                continue
+            await self.think()
+            seat_id = data.split("|")[2]
+            reply = await self.press("confirm", reply, f"confirm|{EVENT_ID}|{seat_id}",
+                                     lambda m: "text" in m and "reply_markup" not in m)
+            if "رزرو شد" in text_of(reply):
+                confirmed[seat_id].add(user_id)
+                break
+            self.stats.conflicts["confirm"] += 1
+            seat_view = self.drop_button(seat_view, data)
+        else:
+            raise SessionFailed("seat", "no seat after retries")
+
+        await self.think()
+        await self.step("receipt", lambda: api.send_photo(user_id, f"receipt_{user_id}"),
+                        lambda m: "رسید دریافت شد" in text_of(m))
+        await self.step("ticket", lambda: None, lambda m: "پرداخت شما تأیید شد" in text_of(m),
+                        timeout=self.args.ticket_timeout)
+
+    async def open_event(self, events):
+        """کلیک روی اجرا؛ اگر کاربر در صف انتظار قرار گرفت تا اعلام نوبت صبر می‌کند"""
+        reply = await self.press("event", events, f"event|{EVENT_ID}",
+                                 lambda m: buttons(m, "seat|") or buttons(m, "block|") or buttons(m, "queue|"))
+        while buttons(reply, "queue|"):
+            self.stats.queued += 1
+            try:
+                notice, self.cursor = await self.inbox.expect(
+                    lambda m: buttons(m, f"event|{EVENT_ID}") and "نوبت شما" in text_of(m),
+                    self.args.queue_timeout, self.cursor)
+            except asyncio.TimeoutError:
+                raise SessionFailed("queue", "timeout")
+            reply = await self.press("event", notice, f"event|{EVENT_ID}",
+                                     lambda m: buttons(m, "seat|") or buttons(m, "block|") or buttons(m, "queue|"))
+        return reply
+
+    @staticmethod
+    def drop_button(message, data):
+        """حذف صندلی امتحان شده از کیبورد تا دوباره انتخاب نشود"""
+        markup = message.get("reply_markup") or {}
+        rows = [[button for button in row if button.get("callback_data") != data]
+                for row in markup.get("inline_keyboard", [])]
+        return {**message, "reply_markup": {"inline_keyboard": rows}}
+
+
+class Stats:
+    def __init__(self):
+        self.latency = defaultdict(list)
+        self.pushback = Counter()
+        self.conflicts = Counter()
+        self.failures = Counter()
+        self.errors = Counter()
+        self.queued = 0
+        self.completed = 0
+        self.approvals = 0
+
+
+async def admin_loop(api, admin_id, stats, stop):
+    """ادمین ساختگی: هر رسید جدید را تأیید می‌کند"""
+    inbox = api.inbox(admin_id)
+    cursor = 0
+    while not stop.is_set():
+        try:
+            message, cursor = await inbox.expect(lambda m: buttons(m, "admin_approve|"), 1.0, cursor)
+        except asyncio.TimeoutError:
+            continue
+        api.press(admin_id, message, buttons(message, "admin_approve|")[0])
+        stats.approvals += 1
+
+
+def check_double_booking(bot, confirmed):
+    """فروش یا رزرو یک صندلی برای بیش از یک کاربر (سمت کاربر و سمت دیتابیس)"""
+    violations = {seat_id: sorted(users) for seat_id, users in confirmed.items() if len(users) > 1}
+    conn = bot.sqlite3.connect(bot.DB_FILE)
+    for event_id, seat_id, count in conn.execute(
+            "SELECT event_id, seat_id, COUNT(*) FROM successful_payments GROUP BY event_id, seat_id HAVING COUNT(*) > 1"):
+        violations.setdefault(seat_id, []).append(f"{count} payments")
+    for seat_id, reserved_by, paid_by in conn.execute(
+            "SELECT s.seat_id, s.reserved_by, p.user_id FROM successful_payments p "
+            "JOIN seats s ON s.event_id = p.event_id AND s.seat_id = p.seat_id WHERE s.reserved_by != p.user_id"):
+        violations.setdefault(seat_id, []).append(f"sold to {reserved_by}, paid by {paid_by}")
+    conn.close()
+    return violations
+
+
+async def simulate(bot, args):
+    api = await FakeBotApi(latency=args.latency, rate_limit_ratio=args.rate_limit, seed=args.seed).start()
+    stats = Stats()
+
+    application = await start_application(bot, api, stats.errors)
+
+    stop = asyncio.Event()
+    admin = asyncio.create_task(admin_loop(api, bot.config.ADMIN_CHAT_ID, stats, stop))
+    confirmed = defaultdict(set)
+
+    async def session(index):
+        await asyncio.sleep(args.ramp * index / max(1, args.users))
+        user = SimulatedUser(api, 100_000 + index, args, stats)
+        try:
+            await user.run(confirmed)
+            stats.completed += 1
+        except SessionFailed as e:
+            stats.failures[f"{e.stage}: {e.reason}"] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(session(i) for i in range(args.users)))
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    await admin
+    await stop_application(bot, application)
+    await api.stop()
+
+    return build_report(bot, args, api, stats, confirmed, elapsed)
+
+
+def build_report(bot, args, api, stats, confirmed, elapsed):
+    updates = sum(len(samples) for samples in stats.latency.values())
+    return {
+        "users": args.users,
+        "seats": args.rows * args.cols,
+        "elapsed_s": elapsed,
+        "completed": stats.completed,
+        "purchases_per_sec": stats.completed / elapsed if elapsed else 0.0,
+        "updates_per_sec": updates / elapsed if elapsed else 0.0,
+        "latency_ms": {
+            stage: {
+                "count": len(stats.latency[stage]),
+                "p50": percentile(stats.latency[stage], 0.5) * 1000,
+                "p95": percentile(stats.latency[stage], 0.95) * 1000,
+                "p99": percentile(stats.latency[stage], 0.99) * 1000,
+            }
+            for stage in STEPS if stats.latency[stage]
+        },
+        "failures": dict(stats.failures),
+        "failure_rate": 1 - stats.completed / args.users if args.users else 0.0,
+        "handler_errors": dict(stats.errors),
+        "pushback": dict(stats.pushback),
+        "seat_conflicts": dict(stats.conflicts),
+        "queued_sessions": stats.queued,
+        "admin_approvals": stats.approvals,
+        "bot_api_calls": sum(api.calls.values()) - api.calls["getUpdates"],
+        "bot_api_429": dict(api.rate_limited),
+        "double_bookings": check_double_booking(bot, confirmed),
+    }
+
+
+def print_report(report):
+    print(f"\n{report['users']} users, {report['seats']} seats, {report['elapsed_s']:.1f}s")
+    print(f"completed purchases: {report['completed']} ({report['purchases_per_sec']:.2f}/s), "
+          f"updates/s: {report['updates_per_sec']:.1f}, failure rate: {report['failure_rate']:.1%}")
+    print(f"{'stage':<10}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage, row in report["latency_ms"].items():
+        print(f"{stage:<10}{row['count']:>7}{row['p50']:>10.1f}{row['p95']:>10.1f}{row['p99']:>10.1f}")
+    print(f"failures: {report['failures'] or '-'}")
+    print(f"handler errors: {report['handler_errors'] or '-'}")
+    print(f"pushback (flood guard / shed): {report['pushback'] or '-'}, "
+          f"seat conflicts: {report['seat_conflicts'] or '-'}, queued sessions: {report['queued_sessions']}")
+    print(f"bot API calls: {report['bot_api_calls']}, injected 429: {report['bot_api_429'] or '-'}")
+    if report["double_bookings"]:
+        print(f"❌ double bookings: {report['double_bookings']}")
+    else:
+        print("✅ no double bookings")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--ramp", type=float, default=10.0, help="ورود کاربران در این بازه (ثانیه)")
+    parser.add_argument("--rows", type=int, default=20)
+    parser.add_argument("--cols", type=int, default=30)
+    parser.add_argument("--latency", type=float, default=0.02, help="تأخیر ساختگی هر فراخوانی Bot API (ثانیه)")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="نسبت پاسخ‌های 429 ساختگی")
+    parser.add_argument("--think", type=float, nargs=2, default=(0.2, 1.0), help="مکث کاربر بین مراحل (ثانیه)")
+    parser.add_argument("--room-capacity", type=int, help="ظرفیت صف انتظار (پیش‌فرض تنظیمات ربات)")
+    parser.add_argument("--step-timeout", type=float, default=30.0)
+    parser.add_argument("--queue-timeout", type=float, default=300.0)
+    parser.add_argument("--ticket-timeout", type=float, default=120.0)
+    parser.add_argument("--seat-attempts", type=int, default=5)
+    parser.add_argument("--retries", type=int, default=5)
+    parser.add_argument("--backoff", type=float, default=2.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="ذخیره گزارش به صورت JSON")
+    args = parser.parse_args()
+    args.output = args.output and os.path.abspath(args.output)
+
+    workdir = tempfile.mkdtemp(prefix="bench_e2e_")
+    bot = load_bot(workdir, [{"id": EVENT_ID, "title": "سالن آزمون", "rows": args.rows, "cols": args.cols}])
+    # load_bot صف انتظار را بی‌اثر می‌کند؛ اینجا رفتار واقعی سنجیده می‌شود
+    bot.waiting_room = bot.WaitingRoom(
+        args.room_capacity or bot.WAITING_ROOM_ACTIVE, bot.WAITING_ROOM_SESSION, bot.WAITING_ROOM_CLAIM)
+
+    report = asyncio.run(simulate(bot, args))
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    if report["double_bookings"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+"""سرور ساختگی Bot API تلگرام برای آزمون بار سرتاسری (بدون شبکه خارجی)
+
+فقط متدهایی که ربات استفاده می‌کند پیاده شده‌اند: getUpdates، sendMessage، sendPhoto،
+sendDocument، editMessage*، getFile، answerCallbackQuery و چند متد راه‌اندازی. هر فراخوانی
+با تأخیر ثابت latency پاسخ داده می‌شود و با احتمال rate_limit_ratio خطای 429 برمی‌گرداند.
+پیام‌های ارسالی ربات در صندوق هر چت ذخیره می‌شوند تا کاربران ساختگی آن‌ها را بخوانند.
+"""
+import asyncio
+import io
+import json
+import random
+import time
+from collections import Counter
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import parse_qsl, urlsplit
+
+# متدهایی که خطای 429 ساختگی می‌گیرند (getUpdates و راه‌اندازی هیچ‌وقت)
+RATE_LIMITED_PREFIXES = ("send", "edit", "answerCallbackQuery")
+
+
+class ChatInbox:
+    """پیام‌های ربات به یک چت، به ترتیب دریافت"""
+
+    def __init__(self):
+        self.messages = []
+        self._changed = asyncio.Event()
+
+    def push(self, item):
+        self.messages.append(item)
+        self._changed.set()
+
+    async def expect(self, predicate, timeout, cursor=0):
+        """انتظار برای اولین پیام از cursor به بعد که predicate آن درست است؛ خروجی: (پیام، cursor بعدی)"""
+        deadline = time.monotonic() + timeout
+        while True:
+            for index in range(cursor, len(self.messages)):
+                if predicate(self.messages[index]):
+                    return self.messages[index], index + 1
+            cursor = len(self.messages)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+
+class FakeBotApi:
+    """سرور HTTP حداقلی سازگار با python-telegram-bot روی 127.0.0.1"""
+
+    def __init__(self, latency=0.0, rate_limit_ratio=0.0, retry_after=1, seed=0):
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.rate_limited = Counter()
+        self.inboxes = {}
+        self._random = random.Random(seed)
+        self._updates = []
+        self._callback_users = {}
+        self._awaiting_reply = {}
+        self.reply_latency = []      # از آپدیت کاربر تا اولین پاسخ ربات به همان چت (ثانیه)
+        self.last_call_at = None
+        self._update_id = 0
+        self._message_id = 0
+        self._new_update = asyncio.Event()
+        self._server = None
+        self.port = None
+        self._photo = self._make_photo()
+
+    # ----- راه‌اندازی -----
+    async def start(self, port=0):
+        self._server = await asyncio.start_server(self._serve, "127.0.0.1", port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    @property
+    def base_file_url(self):
+        return f"http://127.0.0.1:{self.port}/file/bot"
+
+    def inbox(self, chat_id):
+        return self.inboxes.setdefault(int(chat_id), ChatInbox())
+
+    # ----- آپدیت‌های کاربران -----
+    def _next_update_id(self):
+        self._update_id += 1
+        return self._update_id
+
+    def _next_message_id(self):
+        self._message_id += 1
+        return self._message_id
+
+    @staticmethod
+    def _user(user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+    def _push(self, update):
+        update["update_id"] = self._next_update_id()
+        self._updates.append(update)
+        self._new_update.set()
+        if "callback_query" in update:
+            query = update["callback_query"]
+            self._callback_users[query["id"]] = query["from"]["id"]
+        chat_id = self._chat_of(update)
+        if chat_id is not None:
+            self._awaiting_reply.setdefault(chat_id, time.perf_counter())
+
+    def _replied(self, chat_id):
+        pushed_at = self._awaiting_reply.pop(chat_id, None)
+        if pushed_at is not None:
+            self.reply_latency.append(time.perf_counter() - pushed_at)
+
+    def push_update(self, update):
+        """تزریق آپدیت آماده (مثلاً از فایل ضبط شده)؛ update_id دوباره شماره‌گذاری می‌شود"""
+        self._push({key: value for key, value in update.items() if key != "update_id"})
+
+    @staticmethod
+    def _chat_of(update):
+        message = update.get("message") or update.get("edited_message")
+        if message:
+            return message["chat"]["id"]
+        query = update.get("callback_query")
+        if query:
+            return query["from"]["id"]
+        return None
+
+    @property
+    def pending_updates(self):
+        return len(self._updates)
+
+    def send_text(self, user_id, text):
+        message = {
+            "message_id": self._next_message_id(),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        self._push({"message": message})
+
+    def send_photo(self, user_id, file_id):
+        self._push({"message": {
+            "message_id": self._next_message_id(),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            "photo": [{"file_id": file_id, "file_unique_id": file_id, "width": 640, "height": 480}],
+        }})
+
+    def press(self, user_id, message, data):
+        """کلیک روی دکمه اینلاین پیام message (پیامی که ربات فرستاده)"""
+        self._push({"callback_query": {
+            "id": f"q{self._next_message_id()}",
+            "from": self._user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": message["message_id"],
+                "date": message["date"],
+                "chat": message["chat"],
+            },
+        }})
+
+    # ----- HTTP -----
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                http_method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                status, content_type, payload = await self._dispatch(http_method, target, headers, body)
+                writer.write(
+                    f"HTTP/1.1 {status} OK\r\nContent-Type: {content_type}\r\n"
+                    f"Content-Length: {len(payload)}\r\nConnection: keep-alive\r\n\r\n".encode("latin-1")
+                    + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # قطع اتصال کلاینت یا توقف سرور در میانه long polling
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, http_method, target, headers, body):
+        path = urlsplit(target).path
+        if path.startswith("/file/bot"):
+            return 200, "image/jpeg", self._photo
+
+        api_method = path.rsplit("/", 1)[-1]
+        params = self._parse_params(headers.get("content-type", ""), body)
+        self.calls[api_method] += 1
+
+        if api_method != "getUpdates":
+            self.last_call_at = time.perf_counter()
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if (api_method.startswith(RATE_LIMITED_PREFIXES)
+                    and self._random.random() < self.rate_limit_ratio):
+                self.rate_limited[api_method] += 1
+                return 429, "application/json", json.dumps({
+                    "ok": False, "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }).encode()
+
+        handler = getattr(self, f"_api_{api_method}", None)
+        result = await handler(params) if handler else True
+        return 200, "application/json", json.dumps({"ok": True, "result": result}).encode()
+
+    @staticmethod
+    def _parse_params(content_type, body):
+        """پارامترهای فرم (urlencoded یا multipart)؛ فایل‌های آپلودی فقط با نام ثبت می‌شوند"""
+        if content_type.startswith("multipart/form-data"):
+            message = BytesParser(policy=HTTP).parsebytes(
+                f"Content-Type: {content_type}\r\n\r\n".encode("latin-1") + body)
+            params = {}
+            for part in message.iter_parts():
+                name = part.get_param("name", header="content-disposition")
+                if part.get_filename():
+                    params[name] = f"upload:{part.get_filename()}"
+                else:
+                    params[name] = part.get_payload(decode=True).decode("utf-8")
+            return params
+        if body:
+            return dict(parse_qsl(body.decode("utf-8")))
+        return {}
+
+    @staticmethod
+    def _make_photo():
+        from PIL import Image
+
+        buffer = io.BytesIO()
+        Image.new("RGB", (64, 48), "white").save(buffer, "JPEG")
+        return buffer.getvalue()
+
+    def _outgoing(self, params, **content):
+        """ساخت پیام ربات و ثبت آن در صندوق چت"""
+        chat_id = int(params["chat_id"])
+        self._replied(chat_id)
+        message = {
+            "message_id": int(params.get("message_id") or self._next_message_id()),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "Sim"},
+            **content,
+        }
+        markup = json.loads(params.get("reply_markup") or "{}")
+        if "inline_keyboard" in markup:
+            # تلگرام فقط کیبورد اینلاین را در پیام برمی‌گرداند
+            message["reply_markup"] = markup
+        self.inbox(chat_id).push(message)
+        return message
+
+    @staticmethod
+    def _photo_sizes(params, key):
+        file_id = params.get(key, "")
+        if not file_id or file_id.startswith(("upload:", "attach://")):
+            file_id = f"photo_{time.monotonic_ns()}"
+        return [{"file_id": file_id, "file_unique_id": file_id, "width": 640, "height": 480}]
+
+    # ----- متدهای Bot API -----
+    async def _api_getMe(self, params):
+        return {"id": 1, "is_bot": True, "first_name": "Sim", "username": "sim_bot",
+                "can_join_groups": False, "can_read_all_group_messages": False,
+                "supports_inline_queries": False}
+
+    async def _api_getUpdates(self, params):
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        self._updates = [update for update in self._updates if update["update_id"] >= offset]
+        if not self._updates and timeout:
+            self._new_update.clear()
+            try:
+                await asyncio.wait_for(self._new_update.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get("limit") or 100)
+        return self._updates[:limit]
+
+    async def _api_sendMessage(self, params):
+        return self._outgoing(params, text=params.get("text", ""))
+
+    async def _api_sendPhoto(self, params):
+        return self._outgoing(params, caption=params.get("caption", ""),
+                              photo=self._photo_sizes(params, "photo"))
+
+    async def _api_sendDocument(self, params):
+        return self._outgoing(params, caption=params.get("caption", ""), document={
+            "file_id": f"doc_{time.monotonic_ns()}", "file_unique_id": f"doc_{time.monotonic_ns()}"})
+
+    async def _api_editMessageText(self, params):
+        return self._outgoing(params, text=params.get("text", ""), edit_date=int(time.time()))
+
+    async def _api_editMessageCaption(self, params):
+        return self._outgoing(params, caption=params.get("caption", ""), edit_date=int(time.time()))
+
+    async def _api_editMessageMedia(self, params):
+        media = json.loads(params.get("media") or "{}")
+        return self._outgoing(params, caption=media.get("caption", ""), edit_date=int(time.time()),
+                              photo=self._photo_sizes(media, "media"))
+
+    async def _api_editMessageReplyMarkup(self, params):
+        return self._outgoing(params, edit_date=int(time.time()))
+
+    async def _api_answerCallbackQuery(self, params):
+        user_id = self._callback_users.pop(params.get("callback_query_id"), None)
+        if user_id is not None:
+            self._replied(user_id)
+        if params.get("text") and user_id is not None:
+            # پاسخ کال‌بک فقط به صورت اعلان دیده می‌شود؛ برای کاربر ساختگی در صندوق ثبت می‌شود
+            self.inbox(user_id).push({"callback_answer": params["text"]})
+        return True
+
+    async def _api_getFile(self, params):
+        file_id = params["file_id"]
+        return {"file_id": file_id, "file_unique_id": file_id, "file_size": len(self._photo),
+                "file_path": f"photos/{file_id}.jpg"}
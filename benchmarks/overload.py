@@ -0,0 +1,100 @@
+"""آزمون بار کنترل شلوغی: هجوم کاربران به نقشه صندلی هم‌زمان با رزرو
+
+اجرا:
+    python benchmarks/overload.py [--browsers 400] [--buyers 100] [--latency 0.02]
+
+هر «مرورگر» یک کال‌بک event| یا block| می‌فرستد (رندر نقشه) و هر «خریدار» seat| و سپس
+confirm| روی یک صندلی جدا. سناریو یک‌بار با کنترل بار و یک‌بار بدون آن اجرا می‌شود و
+تأخیر p50/p99 هر گروه و تعداد پاسخ‌های کاهش‌یافته چاپ می‌شود. ربات تلگرام با یک
+شیء ساختگی با تأخیر شبکه ثابت جایگزین می‌شود؛ دیتابیس و رندرها واقعی هستند.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from common import FakeBot, load_bot, make_update, percentile, reset_runtime  # noqa: E402
+
+
+async def run_scenario(bot_module, args, seats, label):
+    bot = FakeBot(args.latency)
+    context = SimpleNamespace(bot=bot, application=None)
+    event = bot_module.event_catalog.get(args.event_id)
+    blocks = len(bot_module.get_event_blocks(event))
+    browse_latency, buy_latency = [], []
+    shed = 0
+    reserved = 0
+
+    async def browser(user_id):
+        nonlocal shed
+        await asyncio.sleep(random.random() * args.spread)
+        data = random.choice([f"event|{args.event_id}", f"block|{args.event_id}|{random.randrange(blocks)}"])
+        update, answers = make_update(bot, user_id, data)
+        start = time.perf_counter()
+        await bot_module.callback_router(update, context)
+        browse_latency.append(time.perf_counter() - start)
+        if answers and answers[0]:
+            shed += 1
+
+    async def buyer(user_id, seat_id):
+        nonlocal reserved
+        await asyncio.sleep(random.random() * args.spread)
+        start = time.perf_counter()
+        for data in (f"seat|{args.event_id}|{seat_id}", f"confirm|{args.event_id}|{seat_id}"):
+            update, _ = make_update(bot, user_id, data)
+            await bot_module.callback_router(update, context)
+        buy_latency.append(time.perf_counter() - start)
+        reserved += 1
+
+    tasks = [browser(10_000 + i) for i in range(args.browsers)]
+    tasks += [buyer(50_000 + i, seat_id) for i, seat_id in enumerate(seats)]
+    start = time.perf_counter()
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+
+    degraded = bot_module.overload.degraded
+    print(f"\n[{label}] {elapsed:.2f}s, bot API calls: {bot.calls}")
+    print(f"  browse   p50 {percentile(browse_latency, 0.5) * 1000:8.1f} ms   "
+          f"p99 {percentile(browse_latency, 0.99) * 1000:8.1f} ms")
+    print(f"  reserve  p50 {percentile(buy_latency, 0.5) * 1000:8.1f} ms   "
+          f"p99 {percentile(buy_latency, 0.99) * 1000:8.1f} ms   ({reserved} buyers)")
+    print(f"  degraded: stale maps {degraded['stale_image']}, text only {degraded['text_only']}, "
+          f"shed {shed}")
+    render = bot_module.executors["render"].snapshot()
+    print(f"  render pool: rejected {render['rejected']}, wait max {render['wait_max_ms']:.0f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--browsers", type=int, default=400)
+    parser.add_argument("--buyers", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.02, help="تأخیر ساختگی Bot API (ثانیه)")
+    parser.add_argument("--spread", type=float, default=1.0, help="پخش ورود کاربران در این بازه (ثانیه)")
+    args = parser.parse_args()
+    args.event_id = 1000
+
+    workdir = tempfile.mkdtemp(prefix="bench_overload_")
+    bot = load_bot(workdir, [{"id": args.event_id, "title": "سالن بزرگ", "rows": 50, "cols": 100}])
+
+    conn = bot.sqlite3.connect(bot.DB_FILE)
+    seat_ids = [row[0] for row in conn.execute(
+        "SELECT seat_id FROM seats WHERE event_id=? ORDER BY row, col", (args.event_id,))]
+    conn.close()
+    random.seed(1)
+    random.shuffle(seat_ids)
+
+    configured_levels = bot.OVERLOAD_LEVELS
+    reset_runtime(bot, overload_levels={})
+    asyncio.run(run_scenario(bot, args, seat_ids[:args.buyers], "without overload control"))
+    reset_runtime(bot, overload_levels=configured_levels)
+    asyncio.run(run_scenario(bot, args, seat_ids[args.buyers:2 * args.buyers], "with overload control"))
+
+
+if __name__ == "__main__":
+    main()
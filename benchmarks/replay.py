@@ -0,0 +1,182 @@
+"""بازپخش ترافیک ضبط شده روی نسخه فعلی ربات و سرور ساختگی Bot API
+
+ضبط در محیط اصلی:
+    RECORD_UPDATES=updates.jsonl.gz python main.py
+
+بازپخش:
+    python benchmarks/replay.py updates.jsonl.gz [--speed 1] [--db snapshot.db]
+                                [--latency 0.02] [--output run.json] [--compare base.json]
+
+--speed 1 یعنی با همان فاصله زمانی ضبط، --speed 5 پنج برابر سریع‌تر و --speed 0 با حداکثر
+سرعت. فاصله‌های بیکاری بیشتر از --max-gap (مثلاً بین دو اجرای ربات) کوتاه می‌شوند. اجراها
+از config.py خوانده می‌شوند و با --db می‌توان از کپی دیتابیس محیط اصلی شروع کرد. گزارش
+شامل زمان پردازش، گذردهی، صدک‌های تأخیر پاسخ، خطاهای هندلرها و پاسخ‌های 429 است و با
+--compare در کنار اجرای قبلی (مثلاً شاخه اصلی) چاپ می‌شود.
+"""
+import argparse
+import asyncio
+import copy
+import gzip
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from common import load_bot, percentile, start_application, stop_application  # noqa: E402
+from fake_bot_api import FakeBotApi  # noqa: E402
+
+
+def read_log(path):
+    """خروجی: (شناسه ساختگی ادمین، لیست (زمان، آپدیت))؛ انتهای ناقص فایل نادیده گرفته می‌شود"""
+    admin = None
+    records = []
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                if record.get("type") == "header":
+                    admin = record.get("admin", admin)
+                else:
+                    records.append((record["t"], record["update"]))
+    except (EOFError, zlib.error):
+        # ربات بدون بستن فایل متوقف شده؛ دسته‌های قبلی سالم هستند
+        pass
+    return admin, records
+
+
+def schedule(records, speed, max_gap):
+    """زمان ارسال هر آپدیت نسبت به شروع بازپخش (ثانیه)"""
+    offsets = []
+    elapsed = 0.0
+    previous = records[0][0] if records else 0.0
+    for received_at, _ in records:
+        elapsed += min(max(0.0, received_at - previous), max_gap)
+        previous = received_at
+        offsets.append(elapsed / speed if speed else 0.0)
+    return offsets
+
+
+async def replay(bot, args, records):
+    api = await FakeBotApi(latency=args.latency, rate_limit_ratio=args.rate_limit, seed=args.seed).start()
+    errors = Counter()
+    application = await start_application(bot, api, errors)
+
+    offsets = schedule(records, args.speed, args.max_gap)
+    started = time.perf_counter()
+    lag = 0.0
+    for offset, (_, update) in zip(offsets, records):
+        if args.speed:
+            delay = started + offset - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            lag = max(lag, -delay)
+        else:
+            await asyncio.sleep(0)
+        api.push_update(update)
+
+    # صبر تا مصرف همه آپدیت‌ها و بیکار شدن ربات
+    while api.pending_updates or time.perf_counter() - (api.last_call_at or started) < args.drain:
+        await asyncio.sleep(0.2)
+    finished = (api.last_call_at or started) - started
+
+    await stop_application(bot, application)
+    await api.stop()
+
+    return {
+        "log": os.path.basename(args.log),
+        "speed": args.speed,
+        "updates": len(records),
+        "recorded_span_s": schedule(records, 1, args.max_gap)[-1],
+        "processing_s": finished,
+        "updates_per_sec": len(records) / finished if finished else 0.0,
+        "schedule_lag_max_s": lag,
+        "reply_latency_ms": {
+            "count": len(api.reply_latency),
+            "p50": percentile(api.reply_latency, 0.5) * 1000,
+            "p95": percentile(api.reply_latency, 0.95) * 1000,
+            "p99": percentile(api.reply_latency, 0.99) * 1000,
+        },
+        "handler_errors": dict(errors),
+        "bot_api_calls": sum(api.calls.values()) - api.calls["getUpdates"],
+        "bot_api_429": dict(api.rate_limited),
+    }
+
+
+def print_report(report, baseline=None):
+    rows = [
+        ("updates", lambda r: r["updates"], "{:.0f}"),
+        ("processing s", lambda r: r["processing_s"], "{:.2f}"),
+        ("updates/s", lambda r: r["updates_per_sec"], "{:.1f}"),
+        ("reply p50 ms", lambda r: r["reply_latency_ms"]["p50"], "{:.1f}"),
+        ("reply p95 ms", lambda r: r["reply_latency_ms"]["p95"], "{:.1f}"),
+        ("reply p99 ms", lambda r: r["reply_latency_ms"]["p99"], "{:.1f}"),
+        ("handler errors", lambda r: sum(r["handler_errors"].values()), "{:.0f}"),
+        ("bot API calls", lambda r: r["bot_api_calls"], "{:.0f}"),
+    ]
+    speed = f"{report['speed']}x" if report["speed"] else "max speed"
+    print(f"\nreplay of {report['log']} at {speed} "
+          f"(recorded span {report['recorded_span_s']:.1f}s, max schedule lag {report['schedule_lag_max_s']:.2f}s)")
+    print(f"{'':<16}{'this run':>12}" + (f"{'baseline':>12}{'change':>10}" if baseline else ""))
+    for label, value, fmt in rows:
+        line = f"{label:<16}{fmt.format(value(report)):>12}"
+        if baseline:
+            before = value(baseline)
+            change = f"{(value(report) - before) / before:+.0%}" if before else "-"
+            line += f"{fmt.format(before):>12}{change:>10}"
+        print(line)
+    if report["handler_errors"]:
+        print(f"handler errors: {report['handler_errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("log", help="فایل ضبط شده (RECORD_UPDATES)")
+    parser.add_argument("--speed", type=float, default=1.0, help="ضریب سرعت؛ 0 یعنی حداکثر سرعت")
+    parser.add_argument("--max-gap", type=float, default=60.0, help="حداکثر فاصله بیکاری بین دو آپدیت (ثانیه)")
+    parser.add_argument("--db", help="کپی دیتابیس محیط اصلی برای شروع از همان وضعیت صندلی‌ها")
+    parser.add_argument("--latency", type=float, default=0.02, help="تأخیر ساختگی هر فراخوانی Bot API (ثانیه)")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="نسبت پاسخ‌های 429 ساختگی")
+    parser.add_argument("--drain", type=float, default=3.0, help="بیکاری لازم برای پایان بازپخش (ثانیه)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="ذخیره گزارش به صورت JSON")
+    parser.add_argument("--compare", help="گزارش JSON اجرای قبلی برای مقایسه")
+    args = parser.parse_args()
+    args.log = os.path.abspath(args.log)
+    args.output = args.output and os.path.abspath(args.output)
+
+    admin, records = read_log(args.log)
+    if not records:
+        sys.exit(f"no updates in {args.log}")
+
+    workdir = tempfile.mkdtemp(prefix="bench_replay_")
+    if args.db:
+        shutil.copy(args.db, os.path.join(workdir, "tickets.db"))
+    import config
+
+    bot = load_bot(workdir, copy.deepcopy(config.EVENTS))
+    if admin is not None:
+        # شناسه ادمین هم در فایل ضبط ساختگی شده است
+        config.ADMIN_CHAT_ID = admin
+
+    report = asyncio.run(replay(bot, args, records))
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""بنچمارک زمان راه‌اندازی (init_db) برای سالن ۵۰۰۰ صندلی
+
+اجرا:
+    python benchmarks/startup.py [--rows 50] [--cols 100]
+
+سناریوها: ساخت اولیه، راه‌اندازی مجدد بدون تغییر، تغییر قیمت یک ردیف
+و بزرگ‌شدن سالن. همه روی یک دیتابیس موقت و بدون اتصال به شبکه اجرا می‌شوند.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def timed(label, func):
+    start = time.perf_counter()
+    func()
+    elapsed = (time.perf_counter() - start) * 1000
+    print(f"{label:<28} {elapsed:9.1f} ms")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=50)
+    parser.add_argument("--cols", type=int, default=100)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_startup_")
+    os.chdir(workdir)
+
+    import config
+    import main as bot
+
+    bot.DB_FILE = os.path.join(workdir, "tickets.db")
+    venue = {
+        "id": 1000,
+        "title": "سالن بزرگ",
+        "rows": args.rows,
+        "cols": args.cols,
+        "prices": {1: 300000, 2: 250000, 3: 200000},
+    }
+    config.EVENTS = [venue]
+
+    print(f"venue: {args.rows} x {args.cols} = {args.rows * args.cols} seats")
+    timed("cold start", bot.init_db)
+    timed("warm start (unchanged)", bot.init_db)
+
+    venue["prices"] = {1: 350000, 2: 250000, 3: 200000}
+    timed("row price change", bot.init_db)
+
+    venue["rows"] += 10
+    timed("grow by 10 rows", bot.init_db)
+
+    conn = bot.sqlite3.connect(bot.DB_FILE)
+    count = conn.execute("SELECT COUNT(*) FROM seats WHERE event_id=?", (venue["id"],)).fetchone()[0]
+    conn.close()
+    assert count == venue["rows"] * venue["cols"], count
+    print(f"seats provisioned: {count}")
+
+
+if __name__ == "__main__":
+    main()
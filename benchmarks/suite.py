@@ -0,0 +1,217 @@
+"""مجموعه بنچمارک مسیرهای پرتکرار: دیتابیس، رندر و مسیریابی کال‌بک‌ها
+
+اجرا:
+    python benchmarks/suite.py [--fixtures small,medium,large] [--iterations 50]
+                               [--output results.json] [--baseline baseline.json]
+                               [--threshold 0.2] [--save-baseline baseline.json]
+
+برای هر سالن نمونه (کوچک ۵×۸، متوسط ۲۰×۳۰، بزرگ ۵۰×۱۰۰) دیتابیس موقت با کاربران،
+پرداخت‌ها و پیام‌های پشتیبانی تصادفی (با seed ثابت) ساخته می‌شود و برای هر عملیات
+ops/sec و تأخیر p50/p99 گزارش می‌شود. با --baseline نتایج با اجرای ذخیره شده قبلی مقایسه
+و عملیاتی که p50 آن بیش از threshold کندتر شده با کد خروج ۱ گزارش می‌شود.
+همه چیز بدون شبکه اجرا می‌شود.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from common import FakeBot, load_bot, make_update, percentile  # noqa: E402
+
+EVENT_ID = 1000
+FIXTURES = {
+    "small": {"rows": 5, "cols": 8, "users": 200, "payments": 10, "support": 20},
+    "medium": {"rows": 20, "cols": 30, "users": 2000, "payments": 150, "support": 200},
+    "large": {"rows": 50, "cols": 100, "users": 20000, "payments": 1500, "support": 1000},
+}
+
+
+def seed_fixture(bot, spec, rng):
+    """پر کردن جداول کاربران، پرداخت‌ها و پشتیبانی با داده تصادفی تکرارپذیر"""
+    now = int(time.time())
+    conn = bot.sqlite3.connect(bot.DB_FILE)
+    c = conn.cursor()
+    c.executemany(
+        "INSERT INTO users (user_id, username, first_name, last_name, joined_at, last_activity) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        ((100_000 + i, f"user{i}", "نام", "خانوادگی", now - rng.randrange(90 * 86400),
+          now - rng.randrange(7 * 86400)) for i in range(spec["users"]))
+    )
+    c.execute("SELECT seat_id FROM seats WHERE event_id=? ORDER BY row, col", (EVENT_ID,))
+    seat_ids = [row[0] for row in c.fetchall()]
+    sold = rng.sample(seat_ids, spec["payments"])
+    for seat_id in sold:
+        user_id = 100_000 + rng.randrange(spec["users"])
+        c.execute("UPDATE seats SET status='sold', reserved_by=? WHERE event_id=? AND seat_id=?",
+                  (user_id, EVENT_ID, seat_id))
+        c.execute("INSERT INTO successful_payments (user_id, event_id, seat_id, paid_at) VALUES (?, ?, ?, ?)",
+                  (user_id, EVENT_ID, seat_id, now - rng.randrange(86400)))
+    c.executemany(
+        "INSERT INTO support_messages (user_id, message_text, message_type, created_at) VALUES (?, ?, 'text', ?)",
+        ((100_000 + rng.randrange(spec["users"]), "سلام، سوال درباره بلیت", now - rng.randrange(86400))
+         for _ in range(spec["support"]))
+    )
+    conn.commit()
+    conn.close()
+    return [seat_id for seat_id in seat_ids if seat_id not in set(sold)]
+
+
+def summarize(samples, elapsed):
+    return {
+        "ops": len(samples),
+        "ops_per_sec": len(samples) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(samples, 0.5) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+    }
+
+
+def bench_sync(func, iterations):
+    samples = []
+    start = time.perf_counter()
+    for i in range(iterations):
+        t = time.perf_counter()
+        func(i)
+        samples.append(time.perf_counter() - t)
+    return summarize(samples, time.perf_counter() - start)
+
+
+async def bench_async(func, iterations):
+    samples = []
+    start = time.perf_counter()
+    for i in range(iterations):
+        t = time.perf_counter()
+        await func(i)
+        samples.append(time.perf_counter() - t)
+    return summarize(samples, time.perf_counter() - start)
+
+
+def run_fixture(name, spec, iterations):
+    rng = random.Random(42)
+    workdir = tempfile.mkdtemp(prefix=f"bench_{name}_")
+    venue = {"id": EVENT_ID, "title": f"سالن {name}", "rows": spec["rows"], "cols": spec["cols"],
+             "prices": {1: 300000, 2: 250000, 3: 200000}}
+    bot = load_bot(workdir, [venue])
+    free_seats = seed_fixture(bot, spec, rng)
+    bot.availability.load()
+    event = bot.event_catalog.get(EVENT_ID)
+    blocks = bot.get_event_blocks(event)
+    results = {}
+
+    # ----- مسیرهای همگام (مستقیم، بدون کش) -----
+    results["render.seat_map"] = bench_sync(
+        lambda i: bot._generate_seat_map_image_sync(EVENT_ID), iterations)
+    results["render.block_map"] = bench_sync(
+        lambda i: bot._generate_block_map_image_sync(EVENT_ID, i % len(blocks)), iterations)
+    results["render.qr_code"] = bench_sync(
+        lambda i: bot._generate_qr_code_sync(EVENT_ID, free_seats[i % len(free_seats)], 100_000 + i), iterations)
+    results["db.financial_report"] = bench_sync(
+        lambda i: bot._get_financial_report_sync(), iterations)
+    results["db.users_stats"] = bench_sync(
+        lambda i: bot._get_users_stats_sync(), iterations)
+    results["db.block_seats"] = bench_sync(
+        lambda i: bot._get_block_seats_sync(EVENT_ID, blocks[i % len(blocks)]), iterations)
+
+    async def async_paths():
+        fake = FakeBot()
+        context = SimpleNamespace(bot=fake, application=None)
+
+        async def reserve_release(i):
+            seat_id = free_seats[i % len(free_seats)]
+            await bot.set_reserved(EVENT_ID, seat_id, 1)
+            await bot.release_seat(EVENT_ID, seat_id, 1)
+
+        async def reserve_burst(i):
+            # ۳۲ رزرو هم‌زمان روی صندلی‌های مختلف (group commit)
+            seats = [free_seats[(i * 32 + k) % len(free_seats)] for k in range(32)]
+            await asyncio.gather(*(bot.set_reserved(EVENT_ID, seat_id, 2 + k) for k, seat_id in enumerate(seats)))
+            await asyncio.gather(*(bot.release_seat(EVENT_ID, seat_id, 2 + k) for k, seat_id in enumerate(seats)))
+
+        async def route(data_for):
+            async def op(i):
+                update, _ = make_update(fake, 200_000 + i, data_for(i))
+                await bot.callback_router(update, context)
+            return op
+
+        out = {
+            "db.reserve_release": await bench_async(reserve_release, iterations),
+            "db.reserve_burst_32": await bench_async(reserve_burst, max(1, iterations // 5)),
+            "route.event": await bench_async(await route(lambda i: f"event|{EVENT_ID}"), iterations),
+            "route.block_page": await bench_async(
+                await route(lambda i: f"page|{EVENT_ID}|{i % len(blocks)}|0"), iterations),
+            "route.seat": await bench_async(
+                await route(lambda i: f"seat|{EVENT_ID}|{free_seats[i % len(free_seats)]}"), iterations),
+        }
+        return out
+
+    results.update(asyncio.run(async_paths()))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """خروجی: لیست (عملیات، p50 قبلی، p50 فعلی، نسبت) برای عملیات کندتر شده"""
+    regressions = []
+    for fixture, ops in results.items():
+        for op, stats in ops.items():
+            before = baseline.get(fixture, {}).get(op)
+            if not before or not before["p50_ms"]:
+                continue
+            ratio = stats["p50_ms"] / before["p50_ms"]
+            if ratio > 1 + threshold:
+                regressions.append((f"{fixture}/{op}", before["p50_ms"], stats["p50_ms"], ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--fixtures", default="small,medium,large")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--output", help="ذخیره نتایج به صورت JSON")
+    parser.add_argument("--baseline", help="فایل JSON اجرای مرجع برای مقایسه")
+    parser.add_argument("--threshold", type=float, default=0.2, help="حداکثر کندی مجاز p50 (نسبت)")
+    parser.add_argument("--save-baseline", help="ذخیره همین اجرا به عنوان مرجع")
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    results = {}
+    for name in args.fixtures.split(","):
+        spec = FIXTURES[name]
+        print(f"\n== {name}: {spec['rows']} x {spec['cols']} seats, {spec['users']} users ==")
+        results[name] = run_fixture(name, spec, args.iterations)
+        for op, stats in results[name].items():
+            print(f"{op:<24} {stats['ops_per_sec']:10.1f} ops/s   "
+                  f"p50 {stats['p50_ms']:8.2f} ms   p99 {stats['p99_ms']:8.2f} ms")
+    os.chdir(cwd)
+
+    report = {
+        "created_at": int(time.time()),
+        "python": platform.python_version(),
+        "iterations": args.iterations,
+        "results": results,
+    }
+    for path in filter(None, (args.output, args.save_baseline)):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nsaved: {path}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n⚠️ regressions (p50 slower by more than {args.threshold:.0%}):")
+            for op, before, after, ratio in regressions:
+                print(f"  {op:<32} {before:8.2f} ms -> {after:8.2f} ms  (x{ratio:.2f})")
+            sys.exit(1)
+        print("\nno regressions against baseline")
+
+
+if __name__ == "__main__":
+    main()
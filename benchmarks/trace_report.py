@@ -0,0 +1,117 @@
+"""گزارش کندترین آپدیت‌ها از فایل ردگیری (traces.jsonl)
+
+ثبت ردگیری در محیط اصلی (پیش‌فرض ۱٪ آپدیت‌ها و همه آپدیت‌های کندتر از یک ثانیه):
+    TRACE_FILE=traces.jsonl TRACE_SAMPLE=0.05 python main.py
+
+گزارش:
+    python benchmarks/trace_report.py [traces.jsonl] [--top 10] [--name callback:seat]
+                                      [--folded stacks.txt]
+
+فایل‌های چرخشی (traces.jsonl.1، ...) هم خوانده می‌شوند. برای هر کدام از کندترین traceها
+درخت spanها با زمان شروع و مدت چاپ می‌شود و در پایان، زمان خالص (بدون زمان فرزندان)
+هر مسیر span روی همه traceها جمع و به شکل نمودار میله‌ای نمایش داده می‌شود. با --folded
+همین داده در قالب folded stacks برای flamegraph.pl یا speedscope ذخیره می‌شود.
+"""
+import argparse
+import glob
+import json
+import sys
+from collections import Counter, defaultdict
+
+
+def read_traces(path, name=None):
+    traces = []
+    for filename in sorted(glob.glob(path + "*")):
+        with open(filename, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    trace = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if name is None or trace["name"].startswith(name):
+                    traces.append(trace)
+    return traces
+
+
+def children_of(trace):
+    children = defaultdict(list)
+    for span in trace["spans"]:
+        children[span["parent"]].append(span)
+    for spans in children.values():
+        spans.sort(key=lambda span: span["start_ms"])
+    return children
+
+
+def print_tree(trace):
+    print(f"\n{trace['duration_ms']:9.1f} ms  {trace['name']}  trace={trace['trace_id']}"
+          f"  {json.dumps(trace.get('attrs') or {}, ensure_ascii=False)}")
+    children = children_of(trace)
+
+    def walk(parent, depth):
+        for span in children[parent]:
+            attrs = " ".join(f"{k}={v}" for k, v in (span.get("attrs") or {}).items())
+            print(f"{span['duration_ms']:9.1f} ms  +{span['start_ms']:<8.1f} {'  ' * depth}{span['name']}  {attrs}")
+            walk(span["id"], depth + 1)
+
+    walk(0, 1)
+
+
+def self_times(trace):
+    """زمان خالص هر مسیر span (ریشه تا خود span) در یک trace؛ کلیدها با ';' جدا شده‌اند"""
+    children = children_of(trace)
+    totals = Counter()
+
+    def walk(parent, path, duration):
+        own = duration
+        for span in children[parent]:
+            own -= span["duration_ms"]
+            walk(span["id"], f"{path};{span['name']}", span["duration_ms"])
+        # spanهای هم‌زمان (gather) ممکن است از والد بیشتر شوند
+        totals[path] += max(own, 0.0)
+
+    walk(0, trace["name"], trace["duration_ms"])
+    return totals
+
+
+def print_breakdown(totals, limit, width=40):
+    grand = sum(totals.values()) or 1.0
+    print(f"\nself time by span path (all {len(totals)} paths, top {limit}):")
+    top = totals.most_common(limit)
+    longest = top[0][1] if top else 1.0
+    for path, value in top:
+        bar = "█" * max(1, round(value / longest * width))
+        print(f"{value:10.1f} ms {value / grand:6.1%}  {bar:<{width}}  {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path", nargs="?", default="traces.jsonl")
+    parser.add_argument("--top", type=int, default=10, help="تعداد کندترین traceها")
+    parser.add_argument("--name", help="فقط traceهایی که نامشان با این شروع می‌شود")
+    parser.add_argument("--breakdown", type=int, default=25, help="تعداد مسیرها در جمع‌بندی")
+    parser.add_argument("--folded", help="ذخیره folded stacks (میکروثانیه) برای flamegraph")
+    args = parser.parse_args()
+
+    traces = read_traces(args.path, args.name)
+    if not traces:
+        sys.exit(f"no traces in {args.path}*")
+    traces.sort(key=lambda trace: trace["duration_ms"], reverse=True)
+    slow = sum(1 for trace in traces if trace.get("slow"))
+    print(f"{len(traces)} traces ({slow} slow), slowest {args.top}:")
+    for trace in traces[:args.top]:
+        print_tree(trace)
+
+    totals = Counter()
+    for trace in traces:
+        totals.update(self_times(trace))
+    print_breakdown(totals, args.breakdown)
+
+    if args.folded:
+        with open(args.folded, "w", encoding="utf-8") as f:
+            for path, value in sorted(totals.items()):
+                f.write(f"{path} {round(value * 1000)}\n")
+        print(f"\nsaved: {args.folded}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,40 +1,252 @@
 import sqlite3
 import time
 import os
+import sys
 from datetime import datetime, timedelta
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, InputMediaPhoto
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 from telegram.ext import (
-    ApplicationBuilder, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
+    Application, ApplicationBuilder, ApplicationHandlerStop, CommandHandler, CallbackQueryHandler, ContextTypes,
+    MessageHandler, TypeHandler, filters
 )
 import logging
-from apscheduler.schedulers.background import BackgroundScheduler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from PIL import Image, ImageDraw, ImageFont                                  
 import qrcode
 import json
+import io
+import csv
+import tempfile
+import importlib.util
+import urllib.parse
+import random
+import bisect
+import hashlib
+import itertools
+import hmac
+import gzip
+import re
+import zlib
+import math
+import threading
+import tracemalloc
+import contextlib
+import contextvars
+import functools
+from collections import Counter, OrderedDict, deque
 from typing import Dict, List, Tuple
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import atexit
+import queue
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import config
 
 # ----- لاگ -----
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', 
-    level=logging.INFO
-)
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")   # لاگ JSON چرخشی؛ خالی یعنی فقط کنسول
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_MAX_BYTES = 20 * 1024 * 1024
+LOG_BACKUPS = 5
+LOG_QUEUE_SIZE = 10000        # رکوردهای بیشتر از این در صف دور ریخته می‌شوند
+# نسبت نگه‌داشتن لاگ‌های زیر WARNING به تفکیک دسته (extra category یا نام logger)؛
+# با LOG_SAMPLE="callback=1,httpx=0" قابل تغییر است
+LOG_SAMPLING = {"callback": 0.1, "message": 0.1, "httpx": 0.05}
+LOG_SAMPLING.update({category: float(rate) for category, rate in
+                     (item.split("=") for item in os.getenv("LOG_SAMPLE", "").split(",") if item)})
+
+# trace جاری هر آپدیت (Tracer)؛ شناسه آن به لاگ‌ها هم اضافه می‌شود
+_trace_var = contextvars.ContextVar("trace", default=None)
+_span_var = contextvars.ContextVar("span", default=None)
+
+class LogSampler(logging.Filter):
+    """نمونه‌برداری لاگ‌های پرتکرار؛ هشدارها و خطاها همیشه عبور می‌کنند"""
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+        self.dropped = Counter()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        category = getattr(record, "category", None) or record.name.split(".")[0]
+        rate = self.rates.get(category)
+        if rate is None or random.random() < rate:
+            return True
+        self.dropped[category] += 1
+        return False
+
+class NonBlockingQueueHandler(QueueHandler):
+    """تحویل رکورد به ترد نویسنده بدون قالب‌بندی و بدون انتظار.
+
+    قالب‌بندی پیام (args) و traceback در ترد QueueListener انجام می‌شود و اگر صف پر باشد
+    (دیسک یا ترمینال کند) رکورد دور ریخته و شمرده می‌شود تا حلقه رویداد هرگز منتظر نماند.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        trace = _trace_var.get()
+        if trace is not None:
+            record.trace_id = trace["trace_id"]
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class JsonLogFormatter(logging.Formatter):
+    """هر رکورد یک خط JSON با فیلدهای ساختاریافته"""
+
+    FIELDS = ("user", "event", "action", "category", "trace_id")
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def setup_logging(sampler: LogSampler) -> NonBlockingQueueHandler:
+    """کنسول (متنی) و فایل چرخشی (JSON) پشت یک صف و ترد نویسنده"""
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    handlers = [console]
+    if LOG_FILE:
+        file_handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS,
+                                           encoding="utf-8", delay=True)
+        file_handler.setFormatter(JsonLogFormatter())
+        handlers.append(file_handler)
+    
+    handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    handler.addFilter(sampler)
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(handler)
+    listener = QueueListener(handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # رکوردهای مانده در صف هنگام خروج نوشته می‌شوند
+    atexit.register(listener.stop)
+    return handler
+
+log_sampler = LogSampler(LOG_SAMPLING)
+log_handler = setup_logging(log_sampler)
 logger = logging.getLogger(__name__)
 
 DB_FILE = "tickets.db"
 RESERVE_TIMEOUT = 60
 SEAT_SIZE = 40
 MARGIN = 20
+BLOCK_ROWS = 10           # تعداد ردیف‌های هر بلوک سالن
+BLOCK_COLS = 10           # تعداد ستون‌های هر بلوک سالن
+BLOCK_TILE_WIDTH = 90
+BLOCK_TILE_HEIGHT = 60
+SEATS_PER_PAGE = 30       # حداکثر دکمه صندلی در هر صفحه کیبورد
+SEAT_BUTTONS_PER_ROW = 5
+DEFAULT_SEAT_PRICE = 100000
+MAX_EVENT_SEATS = 20000
+LIVE_MAP_DEBOUNCE = 3        # ثانیه؛ تجمیع تغییرات قبل از به‌روزرسانی نقشه‌های زنده
+LIVE_MAP_MAX_VIEWERS = 30    # حداکثر پیام نقشه زنده برای هر اجرا
+JOB_WORKERS = 2              # تعداد کارگرهای صف کارها
+JOB_MAX_ATTEMPTS = 5         # پس از این تعداد تلاش، کار به لیست ناموفق‌ها می‌رود
+JOB_RETRY_BASE = 10          # ثانیه؛ فاصله تلاش مجدد به صورت نمایی زیاد می‌شود
+JOB_LEASE = 120              # ثانیه؛ کار در حال اجرای رها شده پس از این مدت دوباره برداشته می‌شود
+JOB_POLL_INTERVAL = 5
+EXPIRY_CHECK_INTERVAL = 30    # ثانیه؛ فاصله بررسی رزروهای منقضی
+RESERVE_REMINDER_AFTER = 1800
+RESERVE_EXPIRE_AFTER = 2400
+GROUP_COMMIT_WINDOW = 0.003   # ثانیه؛ نوشتن‌هایی که در این فاصله برسند با یک commit ثبت می‌شوند
+GROUP_COMMIT_MAX = 256        # حداکثر درخواست نوشتن در هر تراکنش
+# استخرهای ترد به تفکیک نوع کار: (تعداد ترد، حداکثر کار در صف)
+EXECUTOR_POOLS = {
+    "db": (8, 200),        # خواندن‌های دیتابیس
+    "render": (2, 16),     # رندر نقشه، رسید و QR با Pillow
+    "admin": (2, 8),       # گزارش‌ها و کارهای سنگین ادمین
+    "seat": (2, 64),       # مسیر انتخاب و رزرو صندلی؛ جدا از نقشه‌ها تا همیشه اولویت داشته باشد
+}
+# آستانه‌های سطوح کاهش کیفیت: اگر یکی از معیارها به آستانه برسد، آن سطح فعال می‌شود
+# (نسبت پر بودن صف رندر، نسبت پر بودن صف دیتابیس، میانگین تأخیر هندلرها به ثانیه)
+OVERLOAD_LEVELS = {
+    1: {"render_queue": 0.25, "db_queue": 0.5, "latency": 1.0},   # نقشه قبلی از کش (کمی قدیمی)
+    2: {"render_queue": 0.6, "db_queue": 0.7, "latency": 2.5},    # فقط متن، بدون رندر
+    3: {"render_queue": 0.9, "db_queue": 0.85, "latency": 5.0},   # رد درخواست‌های مرور با «شلوغ است»
+}
+OVERLOAD_WINDOW = 10          # ثانیه؛ بازه میانگین تأخیر هندلرها
+MAP_STALE_MAX = 60            # ثانیه؛ حداکثر عمر نقشه کش شده در حالت شلوغی
+# محدودیت درخواست هر کاربر به تفکیک نوع کار: (توکن در ثانیه، حداکثر توکن ذخیره)
+FLOOD_LIMITS = {
+    "browse": (1.0, 5),      # مرور اجراها و نقشه‌ها
+    "reserve": (0.5, 4),     # انتخاب، تأیید و لغو صندلی
+    "admin": (5.0, 20),      # کال‌بک‌های پنل ادمین و پشتیبانی
+    "message": (1.0, 6),     # پیام متنی و دستورات
+    "upload": (0.2, 3),      # عکس رسید
+}
+CALLBACK_DEBOUNCE = 1.5       # ثانیه؛ کال‌بک تکراری یکسان در این فاصله نادیده گرفته می‌شود
+FLOOD_IDLE_TTL = 300          # ثانیه؛ وضعیت کاربران غیرفعال پس از این مدت پاک می‌شود
+WAITING_ROOM_ACTIVE = 50      # حداکثر کاربر هم‌زمان در حال انتخاب صندلی هر اجرا
+WAITING_ROOM_SESSION = 180    # ثانیه؛ نوبت کاربر بدون فعالیت پس از این مدت آزاد می‌شود
+WAITING_ROOM_CLAIM = 60       # ثانیه؛ مهلت استفاده از نوبت پس از اعلام آن
+WAITING_ROOM_SNAPSHOT = 5     # ثانیه؛ فاصله ذخیره وضعیت صف برای بازیابی پس از ری‌استارت
+ON_SALE_WARMUP = 120          # ثانیه؛ آماده‌سازی کش نقشه‌ها قبل از شروع فروش
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))   # پورت محلی /metrics برای Prometheus؛ 0 یعنی غیرفعال
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_MAX_SERIES = 200      # حداکثر ترکیب برچسب هر متریک
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")   # خالی یعنی ردگیری غیرفعال
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE", "0.01"))   # نسبت آپدیت‌هایی که ثبت می‌شوند
+TRACE_SLOW = 1.0              # ثانیه؛ آپدیت‌های کندتر از این همیشه ثبت می‌شوند
+TRACE_MAX_BYTES = 10 * 1024 * 1024
+TRACE_BACKUPS = 5
+PROFILE_INTERVAL = 0.005      # فاصله نمونه‌برداری /profile (ثانیه)
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = 300
+PROFILE_TOP = 40              # تعداد توابع در هر جدول گزارش
+SLOW_HANDLER_THRESHOLD = float(os.getenv("SLOW_HANDLER_SECONDS", "2.0"))   # 0 یعنی غیرفعال
+SLOW_HANDLER_INTERVAL = 0.05  # فاصله نمونه‌برداری از هندلرهای کند (ثانیه)
+SLOW_HANDLER_DEPTH = 12       # عمق پشته ثبت شده
+MEMORY_CHECK_INTERVAL = 300   # فاصله بررسی‌های دوره‌ای حافظه (ثانیه)
+MEMORY_ALERT_MB = float(os.getenv("MEMORY_ALERT_MB", "1024"))   # آستانه هشدار RSS؛ 0 یعنی بدون هشدار
+MEMORY_ALERT_COOLDOWN = 3600  # حداقل فاصله دو هشدار (ثانیه)
+MEMORY_TRACEMALLOC = int(os.getenv("MEMORY_TRACEMALLOC", "0"))  # عمق پشته tracemalloc؛ 0 یعنی خاموش
+MEMORY_HISTORY = 288          # تعداد بررسی‌های نگه‌داشته شده (۲۴ ساعت)
+MEMORY_TOP = 15
+SLOW_SQL_THRESHOLD = float(os.getenv("SLOW_SQL_MS", "50")) / 1000   # آستانه کوئری کند (ثانیه)؛ 0 یعنی بدون زمان‌سنجی
+SLOW_SQL_SAMPLES = 1000       # نمونه‌های اخیر هر دستور برای p99
+SLOW_SQL_EXPLAIN_TTL = 600    # حداقل فاصله دو EXPLAIN برای یک دستور (ثانیه)
+SLOW_SQL_MAX_STATEMENTS = 500
+EXPORT_BATCH = 1000           # ردیف‌های هر fetchmany در خروجی فایل
+EXPORT_MAX_BYTES = 50 * 1024 * 1024   # سقف ارسال فایل در Bot API
+# مسیر فایل ضبط آپدیت‌ها (gzip) برای بازپخش؛ خالی یعنی ضبط غیرفعال
+UPDATE_RECORD_FILE = os.getenv("RECORD_UPDATES")
+
+# دکمه‌های کیبورد اصلی کاربر و پنل مدیریت
+MAIN_MENU_BUTTONS = ("📅 دیدن اجراها", "📊 آمار صندلی‌ها", "❓ راهنما", "🛠 پنل مدیریت", "📞 ارتباط با پشتیبانی")
+ADMIN_MENU_BUTTONS = (
+    "👥 مدیریت ادمین‌ها", "💰 گزارش مالی", "🎯 مدیریت قیمت صندلی‌ها", "🎭 مدیریت اجراها", "📊 آمار لحظه‌ای",
+    "👤 لیست کاربران", "📞 پیام‌های پشتیبانی", "🧾 صف ارسال بلیت", "🔙 بازگشت",
+)
 
 # تعریف global برای app
 app = None
+scheduler = None
 
 # فقط در حالت توسعه دیتابیس ریست شود
 if os.getenv("RESET_DB") == "1" and os.path.exists(DB_FILE):
     os.remove(DB_FILE)
-    print("✅ فایل دیتابیس قدیمی حذف شد (حالت توسعه)")
+    logger.info("فایل دیتابیس قدیمی حذف شد (حالت توسعه)")
 
 if not os.path.exists("receipts"):
     os.makedirs("receipts")
@@ -43,13 +255,1463 @@ if not os.path.exists("qrcodes"):
 if not os.path.exists("event_posters"):
     os.makedirs("event_posters")
 
-# اجرای کوئری‌ها در ترد جداگانه
-executor = ThreadPoolExecutor(max_workers=10)
+# ----- متریک‌ها -----
+class MetricsRegistry:
+    """هیستوگرام‌ها، شمارنده‌ها و gauge ها با خروجی متنی Prometheus.
+
+    ثبت هر نمونه فقط یک bisect و چند جمع زیر یک قفل است و از هر تردی قابل فراخوانی است.
+    برای جلوگیری از رشد بی‌حد، هر متریک حداکثر max_series ترکیب برچسب دارد و بقیه با
+    مقدار other جمع می‌شوند.
+    """
+
+    def __init__(self, prefix: str, buckets: Tuple[float, ...], max_series: int):
+        self.prefix = prefix
+        self.buckets = buckets
+        self.max_series = max_series
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, Dict[Tuple, List]] = {}
+        self._counters: Dict[str, Dict[Tuple, float]] = {}
+        self._gauges: Dict[str, object] = {}
+        self._help: Dict[str, str] = {}
+
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+
+    def _series(self, metrics: Dict, name: str, labels: Dict, empty):
+        series = metrics.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        if key not in series and len(series) >= self.max_series:
+            key = tuple((label, "other") for label, _ in key)
+        if key not in series:
+            series[key] = empty()
+        return key, series
+
+    def observe(self, name: str, seconds: float, **labels):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            key, series = self._series(self._histograms, name, labels,
+                                       lambda: [[0] * (len(self.buckets) + 1), 0.0, 0])
+            histogram = series[key]
+            histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        with self._lock:
+            key, series = self._series(self._counters, name, labels, lambda: 0)
+            series[key] += amount
+
+    def gauge(self, name: str, func):
+        """func در زمان خواندن اجرا می‌شود؛ خروجی عدد یا لیست (برچسب‌ها، مقدار)"""
+        self._gauges[name] = func
+
+    def cache(self, cache: str, hit: bool):
+        self.inc("cache_requests_total", cache=cache, result="hit" if hit else "miss")
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def histograms(self, name: str) -> Dict[Tuple, Tuple[List[int], float, int]]:
+        with self._lock:
+            return {key: (list(counts), total, count)
+                    for key, (counts, total, count) in self._histograms.get(name, {}).items()}
+
+    def counters(self, name: str) -> Dict[Tuple, float]:
+        with self._lock:
+            return dict(self._counters.get(name, {}))
+
+    def quantile(self, counts: List[int], q: float) -> float:
+        """تخمین صدک از روی سطل‌ها (درون‌یابی خطی داخل سطل)"""
+        total = sum(counts)
+        if not total:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.buckets[-1] * 2
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    @staticmethod
+    def _labels(key: Tuple, le=None) -> str:
+        parts = [f'{label}="{MetricsRegistry._escape(value)}"' for label, value in key]
+        if le is not None:
+            parts.append(f'le="{le}"')
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    @staticmethod
+    def _escape(value) -> str:
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    def render(self) -> str:
+        """خروجی متنی قالب Prometheus"""
+        lines = []
+        with self._lock:
+            histograms = {name: {key: (list(h[0]), h[1], h[2]) for key, h in series.items()}
+                          for name, series in self._histograms.items()}
+            counters = {name: dict(series) for name, series in self._counters.items()}
+        for name, series in sorted(histograms.items()):
+            full = self.prefix + name
+            if name in self._help:
+                lines.append(f"# HELP {full} {self._help[name]}")
+            lines.append(f"# TYPE {full} histogram")
+            for key, (counts, total, count) in series.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{full}_bucket{self._labels(key, bound)} {cumulative}")
+                lines.append(f"{full}_bucket{self._labels(key, '+Inf')} {count}")
+                lines.append(f"{full}_sum{self._labels(key)} {total}")
+                lines.append(f"{full}_count{self._labels(key)} {count}")
+        for name, series in sorted(counters.items()):
+            full = self.prefix + name
+            if name in self._help:
+                lines.append(f"# HELP {full} {self._help[name]}")
+            lines.append(f"# TYPE {full} counter")
+            for key, value in series.items():
+                lines.append(f"{full}{self._labels(key)} {value}")
+        for name, func in sorted(self._gauges.items()):
+            full = self.prefix + name
+            if name in self._help:
+                lines.append(f"# HELP {full} {self._help[name]}")
+            lines.append(f"# TYPE {full} gauge")
+            value = func()
+            for labels, sample in (value if isinstance(value, list) else [({}, value)]):
+                lines.append(f"{full}{self._labels(tuple(sorted(labels.items())))} {sample}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry("ticketbot_", METRICS_BUCKETS, METRICS_MAX_SERIES)
+metrics.describe("handler_seconds", "Handler latency by handler and callback action")
+metrics.describe("db_seconds", "Duration of DB read functions and group-commit writes")
+metrics.describe("render_seconds", "Duration of Pillow/QR renders by renderer")
+metrics.describe("executor_wait_seconds", "Time a task waited in a thread pool queue")
+metrics.describe("bot_api_seconds", "Bot API request latency by method")
+metrics.describe("bot_api_responses_total", "Bot API responses by method and HTTP status")
+metrics.describe("cache_requests_total", "Cache lookups by cache and result")
+metrics.describe("seat_write_seconds", "Seat write latency per event, from submit to group commit")
+
+def metric_name(func) -> str:
+    """نام کوتاه تابع برای برچسب (_get_seats_sync → get_seats)"""
+    name = getattr(func, "__name__", "call").strip("_")
+    return name[:-5] if name.endswith("_sync") else name
+
+def timed_handler(func):
+    """ثبت مدت اجرای هندلر در handler_seconds و نمونه‌برداری از پشته اگر کند شود"""
+    @functools.wraps(func)
+    async def wrapper(update, context):
+        with metrics.timer("handler_seconds", handler=func.__name__, action="-"), slow_handlers.watch(func.__name__):
+            return await func(update, context)
+    return wrapper
+
+class MetricsHTTPHandler(BaseHTTPRequestHandler):
+    """GET /metrics برای Prometheus (فقط روی 127.0.0.1)"""
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port: int):
+    server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHTTPHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info("متریک‌ها روی http://127.0.0.1:%d/metrics", port)
+    return server
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest با ثبت تأخیر و کد پاسخ هر فراخوانی Bot API (از جمله 429)"""
+
+    async def do_request(self, url: str, method: str, request_data=None, *args, **kwargs):
+        # دانلود فایل‌ها هم از همین مسیر است؛ مسیر فایل برچسب نمی‌شود
+        api_method = "file_download" if "/file/bot" in url else url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        with tracer.span(f"bot_api:{api_method}") as span:
+            try:
+                status, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+            except TelegramError as e:
+                metrics.inc("bot_api_responses_total", method=api_method, status=type(e).__name__)
+                span["error"] = type(e).__name__
+                raise
+            finally:
+                metrics.observe("bot_api_seconds", time.perf_counter() - started, method=api_method)
+            span["status"] = status
+        metrics.inc("bot_api_responses_total", method=api_method, status=str(status))
+        return status, payload
+
+# ----- ردگیری درخواست‌ها -----
+
+class Tracer:
+    """ردگیری هر آپدیت از دریافت تا آخرین فراخوانی Bot API.
+
+    هر آپدیت یک trace دارد و spanها (صف و اجرای استخر ترد، توابع دیتابیس، رندرها و
+    فراخوانی‌های Bot API) با contextvars به آن وصل می‌شوند؛ داخل استخرهای ترد هم همان
+    context کپی می‌شود. در پایان، trace با احتمال sample_rate یا اگر کندتر از slow باشد
+    در فایل JSONL چرخشی نوشته می‌شود (نوشتن در ترد جداگانه).
+    """
+
+    def __init__(self, path: str, sample_rate: float, slow: float, max_bytes: int, backups: int):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.slow = slow
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._queue = queue.Queue(maxsize=1000)
+        self._thread = None
+        self._span_ids = itertools.count(1)
+        self.written = 0
+        self.dropped = 0
+
+    @contextlib.contextmanager
+    def trace(self, name: str, **attrs):
+        """trace یک آپدیت؛ بدون path هیچ کاری انجام نمی‌شود"""
+        if not self.path:
+            yield None
+            return
+        trace = {"trace_id": os.urandom(8).hex(), "name": name, "ts": time.time(),
+                 "attrs": attrs, "spans": [], "_t0": time.perf_counter()}
+        trace_token = _trace_var.set(trace)
+        span_token = _span_var.set(0)
+        try:
+            yield trace
+        finally:
+            _span_var.reset(span_token)
+            _trace_var.reset(trace_token)
+            self._finish(trace)
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attrs):
+        """span داخل trace جاری؛ attrs برگردانده می‌شود تا فراخواننده برچسب اضافه کند"""
+        trace = _trace_var.get()
+        if trace is None:
+            yield attrs
+            return
+        span_id = next(self._span_ids)
+        parent = _span_var.get()
+        token = _span_var.set(span_id)
+        started = time.perf_counter()
+        try:
+            yield attrs
+        finally:
+            _span_var.reset(token)
+            self._append(trace, span_id, parent, name, started, time.perf_counter() - started, attrs)
+
+    def record(self, name: str, started: float, duration: float, **attrs):
+        """ثبت span از زمان‌های اندازه‌گیری شده (مثلاً انتظار در صف استخر)"""
+        trace = _trace_var.get()
+        if trace is not None:
+            self._append(trace, next(self._span_ids), _span_var.get(), name, started, duration, attrs)
+
+    @staticmethod
+    def _append(trace, span_id, parent, name, started, duration, attrs):
+        # append روی list در CPython اتمیک است؛ spanهای تردهای استخر هم همین‌جا ثبت می‌شوند
+        trace["spans"].append({
+            "id": span_id, "parent": parent, "name": name,
+            "start_ms": round((started - trace["_t0"]) * 1000, 3),
+            "duration_ms": round(duration * 1000, 3),
+            **({"attrs": attrs} if attrs else {}),
+        })
+
+    def _finish(self, trace):
+        duration = time.perf_counter() - trace["_t0"]
+        if duration < self.slow and random.random() >= self.sample_rate:
+            return
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="trace-writer", daemon=True)
+            self._thread.start()
+        # کارهای پس‌زمینه‌ای که از این آپدیت شروع شده‌اند ممکن است بعداً span اضافه کنند؛
+        # همان spanهای تا این لحظه نوشته می‌شوند
+        record = {key: value for key, value in trace.items() if key != "_t0"}
+        record.update(spans=list(trace["spans"]), duration_ms=round(duration * 1000, 3),
+                      slow=duration >= self.slow)
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        handler = RotatingFileHandler(self.path, maxBytes=self.max_bytes, backupCount=self.backups,
+                                      encoding="utf-8")
+        while True:
+            trace = self._queue.get()
+            handler.emit(logging.makeLogRecord({"msg": json.dumps(trace, ensure_ascii=False)}))
+            self.written += 1
+
+tracer = Tracer(TRACE_FILE, TRACE_SAMPLE_RATE, TRACE_SLOW, TRACE_MAX_BYTES, TRACE_BACKUPS)
+
+def trace_name(update: Update) -> str:
+    """نام trace یک آپدیت (callback:seat، command:/start، message:photo، ...)"""
+    if update.callback_query:
+        return f"callback:{(update.callback_query.data or '').split('|', 1)[0]}"
+    message = update.message
+    if message is None:
+        return "update"
+    if message.photo:
+        return "message:photo"
+    if message.text and message.text.startswith("/"):
+        return f"command:{message.text.split()[0].split('@')[0]}"
+    return "message:text"
+
+class TracedApplication(Application):
+    """Application که پردازش هر آپدیت را داخل یک trace اجرا می‌کند"""
+
+    async def process_update(self, update: object) -> None:
+        if not isinstance(update, Update):
+            return await super().process_update(update)
+        user = update.effective_user
+        with tracer.trace(trace_name(update), user=user.id if user else None):
+            await super().process_update(update)
+
+# ----- پروفایل CPU و هندلرهای کند -----
+def frame_label(frame, line: bool = False) -> str:
+    """نام تابع با فایل و خط تعریف (یا خط فعلی)"""
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno if line else code.co_firstlineno})"
+
+def frame_stack(frame, line: bool = False) -> List[str]:
+    """پشته یک ترد از ریشه تا تابع در حال اجرا"""
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame, line))
+        frame = frame.f_back
+    labels.reverse()
+    return labels
+
+def coroutine_stack(coro) -> List[str]:
+    """زنجیره awaitهای یک کوروتین معلق، از هندلر تا جایی که منتظر مانده"""
+    labels = []
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        labels.append(frame_label(frame, line=True))
+        awaited = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+        if awaited is not None and not hasattr(awaited, "cr_frame") and not hasattr(awaited, "gi_frame"):
+            labels.append(f"<{type(awaited).__name__}>")
+            break
+        coro = awaited
+    return labels
+
+class SamplingProfiler:
+    """پروفایلر نمونه‌برداری برای ربات در حال اجرا، بدون راه‌اندازی مجدد.
+
+    در یک ترد جداگانه هر interval ثانیه پشته همه تردها (sys._current_frames) خوانده می‌شود
+    و برای هر تابع تعداد نمونه‌هایی که بالای پشته بوده (self) یا در پشته حضور داشته (total)
+    شمرده می‌شود. نمونه‌های تردهای بیکار (منتظر صف، select و ...) جدا شمرده می‌شوند.
+    """
+
+    IDLE_FRAMES = {("selectors.py", "select"), ("threading.py", "wait"), ("queue.py", "get"),
+                   ("thread.py", "_worker")}
+    IGNORED_THREADS = {"profiler", "slow-handlers"}
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.running = False
+
+    def start(self, seconds: float) -> Future:
+        """شروع نمونه‌برداری؛ Future با متن گزارش کامل می‌شود"""
+        if self.running:
+            raise RuntimeError("profiler already running")
+        self.running = True
+        future = Future()
+        threading.Thread(target=self._run, args=(seconds, future), name="profiler", daemon=True).start()
+        return future
+
+    def _run(self, seconds: float, future: Future):
+        try:
+            future.set_result(self._profile(seconds))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            self.running = False
+
+    def _profile(self, seconds: float) -> str:
+        own = threading.get_ident()
+        self_counts, total_counts, stacks, threads = Counter(), Counter(), Counter(), Counter()
+        samples = idle = 0
+        started = time.perf_counter()
+        while time.perf_counter() - started < seconds:
+            names = {thread.ident: re.sub(r"_\d+$", "", thread.name) for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own or names.get(ident) in self.IGNORED_THREADS:
+                    continue
+                samples += 1
+                if (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in self.IDLE_FRAMES:
+                    idle += 1
+                    continue
+                stack = frame_stack(frame)
+                thread = names.get(ident, str(ident))
+                threads[thread] += 1
+                self_counts[stack[-1]] += 1
+                total_counts.update(set(stack))
+                stacks[";".join([thread] + stack)] += 1
+            time.sleep(self.interval)
+        elapsed = time.perf_counter() - started
+        
+        busy = max(samples - idle, 1)
+        lines = [
+            f"CPU profile: {elapsed:.1f}s, interval {self.interval * 1000:.0f}ms, "
+            f"{samples} thread samples ({idle} idle, {samples - idle} busy)",
+            "busy samples per thread: " + ", ".join(f"{name} {count}" for name, count in threads.most_common()),
+            "",
+            "top functions by self samples:",
+            f"{'self%':>7} {'total%':>7}  function",
+        ]
+        for label, count in self_counts.most_common(PROFILE_TOP):
+            lines.append(f"{count / busy:7.1%} {total_counts[label] / busy:7.1%}  {label}")
+        lines += ["", "top functions by total samples:", f"{'total%':>7} {'self%':>7}  function"]
+        for label, count in total_counts.most_common(PROFILE_TOP):
+            lines.append(f"{count / busy:7.1%} {self_counts[label] / busy:7.1%}  {label}")
+        lines += ["", "folded stacks (flamegraph.pl / speedscope):"]
+        lines += [f"{stack} {count}" for stack, count in stacks.most_common()]
+        return "\n".join(lines) + "\n"
+
+profiler = SamplingProfiler(PROFILE_INTERVAL)
+
+class SlowHandlerWatchdog:
+    """نمونه‌برداری خودکار از پشته هندلرهایی که از threshold طولانی‌تر می‌شوند.
+
+    هر هندلر هنگام شروع ثبت می‌شود و یک ترد ناظر هر interval ثانیه از هندلرهای طولانی
+    نمونه می‌گیرد: اگر حلقه رویداد همان لحظه مشغول اجرای همان task باشد پشته ترد اصلی
+    ([running]، کار CPU روی حلقه) و در غیر این صورت زنجیره awaitها ([awaiting]، جایی که
+    منتظر مانده). پس از پایان هندلر، پرتکرارترین پشته‌ها در لاگ ثبت و در recent نگه داشته
+    می‌شوند.
+    """
+
+    def __init__(self, threshold: float, interval: float, keep: int = 20):
+        self.threshold = threshold
+        self.interval = interval
+        self.recent = deque(maxlen=keep)
+        self._active: Dict[int, tuple] = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def begin(self, name: str) -> int:
+        if self.threshold <= 0:
+            return 0
+        handler_id = next(self._ids)
+        with self._lock:
+            self._active[handler_id] = (name, time.perf_counter(), asyncio.current_task(),
+                                        threading.get_ident(), Counter())
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="slow-handlers", daemon=True)
+            self._thread.start()
+        return handler_id
+
+    def end(self, handler_id: int):
+        with self._lock:
+            entry = self._active.pop(handler_id, None)
+        if entry is None:
+            return
+        name, started, _, _, stacks = entry
+        elapsed = time.perf_counter() - started
+        if elapsed < self.threshold or not stacks:
+            return
+        capture = {"handler": name, "at": datetime.now(), "seconds": elapsed,
+                   "samples": sum(stacks.values()), "stacks": stacks.most_common(3)}
+        self.recent.append(capture)
+        metrics.inc("slow_handlers_total", handler=name)
+        logger.warning(self.format(capture))
+
+    @contextlib.contextmanager
+    def watch(self, name: str):
+        handler_id = self.begin(name)
+        try:
+            yield
+        finally:
+            self.end(handler_id)
+
+    @staticmethod
+    def format(capture) -> str:
+        lines = [f"هندلر کند {capture['handler']}: {capture['seconds']:.2f}s، {capture['samples']} نمونه"]
+        for stack, count in capture["stacks"]:
+            lines.append(f"  {count}× " + " -> ".join(stack))
+        return "\n".join(lines)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            now = time.perf_counter()
+            frames = None
+            with self._lock:
+                for name, started, task, loop_ident, stacks in self._active.values():
+                    if now - started < self.threshold:
+                        continue
+                    if frames is None:
+                        frames = sys._current_frames()
+                    stacks[self._stack(task, frames.get(loop_ident))] += 1
+
+    @staticmethod
+    def _compact(labels: List[str]) -> tuple:
+        """از اولین تابع همین فایل به بعد؛ از هر دنباله توابع کتابخانه‌ها فقط آخری می‌ماند"""
+        own = f"({os.path.basename(__file__)}:"
+        kept = []
+        for index, label in enumerate(labels):
+            if own in label:
+                kept.append(label)
+            elif kept and (index + 1 == len(labels) or own in labels[index + 1]):
+                kept.append(f"… {label}")
+        return tuple(kept[-SLOW_HANDLER_DEPTH:] or labels[-SLOW_HANDLER_DEPTH:])
+
+    def _stack(self, task, loop_frame) -> tuple:
+        try:
+            if task is None or asyncio.current_task(task.get_loop()) is task:
+                return ("[running]",) + self._compact(frame_stack(loop_frame, line=True))
+            return ("[awaiting]",) + self._compact(coroutine_stack(task.get_coro()))
+        except Exception as e:
+            # خواندن پشته از ترد دیگر هم‌زمان با تغییر آن؛ به جای خطا نمونه نامعلوم ثبت می‌شود
+            return (f"[unavailable: {type(e).__name__}]",)
+
+slow_handlers = SlowHandlerWatchdog(SLOW_HANDLER_THRESHOLD, SLOW_HANDLER_INTERVAL)
+
+# اجرای کارهای blocking در استخرهای ترد جداگانه
+class ExecutorBusy(RuntimeError):
+    """صف استخر ترد پر است؛ فراخواننده باید پاسخ ساده‌تری بدهد یا بعداً تلاش کند"""
+
+class WorkloadExecutor:
+    """استخر ترد یک نوع کار با صف محدود.
+
+    اگر تعداد کارهای در حال اجرا و در صف از workers + max_queue بیشتر شود، کار جدید
+    بلافاصله با ExecutorBusy رد می‌شود تا یک نوع کار (مثلاً رندر) بقیه را معطل نکند.
+    """
+
+    def __init__(self, name: str, workers: int, max_queue: int):
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"{name}-pool")
+        self._lock = threading.Lock()
+        self._inflight = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def run(self, func, *args):
+        with self._lock:
+            if self._inflight >= self.workers + self.max_queue:
+                self.rejected += 1
+                raise ExecutorBusy(self.name)
+            self._inflight += 1
+            self.submitted += 1
+        
+        submitted_at = time.perf_counter()
+        kind = "render" if self.name == "render" else "db"
+        name = metric_name(func)
+        
+        def task():
+            started = time.perf_counter()
+            waited = started - submitted_at
+            with self._lock:
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+            metrics.observe("executor_wait_seconds", waited, pool=self.name)
+            tracer.record("queue_wait", submitted_at, waited, pool=self.name)
+            try:
+                with tracer.span(f"{kind}:{name}"):
+                    return func(*args)
+            finally:
+                if kind == "render":
+                    metrics.observe("render_seconds", time.perf_counter() - started, renderer=name)
+                else:
+                    metrics.observe("db_seconds", time.perf_counter() - started, query=name)
+        
+        with tracer.span(f"executor:{self.name}"):
+            # context جاری (trace و span) به ترد استخر هم منتقل می‌شود
+            future = self._pool.submit(contextvars.copy_context().run, task)
+            # کار لغو شده‌ای که هرگز اجرا نشده هم از شمارش خارج می‌شود
+            future.add_done_callback(self._release)
+            return await asyncio.wrap_future(future)
+
+    def _release(self, _future):
+        with self._lock:
+            self._inflight -= 1
+
+    def queue_depth(self) -> int:
+        return max(0, self._inflight - self.workers)
+
+    def snapshot(self) -> Dict:
+        started = self.submitted - self.queue_depth()
+        return {
+            'name': self.name,
+            'workers': self.workers,
+            'max_queue': self.max_queue,
+            'queued': self.queue_depth(),
+            'running': min(self._inflight, self.workers),
+            'submitted': self.submitted,
+            'rejected': self.rejected,
+            'wait_avg_ms': self.wait_total / started * 1000 if started else 0.0,
+            'wait_max_ms': self.wait_max * 1000,
+        }
+
+executors = {name: WorkloadExecutor(name, workers, max_queue)
+             for name, (workers, max_queue) in EXECUTOR_POOLS.items()}
+metrics.gauge("executor_queue_depth",
+              lambda: [({"pool": name}, pool.queue_depth()) for name, pool in executors.items()])
+
+async def run_in_thread(func, *args, workload: str = "db"):
+    """اجرای توابع blocking در استخر ترد نوع کار مربوطه"""
+    return await executors[workload].run(func, *args)
+
+# ----- پایش حافظه -----
+def process_rss() -> int:
+    """RSS فعلی پروسه (بایت)؛ بدون /proc بیشینه RSS از resource برگردانده می‌شود"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+def state_container_sizes() -> Dict[str, int]:
+    """تعداد اعضای ظرف‌های وضعیت سطح ماژول و ظرف‌های داخلی اشیای سراسری همین ماژول"""
+    containers = (dict, list, set, deque)
+    sizes = {}
+    for name, value in list(globals().items()):
+        if name.startswith("__") or name.isupper() or isinstance(value, (type, MemoryMonitor)):
+            continue
+        if isinstance(value, containers):
+            sizes[name] = len(value)
+        elif type(value).__module__ == __name__:
+            for attr, inner in list(getattr(value, "__dict__", {}).items()):
+                if isinstance(inner, containers):
+                    sizes[f"{name}.{attr}"] = len(inner)
+    return sizes
+
+def format_bytes(size: float, sign: bool = False) -> str:
+    return f"{size / 1024 / 1024:{'+' if sign else ''}.1f}MB"
+
+class MemoryMonitor:
+    """پایش رشد حافظه در اجرای طولانی.
+
+    در هر بررسی RSS پروسه، اندازه همه ظرف‌های وضعیت (دیکشنری‌های انتظار ادمین، کش‌ها و
+    ظرف‌های داخلی اشیای سراسری) و اگر tracemalloc فعال باشد آمار تخصیص به تفکیک خط ثبت
+    و با بررسی قبلی و اولین بررسی مقایسه می‌شود. عبور RSS از alert_bytes به ADMIN_CHAT_ID
+    هشدار داده می‌شود (حداکثر یک‌بار در هر cooldown ثانیه).
+    """
+
+    FILTERS = (
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        tracemalloc.Filter(False, "<unknown>"),
+    )
+
+    def __init__(self, alert_bytes: int, cooldown: float, history: int, top: int):
+        self.alert_bytes = alert_bytes
+        self.cooldown = cooldown
+        self.top = top
+        self.history = deque(maxlen=history)    # (زمان، RSS)
+        self.sizes: Dict[str, int] = {}
+        self.first_sizes: Dict[str, int] = {}
+        self.previous_sizes: Dict[str, int] = {}
+        self.allocations_recent = []            # رشد تخصیص‌ها از بررسی قبلی
+        self.allocations_total = []             # رشد تخصیص‌ها از اولین snapshot
+        self._first_stats = None
+        self._previous_stats = None
+        self._lock = threading.Lock()
+        self._bot = None
+        self.last_alert = 0.0
+
+    def attach(self, bot):
+        self._bot = bot
+
+    def start_tracing(self, frames: int):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self._first_stats = self._previous_stats = None
+        self.allocations_recent, self.allocations_total = [], []
+
+    def stop_tracing(self):
+        tracemalloc.stop()
+        self._first_stats = self._previous_stats = None
+        self.allocations_recent, self.allocations_total = [], []
+
+    def _allocation_stats(self) -> Dict[str, Tuple[int, int]]:
+        snapshot = tracemalloc.take_snapshot().filter_traces(self.FILTERS)
+        stats = {}
+        for stat in snapshot.statistics("lineno"):
+            frame = stat.traceback[0]
+            site = f"{os.path.join(*frame.filename.split(os.sep)[-2:])}:{frame.lineno}"
+            stats[site] = (stat.size, stat.count)
+        return stats
+
+    def _growth(self, stats, before) -> List[Tuple[str, int, int, int]]:
+        """(محل تخصیص، رشد حجم، رشد تعداد بلوک، حجم فعلی) به ترتیب بیشترین رشد"""
+        rows = []
+        for site, (size, count) in stats.items():
+            old_size, old_count = before.get(site, (0, 0))
+            if size > old_size:
+                rows.append((site, size - old_size, count - old_count, size))
+        rows.sort(key=lambda row: row[1], reverse=True)
+        return rows[:self.top]
+
+    def collect(self) -> int:
+        """یک بررسی کامل (blocking، در استخر admin)؛ خروجی: RSS فعلی"""
+        rss = process_rss()
+        sizes = state_container_sizes()
+        stats = self._allocation_stats() if tracemalloc.is_tracing() else None
+        with self._lock:
+            self.history.append((time.time(), rss))
+            self.previous_sizes, self.sizes = self.sizes or sizes, sizes
+            self.first_sizes = self.first_sizes or sizes
+            if stats is not None:
+                if self._previous_stats is not None:
+                    self.allocations_recent = self._growth(stats, self._previous_stats)
+                    self.allocations_total = self._growth(stats, self._first_stats)
+                else:
+                    self._first_stats = stats
+                self._previous_stats = stats
+        return rss
+
+    async def check(self):
+        """بررسی دوره‌ای (scheduler) و هشدار به ادمین در صورت عبور از آستانه"""
+        rss = await run_in_thread(self.collect, workload="admin")
+        if not self.alert_bytes or rss < self.alert_bytes or self._bot is None:
+            return
+        if time.time() - self.last_alert < self.cooldown:
+            return
+        self.last_alert = time.time()
+        logger.warning(f"مصرف حافظه از آستانه گذشت: {format_bytes(rss)}")
+        try:
+            await self._bot.send_message(chat_id=config.ADMIN_CHAT_ID,
+                                         text="⚠️ هشدار حافظه\n\n" + self.report(limit=5))
+        except TelegramError as e:
+            logger.error(f"خطا در ارسال هشدار حافظه: {e}")
+
+    def report(self, limit: int = 10) -> str:
+        with self._lock:
+            history = list(self.history)
+            sizes, first, previous = dict(self.sizes), dict(self.first_sizes), dict(self.previous_sizes)
+            recent, total = list(self.allocations_recent), list(self.allocations_total)
+        if not history:
+            return "هنوز بررسی انجام نشده است."
+        (first_at, first_rss), (_, rss) = history[0], history[-1]
+        previous_rss = history[-2][1] if len(history) > 1 else rss
+        hours = (time.time() - first_at) / 3600
+        lines = [
+            f"RSS: {format_bytes(rss)} | از بررسی قبلی {format_bytes(rss - previous_rss, sign=True)} | "
+            f"در {hours:.1f} ساعت {format_bytes(rss - first_rss, sign=True)} (بیشینه {format_bytes(max(r for _, r in history))})",
+        ]
+        if self.alert_bytes:
+            lines.append(f"آستانه هشدار: {format_bytes(self.alert_bytes)}")
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            lines.append(f"tracemalloc: {format_bytes(current)} (بیشینه {format_bytes(peak)})")
+        else:
+            lines.append("tracemalloc غیرفعال است (/memory start)")
+        
+        lines.append("\n📦 ظرف‌های وضعیت (تعداد | تغییر از بررسی قبلی | از شروع):")
+        for name, count in sorted(sizes.items(), key=lambda item: item[1], reverse=True)[:limit]:
+            lines.append(f"• {name}: {count} | {count - previous.get(name, 0):+d} | {count - first.get(name, 0):+d}")
+        growing = sorted(((count - first.get(name, 0), name) for name, count in sizes.items()), reverse=True)
+        growing = [(delta, name) for delta, name in growing[:limit] if delta > 0]
+        if growing:
+            lines.append("📈 بیشترین رشد از شروع: " + "، ".join(f"{name} {delta:+d}" for delta, name in growing))
+        
+        for title, rows in (("🧮 رشد تخصیص از بررسی قبلی:", recent), ("🧮 رشد تخصیص از شروع ردگیری:", total)):
+            if rows:
+                lines.append(f"\n{title}")
+                for site, size, count, current in rows[:limit]:
+                    lines.append(f"• {site}: {format_bytes(size, sign=True)} ({count:+d} بلوک، اکنون {format_bytes(current)})")
+        return "\n".join(lines)
+
+memory_monitor = MemoryMonitor(int(MEMORY_ALERT_MB * 1024 * 1024), MEMORY_ALERT_COOLDOWN,
+                               MEMORY_HISTORY, MEMORY_TOP)
+metrics.gauge("memory_rss_bytes", process_rss)
+metrics.gauge("state_container_items",
+              lambda: [({"container": name}, count) for name, count in memory_monitor.sizes.items()])
+
+# ----- ادغام درخواست‌های هم‌زمان یکسان -----
+class SingleFlight:
+    """درخواست‌های هم‌زمان با کلید یکسان یک محاسبه مشترک را منتظر می‌مانند.
+
+    اولین فراخواننده کار را شروع می‌کند و بقیه تا پایان همان کار صبر می‌کنند و همان
+    نتیجه (یا همان خطا) را می‌گیرند. پس از پایان، درخواست بعدی دوباره محاسبه می‌شود.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[Tuple, asyncio.Future] = {}
+        self.started = Counter()
+        self.shared = Counter()
+
+    async def run(self, key: Tuple, func, *args, workload: str = "db"):
+        """اجرای func در استخر ترد، مشترک بین فراخواننده‌های هم‌زمان با همین کلید"""
+        future = self._inflight.get(key)
+        with tracer.span(f"single_flight:{key[0]}", shared=future is not None):
+            if future is None:
+                # کار مشترک در trace اولین فراخواننده ثبت می‌شود
+                future = asyncio.ensure_future(run_in_thread(func, *args, workload=workload))
+                self._inflight[key] = future
+                future.add_done_callback(lambda done: self._finish(key, done))
+                self.started[key[0]] += 1
+                metrics.cache("single_flight", False)
+            else:
+                self.shared[key[0]] += 1
+                metrics.cache("single_flight", True)
+            # لغو یکی از منتظرها کار مشترک را برای بقیه لغو نمی‌کند
+            return await asyncio.shield(future)
+
+    def _finish(self, key: Tuple, future: asyncio.Future):
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+        if not future.cancelled():
+            future.exception()    # جلوگیری از هشدار خطای بازیابی نشده وقتی همه منتظرها رفته‌اند
 
-async def run_in_thread(func, *args):
-    """اجرای توابع blocking در ترد جداگانه"""
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(executor, func, *args)
+single_flight = SingleFlight()
+
+# ----- کنترل بار -----
+class OverloadController:
+    """تشخیص شلوغی از روی صف استخرها و تأخیر هندلرها و کاهش تدریجی کیفیت پاسخ.
+
+    سطح ۱: نقشه کش شده قبلی (تا MAP_STALE_MAX ثانیه) به جای رندر جدید.
+    سطح ۲: فقط متن و کیبورد، بدون رندر. سطح ۳: درخواست‌های مرور با پیام «شلوغ است» رد می‌شوند.
+    مسیر انتخاب و رزرو صندلی (seat| و confirm|) هیچ‌وقت رد نمی‌شود.
+    """
+
+    STALE_MAPS, TEXT_ONLY, SHED = 1, 2, 3
+    BROWSE_PREFIXES = ("event|", "block|", "page|", "stats|", "map|", "back_to_events")
+
+    def __init__(self, levels: Dict[int, Dict[str, float]], window: float):
+        self.levels = levels
+        self.window = window
+        self._samples = deque()
+        self._total = 0.0
+        self._cache: Dict[Tuple, Tuple[object, int, float]] = {}
+        self.degraded = Counter()
+        # آخرین سطح محاسبه شده در حلقه رویداد؛ ترد metrics فقط همین را می‌خواند
+        self.current_level = 0
+
+    def observe(self, seconds: float):
+        """ثبت مدت اجرای یک هندلر"""
+        now = time.monotonic()
+        self._samples.append((now, seconds))
+        self._total += seconds
+        self._trim(now)
+        self.level()
+
+    def _trim(self, now: float):
+        while self._samples and self._samples[0][0] < now - self.window:
+            self._total -= self._samples.popleft()[1]
+        if not self._samples:
+            self._total = 0.0
+
+    def latency(self) -> float:
+        self._trim(time.monotonic())
+        if not self._samples:
+            return 0.0
+        return self._total / len(self._samples)
+
+    def level(self) -> int:
+        render = executors["render"]
+        db = executors["db"]
+        render_ratio = render.queue_depth() / max(render.max_queue, 1)
+        db_ratio = db.queue_depth() / max(db.max_queue, 1)
+        latency = self.latency()
+        
+        current = 0
+        for level, limits in sorted(self.levels.items()):
+            if (render_ratio >= limits["render_queue"] or db_ratio >= limits["db_queue"]
+                    or latency >= limits["latency"]):
+                current = level
+        self.current_level = current
+        return current
+
+    def should_shed(self, data: str) -> bool:
+        """آیا این کال‌بک مرور باید با «شلوغ است» پاسخ داده شود"""
+        if data.startswith(self.BROWSE_PREFIXES) and self.level() >= self.SHED:
+            self.degraded["shed"] += 1
+            return True
+        return False
+
+    def remember(self, key: Tuple, value, version: int):
+        """نگهداری آخرین نقشه یا کپشن ساخته شده همراه نسخه صندلی‌های آن اجرا"""
+        self._cache[key] = (value, version, time.monotonic())
+
+    def cached(self, key: Tuple, version: int, level: int):
+        """مقدار کش شده اگر از آن زمان تغییری نبوده، یا در شلوغی اگر هنوز خیلی قدیمی نشده باشد"""
+        entry = self._cache.get(key)
+        if entry is None:
+            metrics.cache(key[0], False)
+            return None
+        value, cached_version, stored_at = entry
+        if cached_version == version:
+            metrics.cache(key[0], True)
+            return value
+        if level >= self.STALE_MAPS and time.monotonic() - stored_at <= MAP_STALE_MAX:
+            self.degraded[f"stale_{key[0]}"] += 1
+            metrics.cache(key[0], True)
+            return value
+        metrics.cache(key[0], False)
+        return None
+
+overload = OverloadController(OVERLOAD_LEVELS, OVERLOAD_WINDOW)
+metrics.gauge("overload_level", lambda: overload.current_level)
+
+# ----- زمان‌سنجی کوئری‌ها -----
+@functools.lru_cache(maxsize=1024)
+def sql_fingerprint(sql: str) -> str:
+    """متن دستور با مقادیر ثابت جایگزین شده با ? و فاصله‌های یکسان"""
+    sql = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    sql = re.sub(r"\b\d+(?:\.\d+)?\b", "?", sql)
+    sql = re.sub(r"\s+", " ", sql).strip().rstrip(";")
+    return re.sub(r"\bIN \((?:\?, ?)+\?\)", "IN (?...)", sql, flags=re.IGNORECASE)
+
+def sql_params_shape(params) -> str:
+    """نوع پارامترها بدون مقدارشان، مثلاً (int, str, NoneType)"""
+    if isinstance(params, dict):
+        return "{" + ", ".join(f"{key}: {type(value).__name__}" for key, value in params.items()) + "}"
+    return "(" + ", ".join(type(value).__name__ for value in params) + ")"
+
+class SqlProfiler:
+    """زمان‌سنجی همه دستورهای SQL به تفکیک fingerprint و ثبت کوئری‌های کند.
+
+    زمان هر دستور از execute تا پایان خواندن نتیجه (fetchall یا اجرای دستور بعدی روی همان
+    cursor یا آزاد شدن آن) است. دستورهای کندتر از threshold با شکل پارامترها (بدون مقدار) و
+    خروجی EXPLAIN QUERY PLAN در لاگ ثبت می‌شوند؛ plan هر fingerprint روی یک اتصال جدا و
+    حداکثر هر explain_ttl ثانیه یک‌بار گرفته می‌شود تا رشد جدول‌ها در آن دیده شود.
+    """
+
+    EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH")
+
+    def __init__(self, threshold: float, samples: int, explain_ttl: float, max_statements: int):
+        self.threshold = threshold
+        self.samples = samples
+        self.explain_ttl = explain_ttl
+        self.max_statements = max_statements
+        self._stats: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, sql: str, params, elapsed: float, many: int = 0):
+        # روی مسیر همه دستورها اجرا می‌شود؛ شکل پارامترها فقط برای دستور جدید یا کند ساخته می‌شود
+        fingerprint = sql_fingerprint(sql)
+        slow = elapsed >= self.threshold
+        with self._lock:
+            stats = self._stats.get(fingerprint)
+            if stats is None:
+                if len(self._stats) >= self.max_statements:
+                    fingerprint = "(other)"
+                stats = self._stats.get(fingerprint)
+            if stats is None:
+                stats = self._stats[fingerprint] = {
+                    "count": 0, "total": 0.0, "max": 0.0, "slow": 0, "params": None,
+                    "samples": deque(maxlen=self.samples), "plan": None, "plan_at": 0.0,
+                }
+            stats["count"] += 1
+            stats["total"] += elapsed
+            if elapsed > stats["max"]:
+                stats["max"] = elapsed
+            stats["samples"].append(elapsed)
+            if not slow and stats["params"] is not None:
+                return
+            shape = sql_params_shape(params)
+            stats["params"] = f"{many}× {shape}" if many else shape
+            if not slow:
+                return
+            stats["slow"] += 1
+            explain = time.monotonic() - stats["plan_at"] >= self.explain_ttl
+            if explain:
+                stats["plan_at"] = time.monotonic()
+        if explain:
+            stats["plan"] = self.explain(sql, params)
+        logger.warning(
+            f"کوئری کند {elapsed * 1000:.1f}ms: {fingerprint} | پارامترها {stats['params']}"
+            + (f"\n{stats['plan']}" if stats["plan"] else "")
+        )
+
+    def explain(self, sql: str, params) -> str:
+        if not sql.lstrip().upper().startswith(self.EXPLAINABLE):
+            return ""
+        try:
+            # اتصال جدا بدون زمان‌سنجی؛ با WAL منتظر نویسنده نمی‌ماند
+            conn = sqlite3.connect(DB_FILE, timeout=1)
+            try:
+                rows = conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            return f"(EXPLAIN failed: {e})"
+        depth = {0: -1}
+        lines = []
+        for node, parent, _, detail in rows:
+            depth[node] = depth.get(parent, -1) + 1
+            lines.append(f"{'  ' * depth[node]}{detail}")
+        return "\n".join(lines)
+
+    def top(self, limit: int) -> List[Tuple[str, Dict]]:
+        """بیشترین زمان کل؛ هر ردیف (fingerprint، آمار با p99)"""
+        with self._lock:
+            rows = [(fingerprint, dict(stats, samples=sorted(stats["samples"])))
+                    for fingerprint, stats in self._stats.items()]
+        rows.sort(key=lambda row: row[1]["total"], reverse=True)
+        for _, stats in rows[:limit]:
+            samples = stats.pop("samples")
+            stats["p99"] = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+        return rows[:limit]
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+sql_profiler = SqlProfiler(SLOW_SQL_THRESHOLD, SLOW_SQL_SAMPLES, SLOW_SQL_EXPLAIN_TTL, SLOW_SQL_MAX_STATEMENTS)
+
+class TimedCursor(sqlite3.Cursor):
+    """cursor با زمان‌سنجی؛ دستور در اجرای بعدی، fetchall، close یا آزاد شدن cursor ثبت می‌شود"""
+
+    _pending = None
+
+    def execute(self, sql, parameters=()):
+        if self._pending:
+            self._flush()
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._pending = [sql, parameters, time.perf_counter() - started, 0]
+
+    def executemany(self, sql, seq_of_parameters):
+        if self._pending:
+            self._flush()
+        # ردیف‌ها بافر نمی‌شوند؛ هنگام عبور شمرده و شکل ردیف اول نگه داشته می‌شود
+        seen = [(), 0]
+
+        def counted():
+            for row in seq_of_parameters:
+                if not seen[1]:
+                    seen[0] = row
+                seen[1] += 1
+                yield row
+
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, counted())
+        finally:
+            self._pending = [sql, seen[0], time.perf_counter() - started, seen[1]]
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._add(time.perf_counter() - started)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._add(time.perf_counter() - started)
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._add(time.perf_counter() - started)
+        self._flush()
+        return rows
+
+    def close(self):
+        self._flush()
+        super().close()
+
+    def __del__(self):
+        self._flush()
+
+    def _add(self, elapsed: float):
+        if self._pending:
+            self._pending[2] += elapsed
+
+    def _flush(self):
+        if self._pending:
+            sql, params, elapsed, many = self._pending
+            self._pending = None
+            sql_profiler.observe(sql, params, elapsed, many)
+
+class TimedConnection(sqlite3.Connection):
+    """اتصال با TimedCursor؛ میان‌برهای execute اتصال هم از همان cursor می‌گذرند"""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+def connect_db(read_only: bool = False, **kwargs) -> sqlite3.Connection:
+    """اتصال به دیتابیس ربات با زمان‌سنجی همه دستورها (مگر SLOW_SQL_MS=0)؛
+    read_only برای خواندن‌های طولانی که نباید هیچ‌وقت قفل نوشتن بگیرند"""
+    database = DB_FILE
+    if read_only:
+        database = f"file:{urllib.parse.quote(os.path.abspath(DB_FILE))}?mode=ro"
+        kwargs["uri"] = True
+    if sql_profiler.threshold <= 0:
+        return sqlite3.connect(database, **kwargs)
+    return sqlite3.connect(database, factory=TimedConnection, **kwargs)
+
+# ----- نویسنده دیتابیس -----
+class RollbackWrite(Exception):
+    """برگرداندن تغییرات یک درخواست نوشتن بدون خطا؛ result به فراخواننده برگردانده می‌شود"""
+
+    def __init__(self, result=None):
+        super().__init__()
+        self.result = result
+
+class DbWriter:
+    """ترد تنها نویسنده دیتابیس با group commit.
+
+    هر درخواست نوشتن تابعی است که cursor را به عنوان آرگومان اول می‌گیرد. درخواست‌هایی که
+    در فاصله GROUP_COMMIT_WINDOW می‌رسند، هر کدام داخل یک SAVEPOINT و همه با یک commit
+    اعمال می‌شوند؛ خطای یک درخواست فقط تغییرات همان درخواست را برمی‌گرداند.
+    درخواست‌ها به ترتیب ورود به صف اعمال می‌شوند. خواندن‌ها با اتصال‌های جداگانه (WAL) موازی می‌مانند.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.batches = 0
+        self.writes = 0
+        self.max_batch = 0
+        self.commit_time_total = 0.0
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                    self._thread.start()
+
+    def submit(self, func, *args) -> Future:
+        """ثبت درخواست نوشتن؛ خروجی Future با نتیجه همان درخواست پس از commit"""
+        self._ensure_started()
+        future = Future()
+        self._queue.put((future, func, args))
+        return future
+
+    def call(self, func, *args):
+        """نوشتن از کد همگام (ترد فراخواننده تا commit منتظر می‌ماند).
+
+        فقط برای تردهای خارج از حلقه رویداد؛ داخل حلقه باید از run استفاده شود تا
+        حلقه پشت صف نوشتن متوقف نشود.
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return self.submit(func, *args).result()
+        raise RuntimeError("db_writer.call داخل حلقه رویداد فراخوانی شد؛ از await db_writer.run استفاده کنید")
+
+    async def run(self, func, *args):
+        """نوشتن از داخل حلقه رویداد"""
+        with tracer.span(f"db_write:{metric_name(func)}"):
+            return await asyncio.wrap_future(self.submit(func, *args))
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def _run(self):
+        conn = connect_db(timeout=30, isolation_level=None, check_same_thread=False)
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + GROUP_COMMIT_WINDOW
+            while len(batch) < GROUP_COMMIT_MAX:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._apply(conn, batch)
+
+    def _apply(self, conn, batch):
+        c = conn.cursor()
+        outcomes = []
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            for future, func, args in batch:
+                c.execute("SAVEPOINT write")
+                started = time.perf_counter()
+                try:
+                    outcomes.append((future, func(c, *args), None))
+                    c.execute("RELEASE write")
+                except RollbackWrite as e:
+                    c.execute("ROLLBACK TO write")
+                    c.execute("RELEASE write")
+                    outcomes.append((future, e.result, None))
+                except Exception as e:
+                    c.execute("ROLLBACK TO write")
+                    c.execute("RELEASE write")
+                    outcomes.append((future, None, e))
+                finally:
+                    metrics.observe("db_seconds", time.perf_counter() - started, query=f"write:{metric_name(func)}")
+            start = time.perf_counter()
+            c.execute("COMMIT")
+            commit_time = time.perf_counter() - start
+            self.commit_time_total += commit_time
+            metrics.observe("db_seconds", commit_time, query="commit")
+        except Exception as e:
+            logger.error(f"خطا در ثبت گروهی تراکنش ({len(batch)} درخواست): {e}")
+            if conn.in_transaction:
+                conn.rollback()
+            outcomes = [(future, None, e) for future, _, _ in batch]
+        
+        self.batches += 1
+        self.writes += len(batch)
+        self.max_batch = max(self.max_batch, len(batch))
+        for future, result, error in outcomes:
+            try:
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+            except InvalidStateError:
+                pass    # فراخواننده منصرف شده است
+
+db_writer = DbWriter()
+metrics.gauge("db_writer_pending", lambda: db_writer.pending())
+
+async def write_for_event(event_id: int, func, *args):
+    """نوشتن مربوط به صندلی‌های یک اجرا.
+
+    نویسنده درخواست‌ها را به ترتیب صف اعمال می‌کند، پس ترتیب تغییرات هر اجرا حفظ می‌شود و
+    چند تغییر یک اجرا در یک commit جا می‌گیرند. انتظار هر اجرا در seat_writes ثبت می‌شود.
+    """
+    with tracer.span(f"db_write:{metric_name(func)}", event=event_id), seat_writes.track(event_id):
+        return await asyncio.wrap_future(db_writer.submit(func, *args))
+
+# ----- محافظ ارسال پشت سر هم -----
+class FloodGuard:
+    """محدودیت نرخ درخواست هر کاربر (token bucket به تفکیک نوع کار) و حذف کلیک‌های تکراری.
+
+    قبل از همه هندلرها و فقط با داده‌های حافظه اجرا می‌شود؛ درخواست رد شده هیچ
+    خواندن دیتابیس یا رندری ایجاد نمی‌کند.
+    """
+
+    CALLBACK_CLASSES = (
+        (("seat|", "confirm|", "cancel|"), "reserve"),
+        (("admin_", "support_", "refresh_users", "show_users_list", "users_stats", "refresh_users_stats",
+          "export|"), "admin"),
+    )
+
+    def __init__(self, limits: Dict[str, Tuple[float, float]], debounce: float, idle_ttl: float):
+        self.limits = limits
+        self.debounce = debounce
+        self.idle_ttl = idle_ttl
+        self._buckets: Dict[Tuple[int, str], List[float]] = {}
+        self._last_callback: Dict[int, Tuple[str, float]] = {}
+        self._next_prune = time.monotonic() + idle_ttl
+        self.dropped = Counter()
+
+    def classify(self, update: Update):
+        """خروجی: (کاربر، نوع کار، داده کال‌بک) یا None برای آپدیت‌هایی که محدود نمی‌شوند"""
+        if update.callback_query:
+            data = update.callback_query.data or ""
+            for prefixes, action in self.CALLBACK_CLASSES:
+                if data.startswith(prefixes):
+                    return update.callback_query.from_user.id, action, data
+            return update.callback_query.from_user.id, "browse", data
+        
+        message = update.message
+        if message and message.from_user:
+            action = "upload" if message.photo else "message"
+            return message.from_user.id, action, None
+        return None
+
+    def check(self, user_id: int, action: str, data: str = None) -> str:
+        """خروجی: None اگر مجاز باشد، وگرنه دلیل رد (debounce / rate)"""
+        now = time.monotonic()
+        if now >= self._next_prune:
+            self._prune(now)
+        
+        if data is not None:
+            last = self._last_callback.get(user_id)
+            if last and last[0] == data and now - last[1] < self.debounce:
+                self.dropped["debounce"] += 1
+                return "debounce"
+            self._last_callback[user_id] = (data, now)
+        
+        rate, burst = self.limits[action]
+        bucket = self._buckets.get((user_id, action))
+        if bucket is None:
+            bucket = self._buckets[(user_id, action)] = [burst, now]
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        
+        if bucket[0] < 1:
+            self.dropped[action] += 1
+            return "rate"
+        bucket[0] -= 1
+        return None
+
+    def _prune(self, now: float):
+        self._next_prune = now + self.idle_ttl
+        cutoff = now - self.idle_ttl
+        self._buckets = {key: bucket for key, bucket in self._buckets.items() if bucket[1] >= cutoff}
+        self._last_callback = {user_id: last for user_id, last in self._last_callback.items() if last[1] >= cutoff}
+
+    def tracked_users(self) -> int:
+        return len(set(self._last_callback) | {user_id for user_id, _ in self._buckets})
+
+flood_guard = FloodGuard(FLOOD_LIMITS, CALLBACK_DEBOUNCE, FLOOD_IDLE_TTL)
+
+async def flood_guard_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """اجرا در گروه -1 قبل از همه هندلرها؛ درخواست‌های اضافه همین‌جا متوقف می‌شوند"""
+    classified = flood_guard.classify(update)
+    if classified is None:
+        return
+    user_id, action, data = classified
+    if user_id == config.ADMIN_CHAT_ID:
+        return
+    
+    reason = flood_guard.check(user_id, action, data)
+    if reason is None:
+        return
+    
+    if update.callback_query:
+        # بستن حالت انتظار دکمه؛ برای کلیک تکراری پیامی لازم نیست
+        text = "⏳ لطفاً کمی آهسته‌تر، چند لحظه دیگر دوباره تلاش کنید." if reason == "rate" else None
+        try:
+            await update.callback_query.answer(text)
+        except TelegramError:
+            pass
+    raise ApplicationHandlerStop
+
+# ----- ضبط آپدیت‌ها برای بازپخش -----
+class UpdateRecorder:
+    """ضبط آپدیت‌های ورودی در فایل gzip (JSONL، فقط افزودنی) برای بازپخش در benchmarks/replay.py.
+
+    شناسه کاربران با HMAC توکن ربات به شناسه ساختگی ثابت تبدیل می‌شود، نام، یوزرنیم و شماره
+    تلفن از همه بخش‌ها (از جمله contact) حذف و متن آزاد (پیام پشتیبانی، کپشن) با x هم‌طول
+    جایگزین می‌شود؛ فقط دستورات، متن دکمه‌های منو و اعداد باقی می‌مانند. متن تماماً عددی بسته به
+    وضعیت فرستنده رفتار می‌شود: در انتظار شناسه (افزودن/حذف ادمین) به شناسه ساختگی تبدیل، در
+    پیام آزاد (پشتیبانی، پاسخ ادمین) با x جایگزین و در بقیه (مثل قیمت) دست‌نخورده می‌ماند.
+    فشرده‌سازی و نوشتن در ترد جداگانه انجام می‌شود.
+    """
+
+    PERSON_KEYS = ("from", "chat", "user", "forward_from", "sender_chat", "new_chat_member", "left_chat_member")
+    NAME_FIELDS = ("username", "first_name", "last_name", "title", "phone_number", "vcard")
+    TEXT_FIELDS = ("text", "caption")
+    ID_TOKEN = re.compile(r"\d{6,}")   # شناسه کاربر داخل داده کال‌بک (مثل support_reply|<user_id>)
+    ID_STATES = ("admin_add_wait", "admin_remove_wait")
+    FREE_TEXT_STATES = ("support_wait", "admin_reply_wait")
+
+    def __init__(self, path: str, secret: str, safe_texts):
+        self.path = path
+        self._key = secret.encode()
+        self._safe_texts = set(safe_texts)
+        self._queue = queue.Queue()
+        self._thread = None
+        self.recorded = 0
+
+    def pseudonym(self, user_id: int) -> int:
+        digest = hmac.new(self._key, str(user_id).encode(), hashlib.sha256).digest()
+        return 10 ** 9 + int.from_bytes(digest[:6], "big") % (9 * 10 ** 9)
+
+    def record(self, update: Update, numbers: str = "keep"):
+        """از حلقه رویداد؛ فقط کپی داده و قرار دادن در صف
+
+        numbers رفتار با متن تماماً عددی است: "id" (شناسه ساختگی)، "mask" (x) یا "keep"
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="update-recorder", daemon=True)
+            self._thread.start()
+        self._queue.put((time.time(), update.to_dict(), numbers))
+        self.recorded += 1
+
+    @classmethod
+    def numbers_for_state(cls, state_type) -> str:
+        if state_type in cls.ID_STATES:
+            return "id"
+        if state_type in cls.FREE_TEXT_STATES:
+            return "mask"
+        return "keep"
+
+    def _scrub(self, value, key=None, numbers="keep"):
+        if isinstance(value, dict):
+            if key in self.PERSON_KEYS and isinstance(value.get("id"), int):
+                value = {k: v for k, v in value.items() if k not in self.NAME_FIELDS}
+                value["id"] = self.pseudonym(value["id"])
+                if value.get("type", "private") == "private":
+                    value["first_name"] = f"u{value['id']}"   # برای کاربر و چت خصوصی الزامی است
+                return value
+            scrubbed = {k: self._scrub(v, k, numbers) for k, v in value.items() if k not in self.NAME_FIELDS}
+            if key == "contact":
+                # فیلدهای الزامی Contact تا آپدیت در بازپخش قابل خواندن بماند
+                scrubbed["phone_number"] = "0" * len(value.get("phone_number", ""))
+                scrubbed["first_name"] = "contact"
+            return scrubbed
+        if isinstance(value, list):
+            return [self._scrub(item, key, numbers) for item in value]
+        if key in self.TEXT_FIELDS and isinstance(value, str):
+            if value.startswith("/") or value in self._safe_texts:
+                return value
+            if value.strip().isdigit() and numbers == "id":
+                return self._pseudonymize_ids(value)
+            if value.strip().isdigit() and numbers == "keep":
+                return value
+            return "x" * len(value)
+        if key == "data" and isinstance(value, str):
+            return self._pseudonymize_ids(value)
+        if key == "user_id" and isinstance(value, int):
+            return self.pseudonym(value)
+        return value
+
+    def _pseudonymize_ids(self, text: str) -> str:
+        return self.ID_TOKEN.sub(lambda m: str(self.pseudonym(int(m.group()))), text)
+
+    def _run(self):
+        with gzip.open(self.path, "at", encoding="utf-8") as f:
+            f.write(json.dumps({"type": "header", "started_at": time.time(),
+                                "admin": self.pseudonym(config.ADMIN_CHAT_ID)}) + "\n")
+            while True:
+                batch = [self._queue.get()]
+                while len(batch) < 500:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                for received_at, payload, numbers in batch:
+                    f.write(json.dumps({"t": received_at, "update": self._scrub(payload, numbers=numbers)},
+                                       ensure_ascii=False) + "\n")
+                # هر دسته قابل خواندن است حتی اگر برنامه بدون بستن فایل متوقف شود
+                f.flush()
+                f.buffer.flush(zlib.Z_SYNC_FLUSH)
+
+update_recorder = (
+    UpdateRecorder(UPDATE_RECORD_FILE, config.BOT_TOKEN, MAIN_MENU_BUTTONS + ADMIN_MENU_BUTTONS + ("❌ لغو",))
+    if UPDATE_RECORD_FILE else None
+)
+
+async def record_update_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """اجرا در گروه -2، قبل از محافظ ارسال پشت سر هم، تا ترافیک رد شده هم ضبط شود"""
+    message = update.message
+    if not (message and message.from_user and message.text and message.text.strip().isdigit()):
+        update_recorder.record(update)
+        return
+    # وضعیت فرستنده فقط برای متن عددی خوانده می‌شود (قیمت دست‌نخورده، شناسه ادمین ساختگی)
+    user_id = message.from_user.id
+    if user_id in admin_add_wait or user_id in admin_remove_wait:
+        numbers = "id"
+    else:
+        state_type, _ = await run_in_thread(get_user_state, user_id)
+        numbers = UpdateRecorder.numbers_for_state(state_type)
+    update_recorder.record(update, numbers)
 
 # ----- وضعیت‌های مختلف -----
 admin_price_wait = {}
@@ -58,12 +1720,15 @@ admin_add_wait = {}
 admin_remove_wait = {}
 support_wait = {}
 admin_reply_wait = {}
+admin_event_wait = {}
 support_pagination = {}
 
 # ----- دیتابیس -----
 def init_db():
-    conn = sqlite3.connect(DB_FILE)
+    conn = connect_db()
     c = conn.cursor()
+    # WAL: خواندن‌ها هم‌زمان با نویسنده انجام می‌شوند و منتظر قفل نوشتن نمی‌مانند
+    c.execute('PRAGMA journal_mode=WAL')
     
     # جدول وضعیت کاربران
     c.execute('''
@@ -149,79 +1814,508 @@ def init_db():
         )
     ''')
     
+    # جدول صف کارهای پس‌زمینه (مثل ارسال بلیت)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_key TEXT UNIQUE,
+            kind TEXT,
+            payload TEXT,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            run_at INTEGER,
+            locked_until INTEGER,
+            last_error TEXT,
+            created_at INTEGER,
+            updated_at INTEGER
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status_run_at ON jobs (status, run_at)')
+    
+    # جدول بررسی رسیدهای پرداخت (سفارش‌ها)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS payment_reviews (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event_id INTEGER,
+            seat_id TEXT,
+            user_id INTEGER,
+            status TEXT DEFAULT 'pending',
+            receipt_file_id TEXT,
+            decided_by INTEGER,
+            decided_at INTEGER,
+            created_at INTEGER
+        )
+    ''')
+    c.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_reviews_pending_seat
+        ON payment_reviews (event_id, seat_id) WHERE status='pending'
+    ''')
+    
+    # پیام‌های رسید ارسال شده برای هر ادمین
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS review_messages (
+            review_id INTEGER,
+            chat_id INTEGER,
+            message_id INTEGER,
+            PRIMARY KEY (review_id, chat_id)
+        )
+    ''')
+    
     conn.commit()
     
     # اضافه کردن ادمین اصلی
     c.execute('INSERT OR IGNORE INTO admins (user_id, added_by, added_at, username) VALUES (?, ?, ?, ?)',
               (config.ADMIN_CHAT_ID, config.ADMIN_CHAT_ID, int(time.time()), 'admin'))
     
-    # اضافه کردن رویدادها به جدول events
-    for ev in config.EVENTS:
-        c.execute('SELECT COUNT(*) FROM events WHERE id=?', (ev["id"],))
-        if c.fetchone()[0] == 0:
+    # ستون‌های چیدمان برای دیتابیس‌های قدیمی
+    _ensure_column(c, "events", "rows_count", "INTEGER")
+    _ensure_column(c, "events", "cols_count", "INTEGER")
+    _ensure_column(c, "events", "prices_json", "TEXT")
+    _ensure_column(c, "events", "layout_hash", "TEXT")
+    _ensure_column(c, "events", "source", "TEXT DEFAULT 'config'")
+    _ensure_column(c, "events", "on_sale_at", "INTEGER")
+    _ensure_column(c, "seats", "reminded_at", "INTEGER")
+    
+    # وضعیت صف انتظار فقط برای بازیابی پس از ری‌استارت ذخیره می‌شود
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS waiting_room (
+            event_id INTEGER,
+            user_id INTEGER,
+            state TEXT,
+            ticket INTEGER,
+            deadline INTEGER,
+            PRIMARY KEY (event_id, user_id)
+        )
+    ''')
+    
+    # همگام‌سازی رویدادها و صندلی‌ها با config.EVENTS
+    provision_events(c, config.EVENTS)
+    
+    conn.commit()
+    conn.close()
+    logger.info("دیتابیس با موفقیت ایجاد/بارگذاری شد")
+
+# ----- ساخت صندلی‌ها -----
+def _ensure_column(c, table: str, column: str, decl: str):
+    """افزودن ستون به جدول در صورت نبودن (مهاجرت دیتابیس‌های قدیمی)"""
+    c.execute(f'PRAGMA table_info({table})')
+    if column not in [row[1] for row in c.fetchall()]:
+        c.execute(f'ALTER TABLE {table} ADD COLUMN {column} {decl}')
+
+def _row_price(prices: Dict, row: int) -> int:
+    """قیمت یک ردیف؛ کلیدها ممکن است عدد یا رشته (JSON) باشند"""
+    return prices.get(row, prices.get(str(row), DEFAULT_SEAT_PRICE))
+
+def _on_sale_timestamp(value):
+    """زمان شروع فروش: timestamp یا متن «YYYY-MM-DD HH:MM» (میلادی، وقت محلی سرور)"""
+    if value in (None, ""):
+        return None
+    if isinstance(value, int):
+        return value
+    try:
+        return int(datetime.strptime(str(value).strip(), "%Y-%m-%d %H:%M").timestamp())
+    except ValueError:
+        raise ValueError("فیلد on_sale باید به شکل \"2024-05-01 18:00\" باشد.")
+
+def _event_layout_hash(ev) -> str:
+    """هش تعریف رویداد؛ در صورت تغییر نکردن، ساخت صندلی‌ها رد می‌شود"""
+    definition = {
+        "title": ev["title"],
+        "description": ev.get("description"),
+        "date": ev.get("date"),
+        "type": ev.get("type"),
+        "poster": ev.get("poster"),
+        "rows": ev["rows"],
+        "cols": ev["cols"],
+        "prices": {str(k): v for k, v in ev.get("prices", {}).items()},
+    }
+    if ev.get("on_sale"):
+        definition["on_sale"] = _on_sale_timestamp(ev["on_sale"])
+    return hashlib.sha1(json.dumps(definition, sort_keys=True).encode("utf-8")).hexdigest()
+
+def _iter_new_seat_rows(ev, old_rows: int = 0, old_cols: int = 0):
+    """تولید جریانی ردیف‌های صندلی که در چیدمان قبلی وجود نداشتند"""
+    prices = ev.get("prices", {})
+    for r in range(1, ev["rows"] + 1):
+        price = _row_price(prices, r)
+        for co in range(1, ev["cols"] + 1):
+            if r <= old_rows and co <= old_cols:
+                continue
+            yield (ev["id"], f"R{r}C{co}", r, co, price)
+
+def provision_events(c, events, source: str = "config") -> Dict[int, str]:
+    """همگام‌سازی جداول events و seats با تعریف رویدادها در یک تراکنش
+
+    رویدادهایی که هش تعریفشان تغییر نکرده رد می‌شوند؛ برای بقیه تغییرات
+    ابعاد و قیمت ردیف‌ها به صورت diff اعمال می‌شود. رویدادی که از داخل ربات
+    ویرایش شده (source='admin') دیگر از config بازنویسی نمی‌شود. خروجی: وضعیت
+    هر رویداد (created / updated / unchanged / overridden).
+    """
+    c.execute('SELECT id, layout_hash, rows_count, cols_count, prices_json, source FROM events')
+    existing = {row[0]: row[1:] for row in c.fetchall()}
+    now = int(time.time())
+    result = {}
+    
+    for ev in events:
+        event_id = ev["id"]
+        layout_hash = _event_layout_hash(ev)
+        old = existing.get(event_id)
+        
+        if old and old[0] == layout_hash:
+            result[event_id] = "unchanged"
+            continue
+        
+        if old and source == "config" and old[4] == "admin":
+            result[event_id] = "overridden"
+            continue
+        
+        c.execute('''
+            INSERT INTO events (id, title, description, event_date, event_type, poster_path, created_at,
+                                rows_count, cols_count, prices_json, layout_hash, source, on_sale_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                title=excluded.title, description=excluded.description,
+                event_date=excluded.event_date, event_type=excluded.event_type,
+                poster_path=excluded.poster_path, rows_count=excluded.rows_count,
+                cols_count=excluded.cols_count, prices_json=excluded.prices_json,
+                layout_hash=excluded.layout_hash, source=excluded.source,
+                on_sale_at=excluded.on_sale_at
+        ''', (
+            event_id,
+            ev["title"],
+            ev.get("description", "توضیحاتی برای این اجرا موجود نیست."),
+            ev.get("date", "تعیین نشده"),
+            ev.get("type", "عمومی"),
+            ev.get("poster", ""),
+            now,
+            ev["rows"],
+            ev["cols"],
+            json.dumps({str(k): v for k, v in ev.get("prices", {}).items()}),
+            layout_hash,
+            source,
+            _on_sale_timestamp(ev.get("on_sale"))
+        ))
+        
+        if old is None or old[1] is None:
+            # رویداد جدید یا دیتابیس قدیمی بدون چیدمان ذخیره شده
+            c.execute('SELECT MAX(row), MAX(col) FROM seats WHERE event_id=?', (event_id,))
+            old_rows, old_cols = c.fetchone()
+            old_rows, old_cols, old_prices = old_rows or 0, old_cols or 0, None
+        else:
+            old_rows, old_cols, old_prices = old[1], old[2], json.loads(old[3] or "{}")
+        
+        c.executemany('''
+            INSERT OR IGNORE INTO seats (event_id, seat_id, row, col, status, reserved_by, reserved_at, price)
+            VALUES (?, ?, ?, ?, 'free', NULL, NULL, ?)
+        ''', _iter_new_seat_rows(ev, old_rows, old_cols))
+        
+        if ev["rows"] < old_rows or ev["cols"] < old_cols:
             c.execute('''
-                INSERT INTO events (id, title, description, event_date, event_type, poster_path, created_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
+                DELETE FROM seats WHERE event_id=? AND (row>? OR col>?) AND status='free'
+            ''', (event_id, ev["rows"], ev["cols"]))
+            c.execute('''
+                SELECT COUNT(*) FROM seats WHERE event_id=? AND (row>? OR col>?)
+            ''', (event_id, ev["rows"], ev["cols"]))
+            kept = c.fetchone()[0]
+            if kept:
+                logger.warning(f"رویداد {event_id}: {kept} صندلی رزرو/فروخته شده خارج از چیدمان جدید باقی ماند")
+        
+        # قیمت فقط برای ردیف‌هایی که قیمتشان در تعریف عوض شده و صندلی‌های آزاد تغییر می‌کند
+        if old_prices is not None:
+            new_prices = ev.get("prices", {})
+            c.executemany('''
+                UPDATE seats SET price=? WHERE event_id=? AND row=? AND status='free'
             ''', (
-                ev["id"],
-                ev["title"],
-                ev.get("description", "توضیحاتی برای این اجرا موجود نیست."),
-                ev.get("date", "تعیین نشده"),
-                ev.get("type", "عمومی"),
-                ev.get("poster", ""),
-                int(time.time())
+                (_row_price(new_prices, r), event_id, r)
+                for r in range(1, min(old_rows, ev["rows"]) + 1)
+                if _row_price(new_prices, r) != _row_price(old_prices, r)
             ))
+        
+        result[event_id] = "created" if old is None else "updated"
     
-    # ایجاد صندلی‌ها
-    for ev in config.EVENTS:
-        event_id = ev["id"]
-        rows = ev["rows"]
-        cols = ev["cols"]
-        c.execute('SELECT COUNT(*) FROM seats WHERE event_id=?', (event_id,))
-        cnt = c.fetchone()[0]
-        if cnt == 0:
-            for r in range(1, rows+1):
-                for co in range(1, cols+1):
-                    seat_id = f"R{r}C{co}"
-                    price = ev.get("prices", {}).get(r, 100000)
-                    c.execute('''
-                        INSERT OR IGNORE INTO seats (event_id, seat_id, row, col, status, reserved_by, reserved_at, price)
-                        VALUES (?, ?, ?, ?, 'free', NULL, NULL, ?)
-                    ''', (event_id, seat_id, r, co, price))
+    return result
+
+# ----- کاتالوگ اجراها -----
+class EventCatalog:
+    """کاتالوگ اجراها؛ جدول events منبع اصلی است و یک نسخه id→اجرا در حافظه نگه داشته می‌شود.
+
+    متن و کیبورد لیست اجراها یک‌بار ساخته و تا تغییر بعدی کاتالوگ کش می‌شوند.
+    """
+
+    def __init__(self):
+        self._events: Dict[int, Dict] = {}
+        self._rendered: Dict[str, Tuple[int, str, InlineKeyboardMarkup]] = {}
+        self.version = 0
+
+    def load(self):
+        """بارگذاری مجدد اجراها از دیتابیس"""
+        conn = connect_db()
+        c = conn.cursor()
+        c.execute('''
+            SELECT id, title, description, event_date, event_type, poster_path,
+                   rows_count, cols_count, prices_json, on_sale_at
+            FROM events
+            WHERE rows_count IS NOT NULL
+            ORDER BY id
+        ''')
+        events = {}
+        for (event_id, title, description, date, event_type, poster,
+             rows, cols, prices_json, on_sale_at) in c.fetchall():
+            events[event_id] = {
+                "id": event_id,
+                "title": title,
+                "description": description,
+                "date": date,
+                "type": event_type,
+                "poster": poster,
+                "rows": rows,
+                "cols": cols,
+                "prices": {int(k): v for k, v in json.loads(prices_json or "{}").items()},
+                "on_sale": on_sale_at,
+            }
+        conn.close()
+        self._events = events
+        self.invalidate()
+
+    def invalidate(self):
+        """پاک کردن کش متن‌ها و کیبوردهای ساخته شده"""
+        self.version += 1
+        self._rendered = {}
+
+    def get(self, event_id):
+        return self._events.get(event_id)
+
+    def all(self) -> List[Dict]:
+        return list(self._events.values())
+
+    def save(self, ev):
+        """افزودن یا ویرایش اجرا در زمان اجرا (بدون نیاز به ری‌استارت)"""
+        status = db_writer.call(lambda c: provision_events(c, [ev], source="admin")[ev["id"]])
+        availability.load(ev["id"])
+        self.load()
+        return status
+
+    def render(self, kind: str) -> Tuple[str, InlineKeyboardMarkup]:
+        """متن و کیبورد کش شده لیست اجراها (kind: events / stats / price)
+
+        لیست events ظرفیت لحظه‌ای را نشان می‌دهد و فقط وقتی دوباره ساخته می‌شود که
+        اعداد نمایش داده شده (آزاد، فروخته، ارزان‌ترین قیمت) در یکی از اجراها تغییر کند.
+        """
+        version = self._shown_counts() if kind == "events" else 0
+        cached = self._rendered.get(kind)
+        metrics.cache(f"event_list_{kind}", cached is not None and cached[0] == version)
+        if cached is None or cached[0] != version:
+            cached = self._rendered[kind] = (version, *self._render(kind))
+        return cached[1], cached[2]
+
+    def _shown_counts(self) -> Tuple:
+        """کلید کش لیست events: همان مقادیری از خلاصه ظرفیت که در لیست دیده می‌شوند"""
+        shown = []
+        for event_id in self._events:
+            summary = availability.get(event_id)
+            shown.append((event_id, summary['free'], summary['sold'], summary['min_price']))
+        return tuple(shown)
+
+    def _render(self, kind: str) -> Tuple[str, InlineKeyboardMarkup]:
+        events = self.all()
+        
+        if kind == "stats":
+            lines = ["📊 **انتخاب اجرا برای مشاهده آمار صندلی‌ها**\n\n"]
+        else:
+            lines = ["🎭 **لیست اجراهای موجود:**\n\n"]
+        
+        for i, event in enumerate(events, 1):
+            lines.append(f"{i}. **{event['title']}**\n")
+            lines.append(f"   📅 {event.get('date') or 'تعیین نشده'}\n")
+            if kind == "events":
+                lines.append(f"   🏷 {event.get('type') or 'عمومی'}\n")
+            lines.append(f"   💺 {event['rows']} ردیف × {event['cols']} صندلی\n")
+            if kind == "events":
+                summary = availability.get(event['id'])
+                if summary['free'] == 0:
+                    lines.append("   ❌ ظرفیت تکمیل شد\n")
+                else:
+                    lines.append(f"   🟢 {summary['free']} آزاد | 🔴 {summary['sold']} فروخته شده\n")
+                    lines.append(f"   💰 از {summary['min_price']:,} تومان\n")
+            lines.append("\n")
+        
+        button_formats = {
+            "events": ("🎭 {}", "event|{}"),
+            "stats": ("📊 {}", "stats|{}"),
+            "price": ("💰 {}", "admin_price_event|{}"),
+        }
+        label_format, data_format = button_formats[kind]
+        keyboard = [
+            [InlineKeyboardButton(label_format.format(event['title']), callback_data=data_format.format(event['id']))]
+            for event in events
+        ]
+        
+        return "".join(lines), InlineKeyboardMarkup(keyboard)
+
+event_catalog = EventCatalog()
+
+def parse_event_definition(text: str) -> Dict:
+    """اعتبارسنجی تعریف اجرا که ادمین به صورت JSON ارسال کرده"""
+    try:
+        ev = json.loads(text)
+    except ValueError:
+        raise ValueError("متن ارسالی JSON معتبر نیست.")
     
-    conn.commit()
-    conn.close()
-    print("✅ دیتابیس با موفقیت ایجاد/بارگذاری شد")
+    if not isinstance(ev, dict) or not isinstance(ev.get("id"), int):
+        raise ValueError("فیلد id (عدد) الزامی است.")
+    
+    # ویرایش اجرای موجود: فیلدهای ارسال نشده از تعریف فعلی برداشته می‌شوند
+    current = event_catalog.get(ev["id"])
+    if current:
+        ev = {**current, **ev}
+    
+    if not isinstance(ev.get("title"), str) or not ev["title"].strip():
+        raise ValueError("فیلد title الزامی است.")
+    for field in ("rows", "cols"):
+        if not isinstance(ev.get(field), int) or ev[field] <= 0:
+            raise ValueError(f"فیلد {field} باید عدد مثبت باشد.")
+    if ev["rows"] * ev["cols"] > MAX_EVENT_SEATS:
+        raise ValueError(f"حداکثر تعداد صندلی هر اجرا {MAX_EVENT_SEATS} است.")
+    
+    try:
+        ev["prices"] = {int(k): int(v) for k, v in (ev.get("prices") or {}).items()}
+    except (TypeError, ValueError, AttributeError):
+        raise ValueError("فیلد prices باید به شکل {\"1\": 150000} باشد.")
+    
+    ev["on_sale"] = _on_sale_timestamp(ev.get("on_sale"))
+    return ev
+
+# ----- خلاصه لحظه‌ای ظرفیت -----
+class AvailabilityTracker:
+    """شمارش لحظه‌ای صندلی‌های آزاد/رزرو/فروخته و ارزان‌ترین قیمت آزاد هر اجرا در حافظه.
+
+    یک‌بار در شروع از دیتابیس خوانده می‌شود و سپس با هر تغییر وضعیت صندلی
+    به‌روز می‌شود تا لیست اجراها بدون کوئری روی seats ساخته شود.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._status_counts: Dict[int, Counter] = {}
+        self._free_prices: Dict[int, Counter] = {}
+        self._listeners = []
+        self._event_versions: Counter = Counter()
+
+    def add_listener(self, callback):
+        """ثبت تابعی که پس از هر تغییر با شناسه اجرا صدا زده می‌شود (از هر تردی)"""
+        self._listeners.append(callback)
+
+    def _notify(self, event_id: int):
+        for callback in self._listeners:
+            try:
+                callback(event_id)
+            except Exception as e:
+                logger.error(f"خطا در اطلاع‌رسانی تغییر ظرفیت اجرای {event_id}: {e}")
+
+    def load(self, event_id: int = None):
+        """بارگذاری خلاصه از دیتابیس (همه اجراها یا فقط یک اجرا)"""
+        conn = connect_db()
+        c = conn.cursor()
+        if event_id is None:
+            c.execute('SELECT event_id, status, price, COUNT(*) FROM seats GROUP BY event_id, status, price')
+        else:
+            c.execute('''
+                SELECT event_id, status, price, COUNT(*) FROM seats WHERE event_id=? GROUP BY event_id, status, price
+            ''', (event_id,))
+        rows = c.fetchall()
+        conn.close()
+        
+        status_counts: Dict[int, Counter] = {}
+        free_prices: Dict[int, Counter] = {}
+        if event_id is not None:
+            status_counts[event_id] = Counter()
+            free_prices[event_id] = Counter()
+        for ev_id, status, price, count in rows:
+            status_counts.setdefault(ev_id, Counter())[status] += count
+            if status == 'free':
+                free_prices.setdefault(ev_id, Counter())[price] += count
+        
+        with self._lock:
+            if event_id is None:
+                self._status_counts = status_counts
+                self._free_prices = free_prices
+            else:
+                self._status_counts.update(status_counts)
+                self._free_prices.update(free_prices)
+            for ev_id in status_counts:
+                self._event_versions[ev_id] += 1
+        
+        for ev_id in status_counts:
+            self._notify(ev_id)
+
+    def transition(self, event_id: int, old_status: str, new_status: str, price: int):
+        """ثبت تغییر وضعیت یک صندلی"""
+        if old_status == new_status:
+            return
+        with self._lock:
+            counts = self._status_counts.setdefault(event_id, Counter())
+            prices = self._free_prices.setdefault(event_id, Counter())
+            counts[old_status] -= 1
+            counts[new_status] += 1
+            if old_status == 'free':
+                prices[price] -= 1
+                if prices[price] <= 0:
+                    del prices[price]
+            if new_status == 'free':
+                prices[price] += 1
+            self._event_versions[event_id] += 1
+        self._notify(event_id)
+
+    def reprice(self, event_id: int, old_price: int, new_price: int):
+        """ثبت تغییر قیمت یک صندلی آزاد"""
+        if old_price == new_price:
+            return
+        with self._lock:
+            prices = self._free_prices.setdefault(event_id, Counter())
+            prices[old_price] -= 1
+            if prices[old_price] <= 0:
+                del prices[old_price]
+            prices[new_price] += 1
+            self._event_versions[event_id] += 1
+        self._notify(event_id)
+
+    def event_version(self, event_id: int) -> int:
+        """شماره نسخه صندلی‌های یک اجرا؛ فقط با تغییر صندلی‌های همان اجرا زیاد می‌شود"""
+        with self._lock:
+            return self._event_versions[event_id]
+
+    def get(self, event_id: int) -> Dict:
+        """خلاصه یک اجرا: free / reserved / sold / total / min_price"""
+        with self._lock:
+            counts = self._status_counts.get(event_id, Counter())
+            prices = self._free_prices.get(event_id, Counter())
+            total = sum(counts.values())
+            free = counts['free']
+            sold = counts['sold']
+            return {
+                'free': free,
+                'sold': sold,
+                'reserved': total - free - sold,
+                'total': total,
+                'min_price': min(prices) if prices else None,
+            }
+
+availability = AvailabilityTracker()
 
 # ----- مدیریت کاربران -----
-def save_or_update_user(user_id: int, username: str = "", first_name: str = "", last_name: str = ""):
-    """ثبت یا به‌روزرسانی اطلاعات کاربر"""
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    
-    c.execute('SELECT 1 FROM users WHERE user_id=?', (user_id,))
-    exists = c.fetchone() is not None
-    
+def save_or_update_user(c, user_id: int, username: str = "", first_name: str = "", last_name: str = ""):
+    """ثبت یا به‌روزرسانی اطلاعات کاربر (از طریق db_writer)"""
     now = int(time.time())
-    
-    if exists:
-        c.execute('''
-            UPDATE users 
-            SET username=?, first_name=?, last_name=?, last_activity=?
-            WHERE user_id=?
-        ''', (username, first_name, last_name, now, user_id))
-    else:
-        c.execute('''
-            INSERT INTO users (user_id, username, first_name, last_name, joined_at, last_activity)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (user_id, username, first_name, last_name, now, now))
-    
-    conn.commit()
-    conn.close()
+    c.execute('''
+        INSERT INTO users (user_id, username, first_name, last_name, joined_at, last_activity)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            username=excluded.username, first_name=excluded.first_name,
+            last_name=excluded.last_name, last_activity=excluded.last_activity
+    ''', (user_id, username, first_name, last_name, now, now))
 
 def get_all_users(limit: int = 100, offset: int = 0) -> List[Tuple]:
     """دریافت لیست تمام کاربران"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = connect_db()
     c = conn.cursor()
     c.execute('''
         SELECT user_id, username, first_name, last_name, joined_at, last_activity 
@@ -235,86 +2329,99 @@ def get_all_users(limit: int = 100, offset: int = 0) -> List[Tuple]:
 
 def get_users_count() -> int:
     """تعداد کل کاربران"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = connect_db()
     c = conn.cursor()
     c.execute('SELECT COUNT(*) FROM users')
     count = c.fetchone()[0]
     conn.close()
     return count
 
+async def get_users_stats() -> Dict[str, int]:
+    """آمار کاربران (کل، امروز، فعال در ۲۴ ساعت)"""
+    return await single_flight.run(("users_stats",), _get_users_stats_sync, workload="admin")
+
+def _get_users_stats_sync() -> Dict[str, int]:
+    conn = connect_db()
+    c = conn.cursor()
+    today_start = int(datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
+    day_ago = int(time.time()) - 86400
+    c.execute('''
+        SELECT COUNT(*),
+               COALESCE(SUM(joined_at >= ?), 0),
+               COALESCE(SUM(last_activity >= ?), 0)
+        FROM users
+    ''', (today_start, day_ago))
+    total, today, active = c.fetchone()
+    conn.close()
+    return {"total": total, "today": today, "active": active}
+
 # ----- مدیریت وضعیت کاربران -----
-def save_user_state(user_id: int, state_type: str, state_data: str = ""):
+async def save_user_state(user_id: int, state_type: str, state_data: str = ""):
     """ذخیره وضعیت کاربر در دیتابیس"""
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
+    await db_writer.run(_save_user_state, user_id, state_type, state_data)
+
+def _save_user_state(c, user_id: int, state_type: str, state_data: str):
     c.execute('''
         INSERT OR REPLACE INTO user_states (user_id, state_type, state_data, created_at)
         VALUES (?, ?, ?, ?)
     ''', (user_id, state_type, state_data, int(time.time())))
-    conn.commit()
-    conn.close()
 
 def get_user_state(user_id: int):
     """دریافت وضعیت کاربر از دیتابیس"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = connect_db()
     c = conn.cursor()
     c.execute('SELECT state_type, state_data FROM user_states WHERE user_id=?', (user_id,))
     result = c.fetchone()
     conn.close()
     return result if result else (None, None)
 
-def clear_user_state(user_id: int):
+async def clear_user_state(user_id: int):
     """پاک کردن وضعیت کاربر"""
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
+    await db_writer.run(_clear_user_state, user_id)
+
+def _clear_user_state(c, user_id: int):
     c.execute('DELETE FROM user_states WHERE user_id=?', (user_id,))
-    conn.commit()
-    conn.close()
 
 # ----- مدیریت ادمین‌ها -----
 def is_admin(user_id: int) -> bool:
     """بررسی آیا کاربر ادمین است"""
     if user_id == config.ADMIN_CHAT_ID:
         return True
-    conn = sqlite3.connect(DB_FILE)
+    conn = connect_db()
     c = conn.cursor()
     c.execute('SELECT 1 FROM admins WHERE user_id=?', (user_id,))
     result = c.fetchone() is not None
     conn.close()
     return result
 
-def add_admin(user_id: int, added_by: int, username: str = "") -> bool:
+async def add_admin(user_id: int, added_by: int, username: str = "") -> bool:
     """اضافه کردن ادمین جدید"""
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
     try:
-        c.execute('INSERT OR REPLACE INTO admins (user_id, added_by, added_at, username) VALUES (?, ?, ?, ?)',
-                  (user_id, added_by, int(time.time()), username))
-        conn.commit()
+        await db_writer.run(_add_admin, user_id, added_by, username)
         return True
     except Exception as e:
         logger.error(f"خطا در اضافه کردن ادمین: {e}")
         return False
-    finally:
-        conn.close()
 
-def remove_admin(user_id: int) -> bool:
+def _add_admin(c, user_id: int, added_by: int, username: str):
+    c.execute('INSERT OR REPLACE INTO admins (user_id, added_by, added_at, username) VALUES (?, ?, ?, ?)',
+              (user_id, added_by, int(time.time()), username))
+
+async def remove_admin(user_id: int) -> bool:
     """حذف ادمین"""
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
     try:
-        c.execute('DELETE FROM admins WHERE user_id=? AND user_id!=?', (user_id, config.ADMIN_CHAT_ID))
-        conn.commit()
-        return c.rowcount > 0
+        return await db_writer.run(_remove_admin, user_id)
     except Exception as e:
         logger.error(f"خطا در حذف ادمین: {e}")
         return False
-    finally:
-        conn.close()
+
+def _remove_admin(c, user_id: int) -> bool:
+    c.execute('DELETE FROM admins WHERE user_id=? AND user_id!=?', (user_id, config.ADMIN_CHAT_ID))
+    return c.rowcount > 0
 
 def get_all_admins() -> List[Tuple]:
     """دریافت لیست تمام ادمین‌ها"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = connect_db()
     c = conn.cursor()
     c.execute('SELECT user_id, username, added_at FROM admins')
     admins = c.fetchall()
@@ -322,21 +2429,20 @@ def get_all_admins() -> List[Tuple]:
     return admins
 
 # ----- مدیریت پشتیبانی -----
-def save_support_message(user_id: int, message_text: str, message_type: str = "text"):
+async def save_support_message(user_id: int, message_text: str, message_type: str = "text"):
     """ذخیره پیام پشتیبانی"""
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
+    await db_writer.run(_save_support_message, user_id, message_text, message_type)
+    logger.info("پیام پشتیبانی از کاربر %s ذخیره شد", user_id, extra={"category": "support", "user": user_id})
+
+def _save_support_message(c, user_id: int, message_text: str, message_type: str):
     c.execute('''
         INSERT INTO support_messages (user_id, message_text, message_type, created_at)
         VALUES (?, ?, ?, ?)
     ''', (user_id, message_text, message_type, int(time.time())))
-    conn.commit()
-    conn.close()
-    print(f"✅ پیام پشتیبانی از کاربر {user_id} ذخیره شد")
 
 def get_pending_support_messages(limit: int = 10, offset: int = 0) -> List[Tuple]:
     """دریافت پیام‌های پشتیبانی در انتظار"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = connect_db()
     c = conn.cursor()
     c.execute('''
         SELECT sm.id, sm.user_id, sm.message_text, sm.message_type, sm.created_at, 
@@ -349,129 +2455,349 @@ def get_pending_support_messages(limit: int = 10, offset: int = 0) -> List[Tuple
     ''', (limit, offset))
     messages = c.fetchall()
     conn.close()
-    print(f"📨 دریافت {len(messages)} پیام پشتیبانی")
+    logger.debug("دریافت %d پیام پشتیبانی", len(messages), extra={"category": "support"})
     return messages
 
 def get_pending_support_messages_count() -> int:
     """تعداد پیام‌های پشتیبانی در انتظار"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = connect_db()
     c = conn.cursor()
     c.execute('SELECT COUNT(*) FROM support_messages WHERE status = "pending"')
     count = c.fetchone()[0]
     conn.close()
     return count
 
-def mark_support_message_handled(message_id: int, admin_id: int):
+async def mark_support_message_handled(message_id: int, admin_id: int):
     """علامت گذاری پیام پشتیبانی به عنوان پاسخ داده شده"""
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
+    await db_writer.run(_mark_support_message_handled, message_id, admin_id)
+
+def _mark_support_message_handled(c, message_id: int, admin_id: int):
     c.execute('''
         UPDATE support_messages 
         SET status = 'handled', admin_id = ?
         WHERE id = ?
     ''', (admin_id, message_id))
-    conn.commit()
-    conn.close()
 
-def delete_support_message(message_id: int):
+async def delete_support_message(message_id: int):
     """حذف پیام پشتیبانی"""
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
+    await db_writer.run(_delete_support_message, message_id)
+    logger.info("پیام پشتیبانی %s حذف شد", message_id, extra={"category": "support"})
+
+def _delete_support_message(c, message_id: int):
     c.execute('DELETE FROM support_messages WHERE id = ?', (message_id,))
-    conn.commit()
-    conn.close()
-    print(f"🗑️ پیام پشتیبانی {message_id} حذف شد")
 
 # ----- مدیریت صندلی -----
 async def get_seats(event_id):
     """دریافت لیست صندلی‌ها به صورت async"""
-    return await run_in_thread(_get_seats_sync, event_id)
+    return await single_flight.run(("seats", event_id), _get_seats_sync, event_id)
 
 def _get_seats_sync(event_id):
-    conn = sqlite3.connect(DB_FILE)
+    conn = connect_db()
     c = conn.cursor()
     c.execute('SELECT seat_id, row, col, status, reserved_by, price FROM seats WHERE event_id=? ORDER BY row, col', (event_id,))
     rows = c.fetchall()
     conn.close()
     return rows
 
-async def set_reserved(event_id, seat_id, user_id):
-    """رزرو صندلی به صورت اتمیک"""
-    return await run_in_thread(_set_reserved_sync, event_id, seat_id, user_id)
+# ----- آمار نوشتن صندلی‌ها به ازای هر اجرا -----
+class EventWriteStats:
+    """آمار تغییرات صندلی هر اجرا در صف نویسنده دیتابیس.
 
-def _set_reserved_sync(event_id, seat_id, user_id):
-    now = int(time.time())
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    
-    c.execute('''
-        UPDATE seats 
-        SET status=?, reserved_by=?, reserved_at=? 
-        WHERE event_id=? AND seat_id=? AND status='free'
-    ''', ('reserved', user_id, now, event_id, seat_id))
+    تغییرات همه اجراها به ترتیب ورود در صف db_writer اعمال و گروهی commit می‌شوند، پس
+    ترتیب تغییرات هر اجرا بدون قفل جداگانه حفظ می‌شود. رقابت روی یک اجرا به صورت تعداد
+    نوشتن‌های در جریان (ثبت شده و هنوز commit نشده) و زمان انتظار تا commit دیده می‌شود.
+    به‌روزرسانی در حلقه رویداد و خواندن از ترد metrics هم انجام می‌شود؛ برای همین قفل دارد.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.writes = Counter()
+        self.in_flight = Counter()
+        self.in_flight_max = Counter()
+        self.contended = Counter()
+        self.wait_total = Counter()
+        self.wait_max: Dict[int, float] = {}
+
+    @contextlib.contextmanager
+    def track(self, event_id: int):
+        with self._lock:
+            if self.in_flight[event_id]:
+                self.contended[event_id] += 1
+            self.in_flight[event_id] += 1
+            self.in_flight_max[event_id] = max(self.in_flight_max[event_id], self.in_flight[event_id])
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            waited = time.perf_counter() - start
+            with self._lock:
+                self.in_flight[event_id] -= 1
+                self.writes[event_id] += 1
+                self.wait_total[event_id] += waited
+                self.wait_max[event_id] = max(self.wait_max.get(event_id, 0.0), waited)
+            metrics.observe("seat_write_seconds", waited, event=str(event_id))
+
+    def pending(self) -> List[Tuple[int, int]]:
+        """نوشتن‌های در جریان هر اجرا"""
+        with self._lock:
+            return [(event_id, count) for event_id, count in self.in_flight.items() if count]
+
+    def snapshot(self) -> List[Dict]:
+        """آمار هر اجرا، مرتب شده بر اساس بیشترین رقابت"""
+        with self._lock:
+            rows = [{
+                'event_id': event_id,
+                'writes': count,
+                'contended': self.contended[event_id],
+                'in_flight': self.in_flight[event_id],
+                'in_flight_max': self.in_flight_max[event_id],
+                'wait_avg_ms': self.wait_total[event_id] / count * 1000,
+                'wait_max_ms': self.wait_max.get(event_id, 0.0) * 1000,
+            } for event_id, count in self.writes.items()]
+        return sorted(rows, key=lambda row: row['contended'], reverse=True)
+
+seat_writes = EventWriteStats()
+metrics.gauge("seat_writes_in_flight",
+              lambda: [({"event": str(event_id)}, count) for event_id, count in seat_writes.pending()])
+
+# ----- وضعیت‌های صندلی -----
+# free → reserved → pending_review → sold / free
+SEAT_TRANSITIONS = {
+    'free': {'reserved'},
+    'reserved': {'pending_review', 'free'},
+    'pending_review': {'sold', 'free'},
+    'sold': set(),
+}
+
+def _transition_seat(c, event_id, seat_id, from_status: str, to_status: str, user_id: int = None):
+    """تغییر شرطی وضعیت صندلی داخل تراکنش فراخواننده.
+
+    فقط اگر صندلی در وضعیت from_status باشد (و در صورت ذکر user_id، متعلق به همان کاربر)
+    تغییر می‌کند. خروجی: قیمت صندلی در صورت موفقیت، وگرنه None.
+    """
+    if to_status not in SEAT_TRANSITIONS[from_status]:
+        raise ValueError(f"تغییر وضعیت {from_status} → {to_status} مجاز نیست")
+    
+    if to_status == 'reserved':
+        assignments = "status=?, reserved_by=?, reserved_at=?, reminded_at=NULL"
+        params = [to_status, user_id, int(time.time())]
+    elif to_status == 'free':
+        assignments, params = "status=?, reserved_by=NULL, reserved_at=NULL, reminded_at=NULL", [to_status]
+    else:
+        assignments, params = "status=?", [to_status]
     
-    success = c.rowcount > 0
-    conn.commit()
-    conn.close()
+    condition, condition_params = "event_id=? AND seat_id=? AND status=?", [event_id, seat_id, from_status]
+    if user_id is not None and from_status != 'free':
+        condition += " AND reserved_by=?"
+        condition_params.append(user_id)
     
-    if not success:
-        return False, "این صندلی در حال حاضر قابل انتخاب نیست."
-    return True, None
+    c.execute(f'UPDATE seats SET {assignments} WHERE {condition} RETURNING price',
+              params + condition_params)
+    updated = c.fetchone()
+    return updated[0] if updated else None
 
-async def release_seat(event_id, seat_id):
-    """آزادسازی صندلی"""
-    await run_in_thread(_release_seat_sync, event_id, seat_id)
+async def set_reserved(event_id, seat_id, user_id):
+    """رزرو صندلی به صورت اتمیک؛ خروجی: (قیمت، None) یا (None، پیام خطا)"""
+    price = await write_for_event(event_id, _transition_seat, event_id, seat_id, 'free', 'reserved', user_id)
+    if price is None:
+        return None, "این صندلی در حال حاضر قابل انتخاب نیست."
+    availability.transition(event_id, 'free', 'reserved', price)
+    return price, None
 
-def _release_seat_sync(event_id, seat_id):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute('UPDATE seats SET status="free", reserved_by=NULL, reserved_at=NULL WHERE event_id=? AND seat_id=?',
-              (event_id, seat_id))
-    conn.commit()
-    conn.close()
+async def release_seat(event_id, seat_id, user_id=None) -> bool:
+    """آزادسازی صندلی رزرو شده"""
+    price = await write_for_event(event_id, _transition_seat, event_id, seat_id, 'reserved', 'free', user_id)
+    if price is None:
+        return False
+    availability.transition(event_id, 'reserved', 'free', price)
+    return True
+
+async def mark_sold(event_id, seat_id, user_id) -> bool:
+    """علامت گذاری صندلی در حال بررسی به عنوان فروخته شده"""
+    price = await write_for_event(event_id, _transition_seat, event_id, seat_id, 'pending_review', 'sold', user_id)
+    if price is None:
+        return False
+    availability.transition(event_id, 'pending_review', 'sold', price)
+    return True
 
-async def mark_sold(event_id, seat_id):
-    """علامت گذاری صندلی به عنوان فروخته شده"""
-    await run_in_thread(_mark_sold_sync, event_id, seat_id)
+async def get_seat(event_id, seat_id):
+    """وضعیت و قیمت یک صندلی (از استخر مسیر رزرو)"""
+    return await run_in_thread(_get_seat_sync, event_id, seat_id, workload="seat")
 
-def _mark_sold_sync(event_id, seat_id):
-    conn = sqlite3.connect(DB_FILE)
+def _get_seat_sync(event_id, seat_id):
+    conn = connect_db()
     c = conn.cursor()
-    c.execute('UPDATE seats SET status="sold" WHERE event_id=? AND seat_id=?', (event_id, seat_id))
-    conn.commit()
+    c.execute('SELECT status, price FROM seats WHERE event_id=? AND seat_id=?', (event_id, seat_id))
+    seat = c.fetchone()
     conn.close()
+    return seat
 
 async def get_reserved_seat_by_user(user_id):
     """دریافت صندلی رزرو شده توسط کاربر"""
     return await run_in_thread(_get_reserved_seat_by_user_sync, user_id)
 
 def _get_reserved_seat_by_user_sync(user_id):
-    conn = sqlite3.connect(DB_FILE)
+    conn = connect_db()
     c = conn.cursor()
     c.execute('SELECT event_id, seat_id FROM seats WHERE reserved_by=? AND status="reserved"', (user_id,))
     r = c.fetchone()
     conn.close()
     return r if r else None
 
-async def record_successful_payment(user_id, event_id, seat_id):
-    """ثبت پرداخت موفق"""
-    await run_in_thread(_record_successful_payment_sync, user_id, event_id, seat_id)
+async def set_seat_price(event_id, seat_id, price: int):
+    """تغییر قیمت صندلی توسط ادمین"""
+    seat = await write_for_event(event_id, _set_seat_price, event_id, seat_id, price)
+    if seat and seat[0] == 'free':
+        availability.reprice(event_id, seat[1], price)
+
+def _set_seat_price(c, event_id, seat_id, price: int):
+    """خروجی: وضعیت و قیمت قبلی صندلی"""
+    c.execute('SELECT status, price FROM seats WHERE event_id=? AND seat_id=?', (event_id, seat_id))
+    seat = c.fetchone()
+    c.execute("UPDATE seats SET price=? WHERE event_id=? AND seat_id=?", (price, event_id, seat_id))
+    return seat
+
+# ----- بررسی رسید پرداخت -----
+# وضعیت سفارش: pending → approved / rejected
+async def submit_receipt(user_id: int, file_id: str):
+    """ثبت رسید کاربر و انتقال صندلی به وضعیت در حال بررسی"""
+    seat = await get_reserved_seat_by_user(user_id)
+    if not seat:
+        return None
+    result = await write_for_event(seat[0], _submit_receipt, user_id, file_id)
+    if result is None:
+        return None
+    review_id, event_id, seat_id, price = result
+    availability.transition(event_id, 'reserved', 'pending_review', price)
+    return review_id, event_id, seat_id
+
+def _submit_receipt(c, user_id: int, file_id: str):
+    """خروجی: (شناسه بررسی، اجرا، صندلی، قیمت) یا None اگر صندلی رزرو شده‌ای وجود نداشته باشد"""
+    c.execute('SELECT event_id, seat_id FROM seats WHERE reserved_by=? AND status="reserved"', (user_id,))
+    seat = c.fetchone()
+    if not seat:
+        return None
+    event_id, seat_id = seat
+    
+    price = _transition_seat(c, event_id, seat_id, 'reserved', 'pending_review', user_id)
+    if price is None:
+        return None
+    
+    c.execute('''
+        INSERT INTO payment_reviews (event_id, seat_id, user_id, status, receipt_file_id, created_at)
+        VALUES (?, ?, ?, 'pending', ?, ?)
+    ''', (event_id, seat_id, user_id, file_id, int(time.time())))
+    return c.lastrowid, event_id, seat_id, price
+
+def has_pending_review(user_id: int) -> bool:
+    """آیا رسید کاربر در انتظار بررسی ادمین است"""
+    conn = connect_db()
+    c = conn.cursor()
+    c.execute('SELECT 1 FROM payment_reviews WHERE user_id=? AND status="pending" LIMIT 1', (user_id,))
+    result = c.fetchone() is not None
+    conn.close()
+    return result
+
+def add_review_message(c, review_id: int, chat_id: int, message_id: int):
+    """ثبت پیام رسید ارسال شده برای یک ادمین تا پس از تصمیم به‌روز شود (از طریق db_writer).
 
-def _record_successful_payment_sync(user_id, event_id, seat_id):
-    conn = sqlite3.connect(DB_FILE)
+    اگر ادمین دیگری در حین ارسال رسید به بقیه تصمیم گرفته باشد، این پیام در لیست پیام‌های
+    تصمیم نبوده است؛ در این صورت اطلاعات تصمیم برگردانده می‌شود تا فرستنده خودش آن را به‌روز کند.
+    """
+    c.execute('INSERT OR REPLACE INTO review_messages (review_id, chat_id, message_id) VALUES (?, ?, ?)',
+              (review_id, chat_id, message_id))
+    c.execute('''
+        SELECT event_id, seat_id, user_id, status, decided_by, decided_at
+        FROM payment_reviews WHERE id=? AND status!='pending'
+    ''', (review_id,))
+    row = c.fetchone()
+    if row is None:
+        return None
+    return dict(zip(("event_id", "seat_id", "user_id", "status", "decided_by", "decided_at"), row))
+
+def review_caption(review: Dict, decided_at: int) -> str:
+    """کپشن پیام رسید نزد ادمین‌ها پس از تایید یا رد"""
+    result = "✅ **پرداخت تایید شد!**" if review["status"] == "approved" else "❌ **پرداخت رد شد!**"
+    return (
+        f"{result}\n\n"
+        f"👤 کاربر: {review['user_id']}\n"
+        f"🎭 اجرا: {review['event_id']}\n"
+        f"💺 صندلی: {review['seat_id']}\n"
+        f"🛠 ادمین: {review['decided_by']}\n"
+        f"🕒 زمان: {datetime.fromtimestamp(decided_at).strftime('%Y/%m/%d %H:%M')}"
+    )
+
+async def decide_review(review_id: int, admin_id: int, approve: bool):
+    """تایید یا رد رسید؛ فقط اولین تصمیم اعمال می‌شود"""
+    event_id = await run_in_thread(_get_review_event_sync, review_id)
+    if event_id is None:
+        return "not_found", None, []
+    outcome, review, messages, price = await write_for_event(
+        event_id, _decide_review, review_id, admin_id, approve)
+    if outcome in ("approved", "rejected"):
+        target = 'sold' if approve else 'free'
+        availability.transition(review["event_id"], 'pending_review', target, price)
+    return outcome, review, messages
+
+def _get_review_event_sync(review_id: int):
+    conn = connect_db()
     c = conn.cursor()
-    c.execute('INSERT INTO successful_payments (user_id, event_id, seat_id, paid_at) VALUES (?, ?, ?, ?)',
-              (user_id, event_id, seat_id, int(time.time())))
-    conn.commit()
+    c.execute('SELECT event_id FROM payment_reviews WHERE id=?', (review_id,))
+    row = c.fetchone()
     conn.close()
+    return row[0] if row else None
+
+def _decide_review(c, review_id: int, admin_id: int, approve: bool):
+    """اعمال تصمیم ادمین با به‌روزرسانی‌های شرطی در یک تراکنش.
+
+    خروجی: (نتیجه، اطلاعات بررسی، پیام‌های ادمین‌ها، قیمت). نتیجه یکی از
+    approved / rejected / duplicate / conflict / not_found است.
+    """
+    now = int(time.time())
+    new_status = 'approved' if approve else 'rejected'
+    c.execute('''
+        UPDATE payment_reviews SET status=?, decided_by=?, decided_at=?
+        WHERE id=? AND status='pending'
+        RETURNING event_id, seat_id, user_id
+    ''', (new_status, admin_id, now, review_id))
+    row = c.fetchone()
+    
+    if row is None:
+        c.execute('SELECT event_id, seat_id, user_id, status, decided_by FROM payment_reviews WHERE id=?',
+                  (review_id,))
+        existing = c.fetchone()
+        if existing is None:
+            return "not_found", None, [], None
+        review = dict(zip(("event_id", "seat_id", "user_id", "status", "decided_by"), existing))
+        return "duplicate", review, [], None
+    
+    event_id, seat_id, customer_user_id = row
+    target = 'sold' if approve else 'free'
+    price = _transition_seat(c, event_id, seat_id, 'pending_review', target, customer_user_id)
+    if price is None:
+        raise RollbackWrite(("conflict", {"event_id": event_id, "seat_id": seat_id, "user_id": customer_user_id}, [], None))
+    
+    if approve:
+        c.execute('INSERT INTO successful_payments (user_id, event_id, seat_id, paid_at) VALUES (?, ?, ?, ?)',
+                  (customer_user_id, event_id, seat_id, now))
+        enqueue_job(c, "deliver_ticket",
+                    {"event_id": event_id, "seat_id": seat_id, "user_id": customer_user_id},
+                    f"deliver_ticket|{review_id}")
+    
+    c.execute('SELECT chat_id, message_id FROM review_messages WHERE review_id=?', (review_id,))
+    messages = c.fetchall()
+    review = {"event_id": event_id, "seat_id": seat_id, "user_id": customer_user_id,
+              "status": new_status, "decided_by": admin_id}
+    return new_status, review, messages, price
 
 # ----- گزارش‌گیری مالی -----
 async def get_financial_report(event_id: int = None) -> Dict:
     """گزارش مالی کامل"""
-    return await run_in_thread(_get_financial_report_sync, event_id)
+    return await single_flight.run(("financial_report", event_id), _get_financial_report_sync, event_id,
+                                   workload="admin")
 
 def _get_financial_report_sync(event_id: int = None) -> Dict:
-    conn = sqlite3.connect(DB_FILE)
+    conn = connect_db()
     c = conn.cursor()
     
     report = {
@@ -498,7 +2824,7 @@ def _get_financial_report_sync(event_id: int = None) -> Dict:
         sold_count = sold_data[1] if sold_data else 0
         sold_income = sold_data[2] if sold_data and sold_data[2] else 0
         
-        c.execute('SELECT COUNT(*) FROM seats WHERE event_id=? AND status="reserved"', (ev_id,))
+        c.execute('SELECT COUNT(*) FROM seats WHERE event_id=? AND status IN ("reserved", "pending_review")', (ev_id,))
         reserved_count = c.fetchone()[0]
         
         c.execute('SELECT COUNT(*) FROM seats WHERE event_id=? AND status="free"', (ev_id,))
@@ -523,40 +2849,353 @@ def _get_financial_report_sync(event_id: int = None) -> Dict:
     conn.close()
     return report
 
-# ----- آزادسازی خودکار و یادآوری پرداخت -----
-def release_expired_seats():
-    """آزادسازی صندلی‌های منقضی و ارسال یادآوری پرداخت"""
+# ----- خروجی فایل -----
+# (عنوان، سرستون‌ها، کوئری)؛ ترتیب بر اساس کلید اصلی یا rowid تا بدون مرتب‌سازی جریانی خوانده شود
+EXPORTS = {
+    "sales": ("فروش", (
+        "زمان پرداخت", "شناسه اجرا", "اجرا", "تاریخ اجرا", "صندلی", "ردیف", "ستون", "قیمت",
+        "شناسه کاربر", "یوزرنیم", "نام", "نام خانوادگی", "QR تأیید شده",
+    ), '''
+        SELECT datetime(p.paid_at, 'unixepoch', 'localtime'), p.event_id, e.title, e.event_date,
+               p.seat_id, s.row, s.col, s.price,
+               p.user_id, u.username, u.first_name, u.last_name, p.qr_verified
+        FROM successful_payments p
+        LEFT JOIN seats s ON s.event_id = p.event_id AND s.seat_id = p.seat_id
+        LEFT JOIN events e ON e.id = p.event_id
+        LEFT JOIN users u ON u.user_id = p.user_id
+        ORDER BY p.rowid
+    '''),
+    "users": ("کاربران", (
+        "شناسه کاربر", "یوزرنیم", "نام", "نام خانوادگی", "عضویت", "آخرین فعالیت",
+    ), '''
+        SELECT user_id, username, first_name, last_name,
+               datetime(joined_at, 'unixepoch', 'localtime'), datetime(last_activity, 'unixepoch', 'localtime')
+        FROM users
+        ORDER BY user_id
+    '''),
+    "support": ("پیام‌های پشتیبانی", (
+        "شناسه", "زمان", "شناسه کاربر", "یوزرنیم", "نام", "نام خانوادگی", "نوع", "وضعیت", "ادمین", "متن",
+    ), '''
+        SELECT sm.id, datetime(sm.created_at, 'unixepoch', 'localtime'), sm.user_id,
+               u.username, u.first_name, u.last_name, sm.message_type, sm.status, sm.admin_id, sm.message_text
+        FROM support_messages sm
+        LEFT JOIN users u ON u.user_id = sm.user_id
+        ORDER BY sm.id
+    '''),
+}
+
+# متنی که با این نویسه‌ها شروع شود در Excel فرمول حساب می‌شود (مثلاً نام =HYPERLINK(...))
+FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+def _export_row(row) -> List:
+    """خنثی کردن فرمول در فیلدهای متنی (نام، یوزرنیم، متن پیام) با پیشوند '"""
+    return [f"'{value}" if isinstance(value, str) and value.startswith(FORMULA_PREFIXES) else value
+            for value in row]
+
+def _export_sync(kind: str, fmt: str) -> Tuple[str, int]:
+    """نوشتن جریانی یک خروجی در فایل موقت فشرده (csv.gz یا xlsx)؛ خروجی: (مسیر، تعداد ردیف)
+
+    ردیف‌ها دسته‌ای (EXPORT_BATCH) از cursor خوانده و بلافاصله نوشته می‌شوند، پس حافظه به
+    اندازه جدول بستگی ندارد. اتصال فقط‌خواندنی است و روی snapshot ثابت WAL می‌خواند؛ قفل
+    نوشتن گرفته نمی‌شود و نویسنده دیتابیس در تمام مدت کار می‌کند.
+    """
+    _, headers, sql = EXPORTS[kind]
+    fd, path = tempfile.mkstemp(prefix=f"export_{kind}_", suffix=".xlsx" if fmt == "xlsx" else ".csv.gz")
+    os.close(fd)
+    conn = connect_db(read_only=True)
+    rows = 0
+    try:
+        cursor = conn.execute(sql)
+        batches = iter(lambda: cursor.fetchmany(EXPORT_BATCH), [])
+        if fmt == "xlsx":
+            from openpyxl import Workbook
+            # write_only ردیف‌ها را در فایل موقت نگه می‌دارد، نه در حافظه
+            workbook = Workbook(write_only=True)
+            sheet = workbook.create_sheet(kind)
+            sheet.append(headers)
+            for batch in batches:
+                for row in batch:
+                    sheet.append(_export_row(row))
+                rows += len(batch)
+            workbook.save(path)
+        else:
+            # BOM برای نمایش درست متن فارسی در Excel
+            with gzip.open(path, "wt", encoding="utf-8-sig", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(headers)
+                for batch in batches:
+                    writer.writerows(map(_export_row, batch))
+                    rows += len(batch)
+    except BaseException:
+        os.remove(path)
+        raise
+    finally:
+        conn.close()
+    return path, rows
+
+async def send_export(message, kind: str, fmt: str = "csv"):
+    """ساخت خروجی در استخر admin و ارسال آن به صورت فایل در چت message"""
+    title = EXPORTS[kind][0]
+    note = ""
+    if fmt == "xlsx" and importlib.util.find_spec("openpyxl") is None:
+        fmt, note = "csv", "\n(openpyxl نصب نیست؛ خروجی CSV فرستاده شد)"
+    
+    path, rows = await run_in_thread(_export_sync, kind, fmt, workload="admin")
+    try:
+        size = os.path.getsize(path)
+        if size > EXPORT_MAX_BYTES:
+            await message.reply_text(
+                f"❌ حجم خروجی {title} ({size / 1024 / 1024:.0f}MB) از سقف ارسال تلگرام بیشتر است."
+            )
+            return
+        suffix = ".xlsx" if fmt == "xlsx" else ".csv.gz"
+        with open(path, "rb") as f:
+            await message.reply_document(
+                document=f,
+                filename=f"{kind}_{datetime.now():%Y%m%d_%H%M}{suffix}",
+                caption=f"📥 خروجی {title}: {rows:,} ردیف{note}"
+            )
+    finally:
+        os.remove(path)
+
+async def run_export(message, kind: str, fmt: str = "csv"):
+    """اجرای send_export به صورت تسک پس‌زمینه.
+
+    ساخت و آپلود خروجی ممکن است چند ثانیه طول بکشد؛ اگر داخل هندلر اجرا شود مدتش در
+    تأخیر هندلرها (و تشخیص شلوغی) حساب می‌شود و مرور بقیه کاربران را رد می‌کند.
+    """
+    try:
+        await send_export(message, kind, fmt)
+    except ExecutorBusy:
+        await message.reply_text("⏳ سرور شلوغ است، چند ثانیه دیگر دوباره تلاش کنید.")
+    except Exception as e:
+        logger.error(f"خطا در ساخت خروجی {kind}: {e}")
+        await message.reply_text("❌ خطا در ساخت خروجی.")
+
+# ----- صف کارهای پس‌زمینه -----
+job_handlers = {}
+job_wakeup = None
+job_tasks: List[asyncio.Task] = []
+
+def enqueue_job(c, kind: str, payload: Dict, job_key: str) -> bool:
+    """ثبت کار در صف با کلید یکتا؛ با cursor تراکنش فراخواننده اجرا می‌شود.
+
+    اگر کاری با همین کلید قبلاً ثبت شده باشد، دوباره اضافه نمی‌شود.
+    """
+    now = int(time.time())
+    c.execute('''
+        INSERT OR IGNORE INTO jobs (job_key, kind, payload, status, attempts, run_at, created_at, updated_at)
+        VALUES (?, ?, ?, 'pending', 0, ?, ?, ?)
+    ''', (job_key, kind, json.dumps(payload), now, now, now))
+    return c.rowcount > 0
+
+def wake_job_workers():
+    """بیدار کردن کارگرها پس از ثبت کار جدید (فقط از داخل حلقه رویداد)"""
+    if job_wakeup is not None:
+        job_wakeup.set()
+
+def _claim_job(c):
+    """برداشتن اتمیک یک کار سررسید شده یا کاری که مهلت اجرایش تمام شده"""
+    now = int(time.time())
+    c.execute('''
+        UPDATE jobs
+        SET status='running', attempts=attempts+1, locked_until=?, updated_at=?
+        WHERE id = (
+            SELECT id FROM jobs
+            WHERE (status='pending' AND run_at<=?) OR (status='running' AND locked_until<?)
+            ORDER BY run_at
+            LIMIT 1
+        )
+        RETURNING id, kind, payload, attempts, locked_until
+    ''', (now + JOB_LEASE, now, now, now))
+    return c.fetchone()
+
+def _complete_job(c, job_id: int, locked_until: int) -> bool:
+    """ثبت پایان موفق کار، فقط اگر مهلت اجرا هنوز مال همین کارگر باشد"""
+    c.execute('''
+        UPDATE jobs SET status='done', last_error=NULL, updated_at=?
+        WHERE id=? AND status='running' AND locked_until=?
+    ''', (int(time.time()), job_id, locked_until))
+    return c.rowcount > 0
+
+def _fail_job(c, job_id: int, attempts: int, error: str, locked_until: int) -> bool:
+    """ثبت شکست کار؛ تلاش مجدد با تأخیر نمایی یا انتقال به لیست ناموفق‌ها.
+
+    فقط اگر مهلت اجرای این کارگر (locked_until) هنوز مال خودش باشد؛ اگر مهلت تمام شده و
+    کارگر دیگری کار را برداشته، وضعیت او بازنویسی نمی‌شود.
+    """
     now = int(time.time())
-    conn = sqlite3.connect(DB_FILE)
+    if attempts >= JOB_MAX_ATTEMPTS:
+        c.execute('''
+            UPDATE jobs SET status='dead', last_error=?, updated_at=?
+            WHERE id=? AND status='running' AND locked_until=?
+        ''', (error, now, job_id, locked_until))
+    else:
+        c.execute('''
+            UPDATE jobs SET status='pending', run_at=?, last_error=?, updated_at=?
+            WHERE id=? AND status='running' AND locked_until=?
+        ''', (now + JOB_RETRY_BASE * 2 ** (attempts - 1), error, now, job_id, locked_until))
+    return c.rowcount > 0
+
+def get_job_counts() -> Dict[str, int]:
+    """تعداد کارها به تفکیک وضعیت"""
+    conn = connect_db()
     c = conn.cursor()
-    
-    c.execute('SELECT event_id, seat_id, reserved_by, reserved_at FROM seats WHERE status="reserved"')
-    rows = c.fetchall()
-    
-    for event_id, seat_id, user_id, reserved_at in rows:
-        if now - reserved_at > 1800:
+    c.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status')
+    counts = dict(c.fetchall())
+    conn.close()
+    return counts
+
+def get_dead_jobs(limit: int = 10) -> List[Tuple]:
+    """کارهای ناموفق (dead-letter)"""
+    conn = connect_db()
+    c = conn.cursor()
+    c.execute('''
+        SELECT id, kind, payload, attempts, last_error, updated_at
+        FROM jobs WHERE status='dead'
+        ORDER BY updated_at DESC
+        LIMIT ?
+    ''', (limit,))
+    jobs = c.fetchall()
+    conn.close()
+    return jobs
+
+def retry_dead_job(c, job_id: int) -> bool:
+    """بازگرداندن کار ناموفق به صف (از طریق db_writer)"""
+    now = int(time.time())
+    c.execute('''
+        UPDATE jobs SET status='pending', attempts=0, run_at=?, updated_at=? WHERE id=? AND status='dead'
+    ''', (now, now, job_id))
+    return c.rowcount > 0
+
+async def job_worker(application, worker_id: int):
+    """کارگر صف: برداشتن کارها، اجرا و ثبت نتیجه (حداقل یک‌بار اجرا)"""
+    while True:
+        try:
+            job = await db_writer.run(_claim_job)
+        except Exception as e:
+            logger.error(f"خطا در برداشتن کار از صف: {e}")
+            job = None
+        
+        if job is None:
+            job_wakeup.clear()
             try:
-                asyncio.create_task(send_reminder(user_id, seat_id))
-            except Exception as e:
-                logger.error(f"خطا در ارسال یادآوری: {e}")
+                await asyncio.wait_for(job_wakeup.wait(), timeout=JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
         
-        if now - reserved_at > 2400:
-            c.execute('UPDATE seats SET status="free", reserved_by=NULL, reserved_at=NULL WHERE event_id=? AND seat_id=?',
-                      (event_id, seat_id))
+        job_id, kind, payload, attempts, locked_until = job
+        try:
+            handler = job_handlers[kind]
+            await handler(application.bot, json.loads(payload))
+        except Exception as e:
+            logger.error(f"کار {job_id} ({kind}) در تلاش {attempts} ناموفق بود: {e}")
+            # خطا در ثبت نتیجه نباید کارگر را از کار بیندازد؛ کار پس از پایان مهلت دوباره برداشته می‌شود
             try:
-                asyncio.create_task(send_expiration_notice(user_id, seat_id))
+                if not await db_writer.run(_fail_job, job_id, attempts, str(e), locked_until):
+                    logger.warning(f"مهلت کار {job_id} تمام شده بود؛ نتیجه این تلاش ثبت نشد")
             except Exception as e:
-                logger.error(f"خطا در ارسال اخطار انقضا: {e}")
-    
-    conn.commit()
+                logger.error(f"خطا در ثبت شکست کار {job_id}: {e}")
+            continue
+        
+        # کار انجام شده؛ خطای ثبت آن شکست کار نیست و نباید تلاش مجدد زمان‌بندی کند
+        try:
+            if not await db_writer.run(_complete_job, job_id, locked_until):
+                logger.warning(f"مهلت کار {job_id} تمام شده بود؛ پایان آن ثبت نشد")
+        except Exception as e:
+            logger.error(f"کار {job_id} ({kind}) انجام شد ولی ثبت پایان آن ناموفق بود: {e}")
+
+def start_job_workers(application):
+    """راه‌اندازی کارگرهای صف داخل حلقه رویداد.
+
+    در post_init هنوز Application شروع نشده و create_task آن کارها را پیگیری نمی‌کند؛
+    برای همین تسک‌ها اینجا نگه داشته و در stop_job_workers لغو می‌شوند.
+    """
+    global job_wakeup
+    job_wakeup = asyncio.Event()
+    for worker_id in range(JOB_WORKERS):
+        job_tasks.append(asyncio.create_task(job_worker(application, worker_id), name=f"job-worker-{worker_id}"))
+
+async def stop_job_workers():
+    """لغو کارگرهای صف هنگام توقف؛ کار نیمه‌تمام پس از پایان مهلتش دوباره اجرا می‌شود"""
+    for task in job_tasks:
+        task.cancel()
+    await asyncio.gather(*job_tasks, return_exceptions=True)
+    job_tasks.clear()
+
+# ----- آزادسازی خودکار و یادآوری پرداخت -----
+def _get_reserved_seats_sync():
+    conn = connect_db()
+    c = conn.cursor()
+    c.execute('SELECT event_id, seat_id, reserved_by, reserved_at, reminded_at FROM seats WHERE status="reserved"')
+    rows = c.fetchall()
     conn.close()
+    return rows
+
+def _mark_reminded(c, seats: List[Tuple[int, str, int, int]]) -> List[Tuple[int, str, int, int]]:
+    """ثبت ارسال یادآوری برای رزروها؛ فقط رزروهایی که هنوز همان رزرو و بدون یادآوری هستند.
+
+    خروجی: رزروهایی که یادآوری‌شان باید فرستاده شود.
+    """
+    now = int(time.time())
+    marked = []
+    for event_id, seat_id, user_id, reserved_at in seats:
+        c.execute('''
+            UPDATE seats SET reminded_at=?
+            WHERE event_id=? AND seat_id=? AND status='reserved' AND reserved_by=? AND reserved_at=?
+              AND reminded_at IS NULL
+        ''', (now, event_id, seat_id, user_id, reserved_at))
+        if c.rowcount:
+            marked.append((event_id, seat_id, user_id, reserved_at))
+    return marked
+
+def _expire_seats(c, event_id: int, seats: List[Tuple[str, int]]) -> List[Tuple[str, int, int]]:
+    """آزادسازی صندلی‌های منقضی یک اجرا؛ خروجی: صندلی‌های آزاد شده با قیمت"""
+    released = []
+    for seat_id, user_id in seats:
+        # اگر کاربر در همین لحظه رسید فرستاده باشد، صندلی دیگر reserved نیست و آزاد نمی‌شود
+        price = _transition_seat(c, event_id, seat_id, 'reserved', 'free', user_id)
+        if price is not None:
+            released.append((seat_id, user_id, price))
+    return released
+
+async def release_expired_seats():
+    """آزادسازی صندلی‌های منقضی و ارسال یادآوری پرداخت"""
+    now = int(time.time())
+    rows = await run_in_thread(_get_reserved_seats_sync)
+    expired: Dict[int, List[Tuple[str, int]]] = {}
+    remind = []
+    
+    for event_id, seat_id, user_id, reserved_at, reminded_at in rows:
+        age = now - reserved_at
+        if age > RESERVE_EXPIRE_AFTER:
+            expired.setdefault(event_id, []).append((seat_id, user_id))
+        elif age > RESERVE_REMINDER_AFTER and reminded_at is None:
+            # یادآوری فقط یک‌بار؛ اگر بررسی‌ای دیر اجرا یا جا افتاده باشد، در بررسی بعدی فرستاده می‌شود
+            remind.append((event_id, seat_id, user_id, reserved_at))
+    
+    if remind:
+        marked = await db_writer.run(_mark_reminded, remind)
+        await asyncio.gather(*(
+            send_reminder(user_id, seat_id, RESERVE_EXPIRE_AFTER - (now - reserved_at))
+            for _, seat_id, user_id, reserved_at in marked
+        ))
+    
+    for event_id, seats in expired.items():
+        released = await write_for_event(event_id, _expire_seats, event_id, seats)
+        for seat_id, user_id, price in released:
+            availability.transition(event_id, 'reserved', 'free', price)
+        for seat_id, user_id, _ in released:
+            await send_expiration_notice(user_id, seat_id)
 
-async def send_reminder(user_id: int, seat_id: str):
-    """ارسال یادآوری پرداخت"""
+async def send_reminder(user_id: int, seat_id: str, remaining: int):
+    """ارسال یادآوری پرداخت؛ remaining: ثانیه‌های باقی‌مانده تا انقضای رزرو"""
+    minutes = max(1, remaining // 60)
     try:
         await app.bot.send_message(
             chat_id=user_id, 
-            text=f"⏰ یادآوری: رزرو صندلی {seat_id} شما در حال انقضا است. لطفاً ظرف ۱۰ دقیقه پرداخت را انجام دهید."
+            text=f"⏰ یادآوری: رزرو صندلی {seat_id} شما در حال انقضا است. لطفاً ظرف {minutes} دقیقه پرداخت را انجام دهید."
         )
     except Exception as e:
         logger.error(f"خطا در ارسال یادآوری به کاربر {user_id}: {e}")
@@ -571,27 +3210,77 @@ async def send_expiration_notice(user_id: int, seat_id: str):
     except Exception as e:
         logger.error(f"خطا در ارسال اخطار انقضا به کاربر {user_id}: {e}")
 
-# ----- نقشه صندلی پیشرفته -----
-async def generate_seat_map_image(event_id):
-    """تولید نقشه صندلی با رنگ‌بندی پیشرفته"""
-    return await run_in_thread(_generate_seat_map_image_sync, event_id)
+# ----- بلوک‌بندی سالن -----
+def get_event_blocks(event) -> List[Tuple[int, int, int, int]]:
+    """تقسیم سالن به بلوک‌ها؛ هر بلوک (ردیف شروع، ردیف پایان، ستون شروع، ستون پایان)"""
+    blocks = []
+    for r0 in range(1, event["rows"] + 1, BLOCK_ROWS):
+        for c0 in range(1, event["cols"] + 1, BLOCK_COLS):
+            blocks.append((
+                r0, min(r0 + BLOCK_ROWS - 1, event["rows"]),
+                c0, min(c0 + BLOCK_COLS - 1, event["cols"])
+            ))
+    return blocks
 
-def _generate_seat_map_image_sync(event_id):
-    seats = _get_seats_sync(event_id)
-    if not seats:
-        width = SEAT_SIZE + 2*MARGIN
-        height = SEAT_SIZE + 2*MARGIN
-        img = Image.new('RGB', (width, height), color=(255,255,255))
-        img.save(f"seat_map_{event_id}.png")
-        return f"seat_map_{event_id}.png"
+def get_block_grid(event) -> Tuple[int, int]:
+    """تعداد بلوک‌ها در راستای ردیف و ستون"""
+    return (
+        (event["rows"] + BLOCK_ROWS - 1) // BLOCK_ROWS,
+        (event["cols"] + BLOCK_COLS - 1) // BLOCK_COLS
+    )
 
-    rows = max([r for _, r, _, _, _, _ in seats])
-    cols = max([c for _, _, c, _, _, _ in seats])
-    width = cols * SEAT_SIZE + 2*MARGIN
-    height = rows * SEAT_SIZE + 2*MARGIN + 80
-    img = Image.new('RGB', (width, height), color=(240, 240, 240))
-    draw = ImageDraw.Draw(img)
-    
+def get_block_index_of_seat(event, row: int, col: int) -> int:
+    """شماره بلوکی که صندلی در آن قرار دارد"""
+    _, block_cols = get_block_grid(event)
+    return ((row - 1) // BLOCK_ROWS) * block_cols + (col - 1) // BLOCK_COLS
+
+async def get_block_seats(event_id, block):
+    """دریافت صندلی‌های یک بلوک به صورت async"""
+    return await single_flight.run(("block_seats", event_id, tuple(block)), _get_block_seats_sync, event_id, block)
+
+def _get_block_seats_sync(event_id, block):
+    r0, r1, c0, c1 = block
+    conn = connect_db()
+    c = conn.cursor()
+    c.execute('''
+        SELECT seat_id, row, col, status, reserved_by, price FROM seats
+        WHERE event_id=? AND row BETWEEN ? AND ? AND col BETWEEN ? AND ?
+        ORDER BY row, col
+    ''', (event_id, r0, r1, c0, c1))
+    rows = c.fetchall()
+    conn.close()
+    return rows
+
+async def get_block_summary(event):
+    """خلاصه وضعیت هر بلوک: {شماره بلوک: {'free': .., 'total': ..}}"""
+    return await single_flight.run(("block_summary", event['id']), _get_block_summary_sync, event)
+
+def _get_block_summary_sync(event) -> Dict[int, Dict[str, int]]:
+    _, block_cols = get_block_grid(event)
+    conn = connect_db()
+    c = conn.cursor()
+    c.execute('''
+        SELECT (row-1)/?, (col-1)/?, status, COUNT(*) FROM seats
+        WHERE event_id=?
+        GROUP BY 1, 2, 3
+    ''', (BLOCK_ROWS, BLOCK_COLS, event["id"]))
+    summary = {}
+    for br, bc, status, count in c.fetchall():
+        block = summary.setdefault(br * block_cols + bc, {'free': 0, 'total': 0})
+        block['total'] += count
+        if status == 'free':
+            block['free'] += count
+    conn.close()
+    return summary
+
+# ----- نقشه صندلی پیشرفته -----
+_fonts_cache = None
+
+def _load_map_fonts():
+    """بارگذاری یک‌باره فونت‌های نقشه صندلی"""
+    global _fonts_cache
+    if _fonts_cache is not None:
+        return _fonts_cache
     try:
         font_paths = [
             "fonts/Vazir.ttf", "fonts/Shabnam.ttf", "fonts/B Nazanin.ttf",
@@ -612,6 +3301,63 @@ def _generate_seat_map_image_sync(event_id):
         font = ImageFont.load_default()
         small_font = ImageFont.load_default()
         tiny_font = ImageFont.load_default()
+    _fonts_cache = (font, small_font, tiny_font)
+    return _fonts_cache
+
+def _png_bytes(img) -> bytes:
+    """محتوای PNG تصویر.
+
+    نقشه‌ها به جای فایل مشترک روی دیسک به صورت بایت برگردانده می‌شوند تا رندر بعدی
+    همان نقشه (یا رندر هم‌زمان با کلید دیگر، مثل نقشه سالن تک‌بلوکی) فایلی را که
+    در حال آپلود یا در کش است بازنویسی نکند.
+    """
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+async def generate_seat_map_image(event_id) -> bytes:
+    """تولید نقشه صندلی با رنگ‌بندی پیشرفته (برای سالن‌های بزرگ: نمای کلی بلوک‌ها)"""
+    return await single_flight.run(("seat_map", event_id), _generate_seat_map_image_sync, event_id,
+                                   workload="render")
+
+def _generate_seat_map_image_sync(event_id):
+    event = event_catalog.get(event_id)
+    if event and len(get_event_blocks(event)) > 1:
+        return _generate_overview_image_sync(event)
+    seats = _get_seats_sync(event_id)
+    return _draw_seats_image(seats)
+
+async def generate_block_map_image(event_id, block_index) -> bytes:
+    """تولید نقشه صندلی یک بلوک"""
+    return await single_flight.run(("block_map", event_id, block_index), _generate_block_map_image_sync,
+                                   event_id, block_index, workload="render")
+
+def _generate_block_map_image_sync(event_id, block_index):
+    event = event_catalog.get(event_id)
+    blocks = get_event_blocks(event)
+    if len(blocks) == 1:
+        return _generate_seat_map_image_sync(event_id)
+    seats = _get_block_seats_sync(event_id, blocks[block_index])
+    return _draw_seats_image(seats)
+
+def _draw_seats_image(seats) -> bytes:
+    if not seats:
+        width = SEAT_SIZE + 2*MARGIN
+        height = SEAT_SIZE + 2*MARGIN
+        img = Image.new('RGB', (width, height), color=(255,255,255))
+        return _png_bytes(img)
+
+    # مختصات نسبت به گوشه بلوک محاسبه می‌شود تا اندازه تصویر به اندازه بلوک محدود بماند
+    min_row = min(r for _, r, _, _, _, _ in seats)
+    min_col = min(c for _, _, c, _, _, _ in seats)
+    rows = max(r for _, r, _, _, _, _ in seats) - min_row + 1
+    cols = max(c for _, _, c, _, _, _ in seats) - min_col + 1
+    width = cols * SEAT_SIZE + 2*MARGIN
+    height = rows * SEAT_SIZE + 2*MARGIN + 80
+    img = Image.new('RGB', (width, height), color=(240, 240, 240))
+    draw = ImageDraw.Draw(img)
+    
+    font, small_font, tiny_font = _load_map_fonts()
     
     legend_y = height - 60
     legend_x = MARGIN
@@ -629,20 +3375,19 @@ def _generate_seat_map_image_sync(event_id):
         x_pos = legend_x + i * legend_spacing
         draw.rectangle([x_pos, legend_y, x_pos + 15, legend_y + 15], 
                       fill=color, outline=(0,0,0), width=1)
-        text_width = draw.textlength(text, font=small_font)
         text_x = x_pos + 20
         draw.text((text_x, legend_y), text, fill=(0,0,0), font=small_font)
 
     for seat_id, r, c, status, _, price in seats:
-        x0 = MARGIN + (c-1)*SEAT_SIZE
-        y0 = MARGIN + (r-1)*SEAT_SIZE
+        x0 = MARGIN + (c-min_col)*SEAT_SIZE
+        y0 = MARGIN + (r-min_row)*SEAT_SIZE
         
         if status == 'free':
             if price > 150000:
                 color = (0, 100, 255)
             else:
                 color = (0, 200, 0)
-        elif status == 'reserved':
+        elif status in ('reserved', 'pending_review'):
             color = (255, 200, 0)
         else:
             color = (255, 0, 0)
@@ -674,17 +3419,49 @@ def _generate_seat_map_image_sync(event_id):
             price_y = y0 + SEAT_SIZE - 15
             draw.text((price_x, price_y), price_text, fill=(0,0,0), font=current_font)
     
-    path = f"seat_map_{event_id}.png"
-    img.save(path)
-    return path
+    return _png_bytes(img)
+
+def _generate_overview_image_sync(event) -> bytes:
+    """نمای کلی سالن: هر بلوک یک کاشی با تعداد صندلی‌های آزاد"""
+    summary = _get_block_summary_sync(event)
+    block_rows, block_cols = get_block_grid(event)
+    width = block_cols * BLOCK_TILE_WIDTH + 2*MARGIN
+    height = block_rows * BLOCK_TILE_HEIGHT + 2*MARGIN + 40
+    img = Image.new('RGB', (width, height), color=(240, 240, 240))
+    draw = ImageDraw.Draw(img)
+    font, small_font, _ = _load_map_fonts()
+    
+    draw.text((width//2, MARGIN//2 + 5), "صحنه", fill=(0,0,0), font=font, anchor="mm")
+    
+    for index in range(block_rows * block_cols):
+        br, bc = divmod(index, block_cols)
+        x0 = MARGIN + bc * BLOCK_TILE_WIDTH
+        y0 = MARGIN + 20 + br * BLOCK_TILE_HEIGHT
+        stats = summary.get(index, {'free': 0, 'total': 0})
+        
+        if stats['total'] == 0 or stats['free'] == 0:
+            color = (255, 0, 0)
+        elif stats['free'] / stats['total'] < 0.25:
+            color = (255, 200, 0)
+        else:
+            color = (0, 200, 0)
+        
+        draw.rectangle([x0, y0, x0+BLOCK_TILE_WIDTH-4, y0+BLOCK_TILE_HEIGHT-4],
+                      fill=color, outline=(0,0,0), width=1)
+        draw.text((x0 + BLOCK_TILE_WIDTH//2, y0 + BLOCK_TILE_HEIGHT//3),
+                  f"B{index + 1}", fill=(0,0,0), font=font, anchor="mm")
+        draw.text((x0 + BLOCK_TILE_WIDTH//2, y0 + 2*BLOCK_TILE_HEIGHT//3),
+                  f"{stats['free']}/{stats['total']}", fill=(0,0,0), font=small_font, anchor="mm")
+    
+    return _png_bytes(img)
 
 # ----- رسید گرافیکی زیبا -----
 async def generate_beautiful_receipt(user_id: int, event_id: int, seat_id: str, username: str = "") -> str:
     """تولید رسید گرافیکی زیبا"""
-    return await run_in_thread(_generate_beautiful_receipt_sync, user_id, event_id, seat_id, username)
+    return await run_in_thread(_generate_beautiful_receipt_sync, user_id, event_id, seat_id, username, workload="render")
 
 def _generate_beautiful_receipt_sync(user_id: int, event_id: int, seat_id: str, username: str = "") -> str:
-    conn = sqlite3.connect(DB_FILE)
+    conn = connect_db()
     c = conn.cursor()
     
     c.execute('SELECT title, event_date FROM events WHERE id=?', (event_id,))
@@ -760,7 +3537,7 @@ def _generate_beautiful_receipt_sync(user_id: int, event_id: int, seat_id: str,
 # ----- QR Code -----
 async def generate_qr_code(event_id: int, seat_id: str, user_id: int) -> str:
     """تولید QR Code برای بلیت"""
-    return await run_in_thread(_generate_qr_code_sync, event_id, seat_id, user_id)
+    return await run_in_thread(_generate_qr_code_sync, event_id, seat_id, user_id, workload="render")
 
 def _generate_qr_code_sync(event_id: int, seat_id: str, user_id: int) -> str:
     qr_data = {
@@ -781,6 +3558,561 @@ def _generate_qr_code_sync(event_id: int, seat_id: str, user_id: int) -> str:
     
     return path
 
+# ----- کیبورد صندلی‌ها -----
+def build_block_keyboard(event, summary, callback_prefix, back_data):
+    """کیبورد انتخاب بلوک سالن همراه با تعداد صندلی‌های آزاد"""
+    keyboard = []
+    current_row = []
+    
+    for index in range(len(get_event_blocks(event))):
+        stats = summary.get(index, {'free': 0, 'total': 0})
+        current_row.append(InlineKeyboardButton(
+            f"B{index + 1} ({stats['free']})",
+            callback_data=f"{callback_prefix}|{event['id']}|{index}"
+        ))
+        
+        if len(current_row) >= 4:
+            keyboard.append(current_row)
+            current_row = []
+    
+    if current_row:
+        keyboard.append(current_row)
+    
+    keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data=back_data)])
+    return InlineKeyboardMarkup(keyboard)
+
+def build_seat_keyboard(event, block_index, seats, page: int = 0, mode: str = "pick"):
+    """کیبورد صفحه‌بندی شده صندلی‌های یک بلوک (mode: pick برای کاربر، price برای ادمین)"""
+    event_id = event["id"]
+    total_pages = max(1, (len(seats) + SEATS_PER_PAGE - 1) // SEATS_PER_PAGE)
+    page = max(0, min(page, total_pages - 1))
+    
+    keyboard = []
+    current_row = []
+    
+    for seat_id, r, c, status, _, price in seats[page*SEATS_PER_PAGE:(page+1)*SEATS_PER_PAGE]:
+        seat_label = f"{r}-{c}"
+        
+        if mode == "price":
+            btn = InlineKeyboardButton(seat_label, callback_data=f"admin_price_seat|{event_id}|{seat_id}")
+        elif status == 'free':
+            btn = InlineKeyboardButton(seat_label, callback_data=f"seat|{event_id}|{seat_id}")
+        elif status in ('reserved', 'pending_review'):
+            btn = InlineKeyboardButton(f"⏳{seat_label}", callback_data="disabled")
+        else:
+            btn = InlineKeyboardButton(f"❌{seat_label}", callback_data="disabled")
+        
+        current_row.append(btn)
+        
+        if len(current_row) >= SEAT_BUTTONS_PER_ROW:
+            keyboard.append(current_row)
+            current_row = []
+    
+    if current_row:
+        keyboard.append(current_row)
+    
+    page_prefix = "admin_price_page" if mode == "price" else "page"
+    pagination_buttons = []
+    if page > 0:
+        pagination_buttons.append(InlineKeyboardButton(
+            "⬅️ صفحه قبلی", callback_data=f"{page_prefix}|{event_id}|{block_index}|{page-1}"))
+    if page < total_pages - 1:
+        pagination_buttons.append(InlineKeyboardButton(
+            "صفحه بعدی ➡️", callback_data=f"{page_prefix}|{event_id}|{block_index}|{page+1}"))
+    if pagination_buttons:
+        keyboard.append(pagination_buttons)
+    
+    if len(get_event_blocks(event)) > 1:
+        overview_data = f"admin_price_event|{event_id}" if mode == "price" else f"event|{event_id}"
+        keyboard.append([InlineKeyboardButton("🗺 نمای کلی سالن", callback_data=overview_data)])
+    
+    if mode == "price":
+        keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data="admin_back")])
+    else:
+        keyboard.append([InlineKeyboardButton("🔙 بازگشت به لیست اجراها", callback_data="back_to_events")])
+    
+    return InlineKeyboardMarkup(keyboard)
+
+async def show_event_seats(context: ContextTypes.DEFAULT_TYPE, user_id: int, event):
+    """نمایش صندلی‌های اجرا؛ در سالن‌های بزرگ ابتدا نمای کلی بلوک‌ها"""
+    if len(get_event_blocks(event)) == 1:
+        await show_seat_block(context, user_id, event, 0)
+        return
+    
+    await send_live_map(context.bot, user_id, event, {'kind': 'overview'})
+
+async def show_seat_block(context: ContextTypes.DEFAULT_TYPE, user_id: int, event, block_index: int, page: int = 0):
+    """نمایش نقشه و کیبورد صفحه‌بندی شده یک بلوک"""
+    blocks = get_event_blocks(event)
+    if not 0 <= block_index < len(blocks):
+        await context.bot.send_message(chat_id=user_id, text="❌ بلوک یافت نشد.")
+        return
+    
+    await send_live_map(context.bot, user_id, event, {'kind': 'block', 'block': block_index, 'page': page})
+
+async def update_seat_keyboard_page(query, event, block_index: int, page: int, mode: str = "pick"):
+    """تغییر صفحه کیبورد صندلی‌ها بدون رندر و ارسال مجدد نقشه"""
+    blocks = get_event_blocks(event)
+    if not 0 <= block_index < len(blocks):
+        return
+    seats = await get_block_seats(event["id"], blocks[block_index])
+    await query.edit_message_reply_markup(
+        reply_markup=build_seat_keyboard(event, block_index, seats, page, mode)
+    )
+    if mode == "pick":
+        live_maps.set_page(event["id"], query.message.chat_id, query.message.message_id, page)
+
+# ----- نقشه‌های زنده -----
+def build_stats_caption(event) -> str:
+    """متن آمار صندلی‌های یک اجرا از خلاصه لحظه‌ای ظرفیت"""
+    summary = availability.get(event['id'])
+    total_seats = summary['total']
+    free_seats = summary['free']
+    reserved_seats = summary['reserved']
+    sold_seats = summary['sold']
+    
+    return (
+        f"📊 **آمار صندلی‌ها - {event['title']}**\n\n"
+        f"🎫 **کل صندلی‌ها:** {total_seats}\n"
+        f"🟢 **آزاد:** {free_seats}\n"
+        f"🟡 **رزرو شده:** {reserved_seats}\n"
+        f"🔴 **فروخته شده:** {sold_seats}\n"
+        f"📈 **پرشدگی:** {((sold_seats + reserved_seats) / max(total_seats, 1) * 100):.1f}%"
+    )
+
+async def render_live_image(event, view: Dict) -> bytes:
+    """رندر تصویر یک نمای نقشه (view['kind']: overview / block / stats / map / admin_map).
+
+    در شلوغی نقشه کش شده قبلی برگردانده می‌شود یا با ExecutorBusy به نسخه متنی می‌رسیم.
+    """
+    key = ("image", event['id'], view['block'] if view['kind'] == 'block' else None)
+    version = availability.event_version(event['id'])
+    level = overload.level()
+    if level >= overload.TEXT_ONLY:
+        overload.degraded["text_only"] += 1
+        raise ExecutorBusy("render")
+    image = overload.cached(key, version, level)
+    if image:
+        return image
+    
+    if view['kind'] == 'block':
+        image = await generate_block_map_image(event['id'], view['block'])
+    else:
+        image = await generate_seat_map_image(event['id'])
+    overload.remember(key, image, version)
+    return image
+
+async def build_live_caption(event, view: Dict):
+    """کپشن و کیبورد یک نمای نقشه (تا تغییر بعدی صندلی‌ها کش می‌شود)"""
+    key = ("caption", event['id'], view['kind'], view.get('block'), view.get('page', 0))
+    version = availability.event_version(event['id'])
+    cached = overload.cached(key, version, overload.level())
+    if cached:
+        return cached
+    result = await _build_live_caption(event, view)
+    overload.remember(key, result, version)
+    return result
+
+async def _build_live_caption(event, view: Dict):
+    kind = view['kind']
+    
+    if kind == 'block':
+        blocks = get_event_blocks(event)
+        seats = await get_block_seats(event['id'], blocks[view['block']])
+        block_title = f" - بلوک {view['block'] + 1}" if len(blocks) > 1 else ""
+        caption = (
+            f"💺 **انتخاب صندلی - {event['title']}{block_title}**\n\n"
+            "🟩 آزاد 🟨 رزرو شده 🟥 فروخته شده\n\n"
+            "لطفاً صندلی مورد نظر را انتخاب کنید:"
+        )
+        return caption, build_seat_keyboard(event, view['block'], seats, view.get('page', 0))
+    
+    if kind == 'overview':
+        summary = await get_block_summary(event)
+        caption = (
+            f"🗺 **نمای کلی سالن - {event['title']}**\n\n"
+            "🟩 صندلی آزاد زیاد 🟨 رو به اتمام 🟥 تکمیل\n\n"
+            "لطفاً بلوک مورد نظر را انتخاب کنید:"
+        )
+        return caption, build_block_keyboard(event, summary, "block", "back_to_events")
+    
+    if kind == 'stats':
+        return build_stats_caption(event), None
+    
+    if kind == 'admin_map':
+        return f"📊 نقشه صندلی {event['title']}", None
+    
+    return "نقشه صندلی: 🟩آزاد 🟨رزرو شده 🟥فروخته شده 🟦وی‌آی‌پی", None
+
+async def send_live_map(bot, chat_id: int, event, view: Dict):
+    """ارسال نقشه صندلی و ثبت آن برای به‌روزرسانی درجا"""
+    caption, markup = await build_live_caption(event, view)
+    try:
+        image = await render_live_image(event, view)
+    except ExecutorBusy:
+        # استخر رندر پر است؛ همان کیبورد و متن بدون تصویر فرستاده می‌شود
+        return await bot.send_message(chat_id=chat_id, text=caption, reply_markup=markup, parse_mode='Markdown')
+    
+    message = await bot.send_photo(
+        chat_id=chat_id,
+        photo=image,
+        caption=caption,
+        reply_markup=markup,
+        parse_mode='Markdown'
+    )
+    
+    live_maps.subscribe(event['id'], message.chat_id, message.message_id, view)
+    return message
+
+class LiveMapSubscriptions:
+    """نگهداری پیام‌های نقشه صندلی ارسال شده و به‌روزرسانی درجا با edit_message_media.
+
+    تغییرات هر اجرا به مدت LIVE_MAP_DEBOUNCE ثانیه تجمیع می‌شوند، هر نما یک‌بار رندر
+    و یک‌بار آپلود می‌شود و بقیه پیام‌ها با file_id همان عکس ویرایش می‌شوند.
+    """
+
+    def __init__(self, max_viewers: int, debounce: float):
+        self.max_viewers = max_viewers
+        self.debounce = debounce
+        self._viewers: Dict[int, OrderedDict] = {}
+        self._pending: Dict[int, asyncio.Task] = {}
+        self._bot = None
+        self._loop = None
+
+    def attach(self, bot, loop):
+        self._bot = bot
+        self._loop = loop
+
+    def subscribe(self, event_id: int, chat_id: int, message_id: int, view: Dict):
+        """ثبت پیام نقشه؛ برای هر چت فقط آخرین نقشه هر اجرا نگه داشته می‌شود"""
+        viewers = self._viewers.setdefault(event_id, OrderedDict())
+        for key in [key for key in viewers if key[0] == chat_id]:
+            del viewers[key]
+        viewers[(chat_id, message_id)] = dict(view)
+        while len(viewers) > self.max_viewers:
+            viewers.popitem(last=False)
+
+    def set_page(self, event_id: int, chat_id: int, message_id: int, page: int):
+        view = self._viewers.get(event_id, {}).get((chat_id, message_id))
+        if view is not None:
+            view['page'] = page
+
+    def notify(self, event_id: int):
+        """اعلام تغییر صندلی‌های یک اجرا؛ از هر تردی قابل فراخوانی است"""
+        if self._loop is None or self._loop.is_closed():
+            return
+        self._loop.call_soon_threadsafe(self._schedule, event_id)
+
+    def _schedule(self, event_id: int, delay: float = None):
+        if event_id in self._pending or not self._viewers.get(event_id):
+            return
+        self._pending[event_id] = self._loop.create_task(
+            self._refresh_later(event_id, self.debounce if delay is None else delay)
+        )
+
+    async def _refresh_later(self, event_id: int, delay: float):
+        await asyncio.sleep(delay)
+        self._pending.pop(event_id, None)
+        try:
+            await self._refresh(event_id)
+        except Exception as e:
+            logger.error(f"خطا در به‌روزرسانی نقشه‌های زنده اجرای {event_id}: {e}")
+
+    async def _refresh(self, event_id: int):
+        event = event_catalog.get(event_id)
+        viewers = self._viewers.get(event_id)
+        if not event or not viewers:
+            return
+        if overload.level() >= overload.STALE_MAPS:
+            # در شلوغی به‌روزرسانی درجا عقب می‌افتد تا استخر رندر برای درخواست‌های جدید بماند
+            self._schedule(event_id)
+            return
+        
+        media_cache = {}
+        caption_cache = {}
+        
+        for (chat_id, message_id), view in list(viewers.items()):
+            image_key = (view['kind'] == 'block', view.get('block'))
+            caption_key = (view['kind'], view.get('block'), view.get('page', 0))
+            
+            if image_key not in media_cache:
+                try:
+                    media_cache[image_key] = await render_live_image(event, view)
+                except ExecutorBusy:
+                    self._schedule(event_id)
+                    return
+            if caption_key not in caption_cache:
+                caption_cache[caption_key] = await build_live_caption(event, view)
+            caption, markup = caption_cache[caption_key]
+            
+            try:
+                message = await self._bot.edit_message_media(
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    media=InputMediaPhoto(media=media_cache[image_key], caption=caption, parse_mode='Markdown'),
+                    reply_markup=markup
+                )
+                if message is not True and message.photo:
+                    # آپلودهای بعدی همین نما با file_id انجام می‌شود
+                    media_cache[image_key] = message.photo[-1].file_id
+            except RetryAfter as e:
+                self._schedule(event_id, e.retry_after)
+                return
+            except BadRequest as e:
+                if "not modified" not in str(e).lower():
+                    viewers.pop((chat_id, message_id), None)
+            except TelegramError as e:
+                logger.warning(f"ویرایش نقشه زنده {chat_id}/{message_id} ناموفق بود: {e}")
+
+live_maps = LiveMapSubscriptions(LIVE_MAP_MAX_VIEWERS, LIVE_MAP_DEBOUNCE)
+availability.add_listener(live_maps.notify)
+
+# ----- صف انتظار مجازی -----
+class WaitingRoom:
+    """صف انتظار هر اجرا برای فروش‌های پرهجوم.
+
+    حداکثر capacity کاربر هم‌زمان صندلی انتخاب می‌کنند؛ بقیه به ترتیب ورود (FIFO) در صف
+    می‌مانند و با تمام شدن رزرو، لغو یا منقضی شدن نوبت دیگران، نوبتشان اعلام می‌شود.
+    قبل از زمان شروع فروش (on_sale) همه در صف ثبت می‌شوند. وضعیت در حافظه است و فقط
+    برای بازیابی پس از ری‌استارت به صورت دوره‌ای در جدول waiting_room ذخیره می‌شود.
+    """
+
+    def __init__(self, capacity: int, session: float, claim: float):
+        self.capacity = capacity
+        self.session = session
+        self.claim = claim
+        self._active: Dict[int, Dict[int, float]] = {}       # اجرا → {کاربر: مهلت}
+        self._admitted_at: Dict[Tuple[int, int], float] = {}
+        self._queue: Dict[int, OrderedDict] = {}             # اجرا → {کاربر: شماره نوبت}
+        self._next_ticket = Counter()
+        self._session_avg: Dict[int, float] = {}
+        self._dirty = set()
+        self._bot = None
+        self._loop = None
+        # حلقه رویداد فقط ارجاع ضعیف به تسک‌ها نگه می‌دارد؛ اعلام‌های در حال ارسال اینجا نگه داشته می‌شوند
+        self._notify_tasks = set()
+        self.admitted = Counter()
+
+    def attach(self, bot, loop):
+        self._bot = bot
+        self._loop = loop
+
+    @staticmethod
+    def is_open(event) -> bool:
+        return not event.get("on_sale") or time.time() >= event["on_sale"]
+
+    def enter(self, event, user_id: int) -> Tuple[bool, int]:
+        """ورود کاربر به صفحه انتخاب صندلی؛ خروجی: (اجازه ورود، جایگاه در صف)"""
+        event_id = event["id"]
+        active = self._active.setdefault(event_id, {})
+        waiting = self._queue.setdefault(event_id, OrderedDict())
+        now = time.time()
+        
+        if user_id in active:
+            active[user_id] = now + self.session
+            return True, 0
+        if user_id not in waiting:
+            if self.is_open(event) and not waiting and len(active) < self.capacity:
+                self._admit(event_id, user_id, now + self.session)
+                return True, 0
+            waiting[user_id] = self._next_ticket[event_id]
+            self._next_ticket[event_id] += 1
+            self._dirty.add(event_id)
+        return False, self.position(event_id, user_id)
+
+    def touch(self, event_id: int, user_id: int) -> bool:
+        """تمدید نوبت کاربر فعال؛ خروجی False یعنی کاربر نوبت فعالی ندارد"""
+        active = self._active.get(event_id)
+        if active is None or user_id not in active:
+            return False
+        active[user_id] = time.time() + self.session
+        return True
+
+    def leave(self, event_id: int, user_id: int):
+        """پایان نوبت (رزرو انجام شد یا لغو شد) و اعلام نوبت نفر بعدی"""
+        active = self._active.get(event_id, {})
+        if active.pop(user_id, None) is None:
+            return
+        started = self._admitted_at.pop((event_id, user_id), None)
+        if started is not None:
+            duration = time.time() - started
+            average = self._session_avg.get(event_id, duration)
+            self._session_avg[event_id] = average * 0.8 + duration * 0.2
+        self._dirty.add(event_id)
+        self._promote(event_id)
+
+    def position(self, event_id: int, user_id: int) -> int:
+        waiting = self._queue.get(event_id)
+        if not waiting or user_id not in waiting:
+            return 0
+        return waiting[user_id] - next(iter(waiting.values())) + 1
+
+    def estimated_wait(self, event_id: int, position: int) -> int:
+        """تخمین زمان انتظار (ثانیه) از روی میانگین مدت نوبت کاربران قبلی"""
+        average = self._session_avg.get(event_id, self.session / 2)
+        return int(math.ceil(position / self.capacity) * average)
+
+    async def expire(self):
+        """آزادسازی نوبت‌های بدون فعالیت و اعلام نوبت نفرات بعدی"""
+        now = time.time()
+        for event_id, active in self._active.items():
+            expired = [user_id for user_id, deadline in active.items() if deadline < now]
+            for user_id in expired:
+                del active[user_id]
+                self._admitted_at.pop((event_id, user_id), None)
+            if expired:
+                self._dirty.add(event_id)
+        for event_id in list(self._queue):
+            self._promote(event_id)
+
+    async def open_gate(self, event_id: int):
+        """شروع فروش: اعلام نوبت به اولین نفرات صف"""
+        self._promote(event_id)
+
+    def _admit(self, event_id: int, user_id: int, deadline: float):
+        self._active.setdefault(event_id, {})[user_id] = deadline
+        self._admitted_at[(event_id, user_id)] = time.time()
+        self.admitted[event_id] += 1
+        self._dirty.add(event_id)
+
+    def _promote(self, event_id: int):
+        event = event_catalog.get(event_id)
+        waiting = self._queue.get(event_id)
+        if not event or not waiting or not self.is_open(event):
+            return
+        active = self._active.setdefault(event_id, {})
+        while waiting and len(active) < self.capacity:
+            user_id, _ = waiting.popitem(last=False)
+            self._admit(event_id, user_id, time.time() + self.claim)
+            if self._loop is not None:
+                task = self._loop.create_task(self._notify_admitted(event, user_id))
+                self._notify_tasks.add(task)
+                task.add_done_callback(self._notify_tasks.discard)
+
+    async def _notify_admitted(self, event, user_id: int):
+        try:
+            await self._bot.send_message(
+                chat_id=user_id,
+                text=(
+                    f"🎉 **نوبت شما رسید!**\n\n🎭 {event['title']}\n"
+                    f"⏰ برای انتخاب صندلی {int(self.claim)} ثانیه فرصت دارید."
+                ),
+                reply_markup=InlineKeyboardMarkup([[
+                    InlineKeyboardButton("💺 انتخاب صندلی", callback_data=f"event|{event['id']}")
+                ]]),
+                parse_mode='Markdown'
+            )
+        except TelegramError as e:
+            logger.warning(f"اعلام نوبت به کاربر {user_id} ناموفق بود: {e}")
+        except Exception as e:
+            logger.error(f"خطا در اعلام نوبت به کاربر {user_id}: {e}")
+
+    def stats(self, event_id: int) -> Tuple[int, int]:
+        """(تعداد فعال، تعداد در صف)"""
+        return len(self._active.get(event_id, {})), len(self._queue.get(event_id, {}))
+
+    def event_ids(self) -> List[int]:
+        return sorted(set(self._active) | set(self._queue))
+
+    def _snapshot(self, c, rows_by_event: Dict[int, List[Tuple]]):
+        for event_id, rows in rows_by_event.items():
+            c.execute('DELETE FROM waiting_room WHERE event_id=?', (event_id,))
+            c.executemany(
+                'INSERT INTO waiting_room (event_id, user_id, state, ticket, deadline) VALUES (?, ?, ?, ?, ?)',
+                rows
+            )
+
+    async def persist(self):
+        """ذخیره وضعیت صف‌های تغییر کرده (برای بازیابی پس از ری‌استارت)"""
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        # کپی وضعیت داخل حلقه رویداد؛ ترد نویسنده به دیکشنری‌های در حال تغییر دست نمی‌زند
+        rows_by_event = {}
+        for event_id in dirty:
+            rows = [(event_id, user_id, 'active', None, int(deadline))
+                    for user_id, deadline in self._active.get(event_id, {}).items()]
+            rows += [(event_id, user_id, 'queued', ticket, None)
+                     for user_id, ticket in self._queue.get(event_id, {}).items()]
+            rows_by_event[event_id] = rows
+        await db_writer.run(self._snapshot, rows_by_event)
+
+    def restore(self):
+        """بازیابی صف‌ها پس از ری‌استارت"""
+        conn = connect_db()
+        c = conn.cursor()
+        c.execute('SELECT event_id, user_id, state, ticket, deadline FROM waiting_room ORDER BY event_id, ticket')
+        for event_id, user_id, state, ticket, deadline in c.fetchall():
+            if state == 'active':
+                self._active.setdefault(event_id, {})[user_id] = deadline
+            else:
+                self._queue.setdefault(event_id, OrderedDict())[user_id] = ticket
+                self._next_ticket[event_id] = max(self._next_ticket[event_id], ticket + 1)
+        conn.close()
+
+waiting_room = WaitingRoom(WAITING_ROOM_ACTIVE, WAITING_ROOM_SESSION, WAITING_ROOM_CLAIM)
+
+async def send_queue_status(bot, user_id: int, event):
+    """پیام جایگاه کاربر در صف انتظار"""
+    position = waiting_room.position(event['id'], user_id)
+    if not waiting_room.is_open(event):
+        opens_at = datetime.fromtimestamp(event['on_sale']).strftime("%Y-%m-%d %H:%M")
+        text = (
+            f"⏳ **فروش {event['title']} هنوز شروع نشده است.**\n\n"
+            f"🕒 شروع فروش: {opens_at}\n"
+            f"🎟 جایگاه شما در صف: {position}\n\n"
+            "با شروع فروش، به ترتیب صف نوبت شما اعلام می‌شود."
+        )
+    else:
+        wait = waiting_room.estimated_wait(event['id'], position)
+        text = (
+            f"⏳ **صف انتظار {event['title']}**\n\n"
+            f"🎟 جایگاه شما در صف: {position}\n"
+            f"⌛ زمان تقریبی انتظار: {max(1, math.ceil(wait / 60))} دقیقه\n\n"
+            "به محض رسیدن نوبت، به شما اطلاع داده می‌شود."
+        )
+    await bot.send_message(
+        chat_id=user_id,
+        text=text,
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton("🔄 وضعیت نوبت", callback_data=f"queue|{event['id']}")
+        ]]),
+        parse_mode='Markdown'
+    )
+
+async def warm_up_event(event_id: int):
+    """آماده‌سازی نقشه‌ها و کیبوردها قبل از شروع فروش تا اولین درخواست‌ها از کش پاسخ بگیرند"""
+    event = event_catalog.get(event_id)
+    if not event:
+        return
+    blocks = get_event_blocks(event)
+    views = [{'kind': 'overview'}] if len(blocks) > 1 else []
+    views += [{'kind': 'block', 'block': index} for index in range(len(blocks))]
+    for view in views:
+        try:
+            await render_live_image(event, view)
+            await build_live_caption(event, view)
+        except ExecutorBusy:
+            await asyncio.sleep(1)
+    event_catalog.render("events")
+    logger.info("کش نقشه‌های اجرای %s قبل از شروع فروش آماده شد (%d نما)", event_id, len(views),
+                extra={"event": event_id})
+
+def schedule_on_sales():
+    """زمان‌بندی آماده‌سازی و باز شدن صف اجراهایی که زمان شروع فروش دارند"""
+    if scheduler is None:
+        return
+    now = time.time()
+    for event in event_catalog.all():
+        on_sale = event.get("on_sale")
+        if not on_sale or on_sale <= now:
+            continue
+        scheduler.add_job(warm_up_event, 'date', args=[event['id']], id=f"warm_up_{event['id']}",
+                          run_date=datetime.fromtimestamp(max(now, on_sale - ON_SALE_WARMUP)),
+                          replace_existing=True)
+        scheduler.add_job(waiting_room.open_gate, 'date', args=[event['id']], id=f"on_sale_{event['id']}",
+                          run_date=datetime.fromtimestamp(on_sale), replace_existing=True)
+
 # ----- دکمه‌های ثابت -----
 def get_persistent_keyboard(user_id):
     keyboard = [
@@ -793,6 +4125,7 @@ def get_persistent_keyboard(user_id):
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
 # ----- استارت -----
+@timed_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
     user_id = user.id
@@ -800,7 +4133,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     first_name = user.first_name or ""
     last_name = user.last_name or ""
     
-    await run_in_thread(save_or_update_user, user_id, username, first_name, last_name)
+    await db_writer.run(save_or_update_user, user_id, username, first_name, last_name)
     
     welcome_text = (
         "🎭 **سلام! به ربات رزرو بلیت خوش آمدید**\n\n"
@@ -827,62 +4160,31 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ----- نمایش لیست اجراها -----
 async def show_events_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """نمایش لیست اجراها با دکمه اینلاین"""
-    user_id = update.message.from_user.id
-    events = config.EVENTS
-    
-    if not events:
-        await update.message.reply_text("📭 هیچ اجرایی در حال حاضر موجود نیست.")
+    if not event_catalog.all():
+        await update.effective_message.reply_text("📭 هیچ اجرایی در حال حاضر موجود نیست.")
         return
     
-    events_text = "🎭 **لیست اجراهای موجود:**\n\n"
-    for i, event in enumerate(events, 1):
-        events_text += f"{i}. **{event['title']}**\n"
-        events_text += f"   📅 {event.get('date', 'تعیین نشده')}\n"
-        events_text += f"   🏷 {event.get('type', 'عمومی')}\n"
-        events_text += f"   💺 {event['rows']} ردیف × {event['cols']} صندلی\n\n"
-    
-    await update.message.reply_text(events_text, parse_mode='Markdown')
-    
-    keyboard = []
-    for event in events:
-        keyboard.append([InlineKeyboardButton(
-            f"🎭 {event['title']}", 
-            callback_data=f"event|{event['id']}"
-        )])
+    events_text, keyboard = event_catalog.render("events")
     
-    await update.message.reply_text(
+    await update.effective_message.reply_text(events_text, parse_mode='Markdown')
+    await update.effective_message.reply_text(
         "لطفاً اجرای مورد نظر را انتخاب کنید:",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=keyboard
     )
 
 # ----- نمایش لیست اجراها برای آمار -----
 async def show_events_for_statistics(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """نمایش لیست اجراها برای انتخاب آمار صندلی‌ها"""
-    user_id = update.message.from_user.id
-    events = config.EVENTS
-    
-    if not events:
+    if not event_catalog.all():
         await update.message.reply_text("📭 هیچ اجرایی در حال حاضر موجود نیست.")
         return
     
-    events_text = "📊 **انتخاب اجرا برای مشاهده آمار صندلی‌ها**\n\n"
-    for i, event in enumerate(events, 1):
-        events_text += f"{i}. **{event['title']}**\n"
-        events_text += f"   📅 {event.get('date', 'تعیین نشده')}\n"
-        events_text += f"   💺 {event['rows']} ردیف × {event['cols']} صندلی\n\n"
+    events_text, keyboard = event_catalog.render("stats")
     
     await update.message.reply_text(events_text, parse_mode='Markdown')
-    
-    keyboard = []
-    for event in events:
-        keyboard.append([InlineKeyboardButton(
-            f"📊 {event['title']}", 
-            callback_data=f"stats|{event['id']}"
-        )])
-    
     await update.message.reply_text(
         "لطفاً اجرای مورد نظر را انتخاب کنید:",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=keyboard
     )
 
 # ----- پشتیبانی -----
@@ -891,11 +4193,11 @@ async def handle_support_request(update: Update, context: ContextTypes.DEFAULT_T
     user_id = update.message.from_user.id
     user = update.message.from_user
     
-    await run_in_thread(save_or_update_user, user_id, user.username or "", 
+    await db_writer.run(save_or_update_user, user_id, user.username or "", 
                        user.first_name or "", user.last_name or "")
     
     support_wait[user_id] = True
-    save_user_state(user_id, "support_wait")
+    await save_user_state(user_id, "support_wait")
     
     await update.message.reply_text(
         "📞 **پشتیبانی**\n\n"
@@ -918,7 +4220,7 @@ async def handle_support_message(update: Update, context: ContextTypes.DEFAULT_T
     
     if text == "❌ لغو":
         support_wait.pop(user_id, None)
-        clear_user_state(user_id)
+        await clear_user_state(user_id)
         await update.message.reply_text(
             "✅ درخواست پشتیبانی لغو شد.",
             reply_markup=get_persistent_keyboard(user_id)
@@ -928,7 +4230,7 @@ async def handle_support_message(update: Update, context: ContextTypes.DEFAULT_T
     if user_id not in support_wait:
         return
     
-    await run_in_thread(save_support_message, user_id, text, "text")
+    await save_support_message(user_id, text, "text")
     
     user = update.message.from_user
     user_info = f"@{user.username}" if user.username else f"{user.first_name or ''} {user.last_name or ''}".strip()
@@ -967,7 +4269,7 @@ async def handle_support_message(update: Update, context: ContextTypes.DEFAULT_T
     )
     
     support_wait.pop(user_id, None)
-    clear_user_state(user_id)
+    await clear_user_state(user_id)
 
 # ----- نمایش پیام‌های پشتیبانی -----
 async def show_support_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -990,7 +4292,8 @@ async def show_support_messages(update: Update, context: ContextTypes.DEFAULT_TY
 async def show_support_messages_page(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int = 0):
     """نمایش صفحه‌بندی شده پیام‌های پشتیبانی"""
     user_id = update.effective_user.id
-    logger.info(f"Showing support messages page {page} for user {user_id}")
+    logger.info("Showing support messages page %s for user %s", page, user_id,
+                extra={"category": "support", "user": user_id})
     
     limit = 5
     offset = page * limit
@@ -1042,6 +4345,7 @@ async def show_support_messages_page(update: Update, context: ContextTypes.DEFAU
         keyboard.append(pagination_buttons)
     
     keyboard.append([InlineKeyboardButton("🔄 به‌روزرسانی", callback_data="refresh_support_messages")])
+    keyboard.append([InlineKeyboardButton("📥 خروجی تاریخچه پشتیبانی (CSV)", callback_data="export|support")])
     
     if hasattr(update, 'message'):
         await update.message.reply_text(
@@ -1065,7 +4369,7 @@ async def show_support_message_detail(update: Update, context: ContextTypes.DEFA
     if not is_admin(user_id):
         return
     
-    conn = sqlite3.connect(DB_FILE)
+    conn = connect_db()
     c = conn.cursor()
     c.execute('''
         SELECT sm.id, sm.user_id, sm.message_text, sm.message_type, sm.created_at, 
@@ -1111,15 +4415,16 @@ async def show_support_message_detail(update: Update, context: ContextTypes.DEFA
     )
 
 # ----- هندلر اصلی برای تمام پیام‌های متنی -----
+@timed_handler
 async def handle_all_text_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """مدیریت همه پیام‌های متنی به صورت متمرکز"""
     user = update.message.from_user
     user_id = user.id
     text = update.message.text.strip()
     
-    logger.info(f"پیام متنی دریافت شد از {user_id}: {text}")
+    logger.info("پیام متنی دریافت شد از %s: %s", user_id, text, extra={"category": "message", "user": user_id})
     
-    await run_in_thread(save_or_update_user, user_id, user.username or "", 
+    await db_writer.run(save_or_update_user, user_id, user.username or "", 
                        user.first_name or "", user.last_name or "")
     
     state_type, state_data = get_user_state(user_id)
@@ -1149,6 +4454,11 @@ async def handle_all_text_messages(update: Update, context: ContextTypes.DEFAULT
         await handle_admin_reply(update, context)
         return
     
+    elif state_type == "admin_event_wait":
+        admin_event_wait[user_id] = True
+        await handle_admin_event_input(update, context)
+        return
+    
     if user_id in admin_price_wait:
         await handle_admin_price_input(update, context)
         return
@@ -1169,11 +4479,15 @@ async def handle_all_text_messages(update: Update, context: ContextTypes.DEFAULT
         await handle_admin_reply(update, context)
         return
     
-    if text in ["📅 دیدن اجراها", "📊 آمار صندلی‌ها", "❓ راهنما", "🛠 پنل مدیریت", "📞 ارتباط با پشتیبانی"]:
+    if user_id in admin_event_wait:
+        await handle_admin_event_input(update, context)
+        return
+    
+    if text in MAIN_MENU_BUTTONS:
         await handle_main_buttons(update, context)
         return
     
-    if text in ["👥 مدیریت ادمین‌ها", "💰 گزارش مالی", "🎯 مدیریت قیمت صندلی‌ها", "📊 آمار لحظه‌ای", "👤 لیست کاربران", "📞 پیام‌های پشتیبانی", "🔙 بازگشت"]:
+    if text in ADMIN_MENU_BUTTONS:
         await handle_admin_buttons(update, context)
         return
     
@@ -1185,7 +4499,8 @@ async def handle_main_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE
     text = update.message.text
     user_id = update.message.from_user.id
     
-    logger.info(f"دکمه فشرده شده: {text} توسط کاربر: {user_id}")
+    logger.info("دکمه فشرده شده: %s توسط کاربر: %s", text, user_id,
+                extra={"category": "message", "user": user_id, "action": text})
     
     if text == "📅 دیدن اجراها":
         await show_events_list(update, context)
@@ -1231,10 +4546,10 @@ async def show_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     keyboard = [
         [KeyboardButton("👥 مدیریت ادمین‌ها"), KeyboardButton("💰 گزارش مالی")],
-        [KeyboardButton("🎯 مدیریت قیمت صندلی‌ها")],
+        [KeyboardButton("🎯 مدیریت قیمت صندلی‌ها"), KeyboardButton("🎭 مدیریت اجراها")],
         [KeyboardButton("📊 آمار لحظه‌ای")],
         [KeyboardButton("👤 لیست کاربران")],
-        [KeyboardButton("📞 پیام‌های پشتیبانی")],
+        [KeyboardButton("📞 پیام‌های پشتیبانی"), KeyboardButton("🧾 صف ارسال بلیت")],
         [KeyboardButton("🔙 بازگشت")]
     ]
     await update.message.reply_text(
@@ -1285,7 +4600,8 @@ async def show_users_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     keyboard = [
         [InlineKeyboardButton("🔄 به‌روزرسانی", callback_data="refresh_users")],
-        [InlineKeyboardButton("📊 آمار کامل", callback_data="users_stats")]
+        [InlineKeyboardButton("📊 آمار کامل", callback_data="users_stats")],
+        [InlineKeyboardButton("📥 خروجی همه کاربران (CSV)", callback_data="export|users")]
     ]
     
     await update.message.reply_text(
@@ -1297,26 +4613,16 @@ async def show_users_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ----- نمایش آمار کاربران -----
 async def show_users_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """نمایش آمار کامل کاربران"""
-    user_id = update.message.from_user.id
+    user_id = update.effective_user.id
     
     if not is_admin(user_id):
-        await update.message.reply_text("❌ دسترسی denied.")
+        await update.effective_message.reply_text("❌ دسترسی denied.")
         return
     
-    total_users = await run_in_thread(get_users_count)
-    
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    
-    today_start = int(datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
-    c.execute('SELECT COUNT(*) FROM users WHERE joined_at >= ?', (today_start,))
-    today_users = c.fetchone()[0]
-    
-    day_ago = int(time.time()) - 86400
-    c.execute('SELECT COUNT(*) FROM users WHERE last_activity >= ?', (day_ago,))
-    active_users = c.fetchone()[0]
-    
-    conn.close()
+    stats = await get_users_stats()
+    total_users = stats["total"]
+    today_users = stats["today"]
+    active_users = stats["active"]
     
     stats_text = (
         "📊 **آمار کامل کاربران**\n\n"
@@ -1334,7 +4640,7 @@ async def show_users_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("🔄 به‌روزرسانی", callback_data="refresh_users_stats")]
     ]
     
-    await update.message.reply_text(
+    await update.effective_message.reply_text(
         stats_text,
         reply_markup=InlineKeyboardMarkup(keyboard),
         parse_mode='Markdown'
@@ -1371,67 +4677,375 @@ async def handle_admin_buttons(update: Update, context: ContextTypes.DEFAULT_TYP
             report_text += f"⏳ {event['stats']['reserved']} - "
             report_text += f"🆓 {event['stats']['free']}\n"
         
-        await update.message.reply_text(report_text, parse_mode='Markdown')
+        keyboard = [[InlineKeyboardButton("📥 خروجی همه فروش‌ها (CSV)", callback_data="export|sales")]]
+        await update.message.reply_text(report_text, reply_markup=InlineKeyboardMarkup(keyboard),
+                                        parse_mode='Markdown')
+    
+    elif text == "🎯 مدیریت قیمت صندلی‌ها":
+        _, keyboard = event_catalog.render("price")
+        
+        await update.message.reply_text(
+            "🎯 **مدیریت قیمت صندلی‌ها**\n\nلطفاً اجرای مورد نظر را انتخاب کنید:",
+            reply_markup=keyboard,
+            parse_mode='Markdown'
+        )
+    
+    elif text == "🎭 مدیریت اجراها":
+        await manage_events(update, context)
+    
+    elif text == "📊 آمار لحظه‌ای":
+        for ev in event_catalog.all():
+            await send_live_map(context.bot, user_id, ev, {'kind': 'admin_map'})
+    
+    elif text == "👤 لیست کاربران":
+        await show_users_list(update, context)
+    
+    elif text == "📞 پیام‌های پشتیبانی":
+        await show_support_messages(update, context)
+    
+    elif text == "🧾 صف ارسال بلیت":
+        await show_job_queue(update.message)
+    
+    elif text == "🔙 بازگشت":
+        await update.message.reply_text(
+            "بازگشت به منوی اصلی:",
+            reply_markup=get_persistent_keyboard(user_id)
+        )
+
+# ----- صف ارسال بلیت -----
+async def show_job_queue(message):
+    """نمایش وضعیت صف کارها و کارهای ناموفق برای ادمین"""
+    counts = await run_in_thread(get_job_counts)
+    dead_jobs = await run_in_thread(get_dead_jobs, 10)
+    
+    text = (
+        "🧾 **صف ارسال بلیت**\n\n"
+        f"⏳ در انتظار: {counts.get('pending', 0)}\n"
+        f"⚙️ در حال اجرا: {counts.get('running', 0)}\n"
+        f"✅ انجام شده: {counts.get('done', 0)}\n"
+        f"☠️ ناموفق: {counts.get('dead', 0)}\n"
+    )
+    
+    keyboard = []
+    if dead_jobs:
+        text += "\n**آخرین کارهای ناموفق:**\n"
+        for job_id, kind, payload, attempts, last_error, updated_at in dead_jobs:
+            time_str = datetime.fromtimestamp(updated_at).strftime("%Y/%m/%d %H:%M")
+            text += f"• #{job_id} {kind} ({attempts} تلاش) - {time_str}\n  `{(last_error or '')[:80]}`\n"
+            keyboard.append([InlineKeyboardButton(f"🔁 تلاش مجدد #{job_id}", callback_data=f"admin_job_retry|{job_id}")])
+    
+    keyboard.append([InlineKeyboardButton("🔄 به‌روزرسانی", callback_data="admin_jobs")])
+    
+    await message.reply_text(
+        text,
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode='Markdown'
+    )
+
+# ----- مدیریت ادمین‌ها -----
+async def manage_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """مدیریت ادمین‌ها"""
+    user_id = update.message.from_user.id
+    
+    admins = get_all_admins()
+    admin_list = "👥 **لیست ادمین‌ها:**\n\n"
+    for admin_id, username, added_at in admins:
+        date_str = datetime.fromtimestamp(added_at).strftime("%Y/%m/%d")
+        admin_list += f"• @{username or 'بدون نام'} (ID: `{admin_id}`) - {date_str}\n"
+    
+    keyboard = [
+        [InlineKeyboardButton("➕ افزودن ادمین", callback_data="admin_add")],
+        [InlineKeyboardButton("➖ حذف ادمین", callback_data="admin_remove")],
+        [InlineKeyboardButton("🔙 بازگشت", callback_data="admin_back")]
+    ]
+    
+    await update.message.reply_text(
+        admin_list,
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode='Markdown'
+    )
+
+# ----- مدیریت اجراها -----
+async def manage_events(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """نمایش اجراها و درخواست تعریف JSON برای افزودن/ویرایش"""
+    user_id = update.message.from_user.id
+    
+    events_list = "🎭 **اجراهای فعلی:**\n\n"
+    for event in event_catalog.all():
+        events_list += f"• `{event['id']}` - {event['title']} ({event['rows']}×{event['cols']})\n"
+    
+    admin_event_wait[user_id] = True
+    await save_user_state(user_id, "admin_event_wait")
+    
+    await update.message.reply_text(
+        f"{events_list}\n"
+        "برای افزودن یا ویرایش اجرا، تعریف آن را به صورت JSON ارسال کنید.\n"
+        "برای ویرایش فقط id و فیلدهای تغییر کرده کافی است.\n\n"
+        "مثال:\n"
+        "`{\"id\": 3, \"title\": \"کنسرت\", \"date\": \"1402/11/01\", \"rows\": 10, \"cols\": 12, \"prices\": {\"1\": 250000}}`\n\n"
+        "❌ برای لغو «لغو» را ارسال کنید.",
+        parse_mode='Markdown'
+    )
+
+async def handle_admin_event_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ثبت تعریف اجرای ارسال شده توسط ادمین"""
+    user_id = update.message.from_user.id
+    text = update.message.text.strip()
+    
+    if text in ("لغو", "❌ لغو", "🔙 بازگشت"):
+        admin_event_wait.pop(user_id, None)
+        await clear_user_state(user_id)
+        await show_admin_panel(update, context)
+        return
+    
+    try:
+        ev = parse_event_definition(text)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}")
+        return
+    
+    status = await run_in_thread(event_catalog.save, ev, workload="admin")
+    schedule_on_sales()
+    
+    admin_event_wait.pop(user_id, None)
+    await clear_user_state(user_id)
+    
+    action = "اضافه شد" if status == "created" else "به‌روزرسانی شد"
+    await update.message.reply_text(f"✅ اجرای **{ev['title']}** {action}.", parse_mode='Markdown')
+    await show_admin_panel(update, context)
+
+async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """وضعیت داخلی ربات برای ادمین (/status)"""
+    user_id = update.message.from_user.id
+    if not is_admin(user_id):
+        return
+    
+    text = "⚙️ **وضعیت ربات**\n\n✍️ **تغییر صندلی‌ها (بیشترین رقابت):**\n"
+    rows = seat_writes.snapshot()[:10]
+    if not rows:
+        text += "هنوز تغییری ثبت نشده است.\n"
+    for row in rows:
+        event = event_catalog.get(row['event_id'])
+        title = event['title'] if event else row['event_id']
+        text += (
+            f"• {title}: {row['writes']} تغییر، {row['contended']} هم‌زمان با تغییر دیگر، "
+            f"در صف نویسنده {row['in_flight']} (حداکثر {row['in_flight_max']})، "
+            f"انتظار میانگین {row['wait_avg_ms']:.1f}ms / حداکثر {row['wait_max_ms']:.1f}ms\n"
+        )
     
-    elif text == "🎯 مدیریت قیمت صندلی‌ها":
-        keyboard = []
-        for event in config.EVENTS:
-            keyboard.append([InlineKeyboardButton(
-                f"💰 {event['title']}", 
-                callback_data=f"admin_price_event|{event['id']}"
-            )])
-        
-        await update.message.reply_text(
-            "🎯 **مدیریت قیمت صندلی‌ها**\n\nلطفاً اجرای مورد نظر را انتخاب کنید:",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='Markdown'
+    
+    text += (
+        f"\n🚦 **کنترل بار:** سطح {overload.level()} | تأخیر میانگین {overload.latency() * 1000:.0f}ms\n"
+        f"• نقشه کش شده: {overload.degraded['stale_image']} | فقط متن: {overload.degraded['text_only']} "
+        f"| رد شده: {overload.degraded['shed']}\n"
+    )
+    text += (
+        f"\n🛡 **محافظ ارسال:** {flood_guard.tracked_users()} کاربر فعال | "
+        f"تکراری: {flood_guard.dropped['debounce']} | "
+        + " | ".join(f"{action}: {flood_guard.dropped[action]}" for action in FLOOD_LIMITS)
+        + "\n"
+    )
+    shared_total = sum(single_flight.shared.values())
+    started_total = sum(single_flight.started.values())
+    text += f"\n🔁 **ادغام درخواست‌ها:** {started_total} اجرا، {shared_total} درخواست مشترک\n"
+    for event_id in waiting_room.event_ids():
+        active, queued = waiting_room.stats(event_id)
+        if queued:
+            text += f"🎟 صف اجرای {event_id}: {active} در حال انتخاب، {queued} در صف\n"
+    text += "\n🧵 **استخرهای ترد:**\n"
+    for pool in executors.values():
+        stats = pool.snapshot()
+        text += (
+            f"• {stats['name']}: {stats['running']}/{stats['workers']} در حال اجرا، "
+            f"صف {stats['queued']}/{stats['max_queue']}، رد شده {stats['rejected']}، "
+            f"انتظار میانگین {stats['wait_avg_ms']:.1f}ms / حداکثر {stats['wait_max_ms']:.1f}ms\n"
         )
     
-    elif text == "📊 آمار لحظه‌ای":
-        for ev in config.EVENTS:
-            path = await generate_seat_map_image(ev["id"])
-            with open(path, "rb") as photo:
-                await context.bot.send_photo(
-                    chat_id=user_id, 
-                    photo=photo, 
-                    caption=f"📊 نقشه صندلی {ev['title']}"
-                )
+    avg_batch = db_writer.writes / db_writer.batches if db_writer.batches else 0
+    avg_commit = db_writer.commit_time_total / db_writer.batches * 1000 if db_writer.batches else 0
+    text += (
+        f"\n💾 **نویسنده دیتابیس:**\n"
+        f"• {db_writer.writes} نوشتن در {db_writer.batches} تراکنش "
+        f"(میانگین {avg_batch:.1f}، حداکثر {db_writer.max_batch})\n"
+        f"• میانگین زمان commit: {avg_commit:.1f}ms | در صف: {db_writer.pending()}\n"
+    )
+    sampled = sum(log_sampler.dropped.values())
+    text += (
+        f"\n📝 **لاگ:** در صف {log_handler.queue.qsize()} | دور ریخته (صف پر) {log_handler.dropped} | "
+        f"حذف با نمونه‌برداری {sampled}\n"
+    )
+    if tracer.path:
+        text += (
+            f"\n🔎 **ردگیری:** نمونه {tracer.sample_rate:.0%} + کندتر از {tracer.slow:.0f}s | "
+            f"{tracer.written} ثبت شده، {tracer.dropped} از دست رفته\n"
+        )
     
-    elif text == "👤 لیست کاربران":
-        await show_users_list(update, context)
+    await update.message.reply_text(text, parse_mode='Markdown')
+
+async def metrics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """خلاصه متریک‌ها برای ادمین (/metrics)؛ خروجی کامل روی METRICS_PORT"""
+    user_id = update.message.from_user.id
+    if not is_admin(user_id):
+        return
     
-    elif text == "📞 پیام‌های پشتیبانی":
-        await show_support_messages(update, context)
+    def rows(name: str, label: str, limit: int):
+        """(مقدار برچسب، تعداد، p50، p95، مجموع زمان) به ترتیب بیشترین زمان کل"""
+        result = []
+        for key, (counts, total, count) in metrics.histograms(name).items():
+            labels = dict(key)
+            title = labels[label]
+            if labels.get("action", "-") != "-":
+                title = f"{title}:{labels['action']}"
+            result.append((title, count, metrics.quantile(counts, 0.5), metrics.quantile(counts, 0.95), total))
+        result.sort(key=lambda row: row[4], reverse=True)
+        return result[:limit]
+    
+    def section(title: str, name: str, label: str, limit: int = 8) -> str:
+        lines = [f"\n{title}"]
+        for value, count, p50, p95, _ in rows(name, label, limit):
+            lines.append(f"• {value}: {count}× p50 {p50 * 1000:.0f}ms p95 {p95 * 1000:.0f}ms")
+        if len(lines) == 1:
+            lines.append("• هنوز داده‌ای ثبت نشده است.")
+        return "\n".join(lines) + "\n"
+    
+    text = "📈 متریک‌ها (از زمان راه‌اندازی)\n"
+    text += section("⏱ هندلرها:", "handler_seconds", "handler")
+    text += section("💾 دیتابیس (بیشترین زمان کل):", "db_seconds", "query")
+    text += section("🖼 رندر:", "render_seconds", "renderer")
+    text += section("📡 Bot API:", "bot_api_seconds", "method", limit=6)
+    
+    responses = metrics.counters("bot_api_responses_total")
+    total_calls = sum(responses.values())
+    limited = sum(value for key, value in responses.items() if dict(key)["status"] == "429")
+    failed = sum(value for key, value in responses.items() if not dict(key)["status"].startswith("2"))
+    text += f"• کل: {total_calls:.0f} فراخوانی، 429: {limited:.0f}، ناموفق: {failed:.0f}\n"
+    
+    caches = Counter()
+    for key, value in metrics.counters("cache_requests_total").items():
+        labels = dict(key)
+        caches[(labels["cache"], labels["result"])] += value
+    text += "\n🗂 نرخ برخورد کش:\n"
+    for cache in sorted({cache for cache, _ in caches}):
+        hits, misses = caches[(cache, "hit")], caches[(cache, "miss")]
+        text += f"• {cache}: {hits / (hits + misses):.0%} از {hits + misses:.0f}\n"
+    
+    text += "\n🧵 صف استخرها: " + "، ".join(
+        f"{name} {pool.queue_depth()}" for name, pool in executors.items()
+    ) + f" | نویسنده دیتابیس {db_writer.pending()}\n"
+    if METRICS_PORT:
+        text += f"\n🔗 خروجی Prometheus: http://127.0.0.1:{METRICS_PORT}/metrics"
+    
+    # نام‌ها زیرخط دارند؛ بدون Markdown فرستاده می‌شود
+    await update.message.reply_text(text)
+
+async def memory_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """گزارش حافظه (/memory)؛ /memory start و /memory stop ردگیری tracemalloc را روشن و خاموش می‌کنند"""
+    user_id = update.message.from_user.id
+    if not is_admin(user_id):
+        return
     
-    elif text == "🔙 بازگشت":
-        await update.message.reply_text(
-            "بازگشت به منوی اصلی:",
-            reply_markup=get_persistent_keyboard(user_id)
-        )
+    action = context.args[0] if context.args else ""
+    if action == "start":
+        memory_monitor.start_tracing(MEMORY_TRACEMALLOC or 1)
+        await memory_monitor.check()
+        await update.message.reply_text("✅ tracemalloc فعال شد؛ رشد تخصیص‌ها از بررسی بعدی گزارش می‌شود.")
+        return
+    if action == "stop":
+        memory_monitor.stop_tracing()
+        await update.message.reply_text("✅ tracemalloc غیرفعال شد.")
+        return
+    
+    await memory_monitor.check()
+    # نام‌ها زیرخط دارند؛ بدون Markdown فرستاده می‌شود
+    await update.message.reply_text("🧠 حافظه\n\n" + memory_monitor.report())
 
-# ----- مدیریت ادمین‌ها -----
-async def manage_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """مدیریت ادمین‌ها"""
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """خروجی فایل فروش، کاربران یا پیام‌های پشتیبانی (/export sales|users|support [xlsx])"""
     user_id = update.message.from_user.id
+    if not is_admin(user_id):
+        return
     
-    admins = get_all_admins()
-    admin_list = "👥 **لیست ادمین‌ها:**\n\n"
-    for admin_id, username, added_at in admins:
-        date_str = datetime.fromtimestamp(added_at).strftime("%Y/%m/%d")
-        admin_list += f"• @{username or 'بدون نام'} (ID: `{admin_id}`) - {date_str}\n"
+    kind = context.args[0] if context.args else ""
+    if kind not in EXPORTS:
+        await update.message.reply_text("❌ استفاده: /export sales|users|support [xlsx]")
+        return
+    fmt = "xlsx" if len(context.args) > 1 and context.args[1].lower() == "xlsx" else "csv"
+    context.application.create_task(run_export(update.message, kind, fmt))
+
+async def slowsql_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """دستورهای SQL با بیشترین زمان کل (/slowsql [تعداد])؛ /slowsql reset آمار را صفر می‌کند"""
+    user_id = update.message.from_user.id
+    if not is_admin(user_id):
+        return
     
-    keyboard = [
-        [InlineKeyboardButton("➕ افزودن ادمین", callback_data="admin_add")],
-        [InlineKeyboardButton("➖ حذف ادمین", callback_data="admin_remove")],
-        [InlineKeyboardButton("🔙 بازگشت", callback_data="admin_back")]
-    ]
+    if context.args and context.args[0] == "reset":
+        sql_profiler.reset()
+        await update.message.reply_text("✅ آمار کوئری‌ها صفر شد.")
+        return
+    limit = int(context.args[0]) if context.args and context.args[0].isdigit() else 10
     
-    await update.message.reply_text(
-        admin_list,
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode='Markdown'
+    rows = sql_profiler.top(limit)
+    if not rows:
+        await update.message.reply_text("هنوز کوئری‌ای ثبت نشده است.")
+        return
+    text = f"🐢 کوئری‌ها با بیشترین زمان کل (آستانه کند: {sql_profiler.threshold * 1000:.0f}ms)\n"
+    for rank, (fingerprint, stats) in enumerate(rows, 1):
+        text += (
+            f"\n{rank}. {stats['count']}× | کل {stats['total'] * 1000:.0f}ms | "
+            f"میانگین {stats['total'] / stats['count'] * 1000:.1f}ms | p99 {stats['p99'] * 1000:.1f}ms | "
+            f"حداکثر {stats['max'] * 1000:.1f}ms | کند {stats['slow']}\n"
+            f"{fingerprint[:300]}\n"
+            f"پارامترها: {stats['params']}\n"
+        )
+        if stats["plan"] and rank <= 3:
+            text += f"plan:\n{stats['plan']}\n"
+    # متن SQL علامت‌های Markdown دارد؛ بدون parse_mode و در سقف طول پیام تلگرام
+    await update.message.reply_text(text[:4000])
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """پروفایل CPU ربات در حال اجرا برای چند ثانیه و ارسال گزارش به صورت فایل (/profile [ثانیه])"""
+    user_id = update.message.from_user.id
+    if not is_admin(user_id):
+        return
+    
+    seconds = PROFILE_DEFAULT_SECONDS
+    if context.args:
+        try:
+            seconds = float(context.args[0])
+        except ValueError:
+            await update.message.reply_text("❌ استفاده: /profile [ثانیه]")
+            return
+    seconds = min(max(seconds, 1), PROFILE_MAX_SECONDS)
+    
+    try:
+        future = profiler.start(seconds)
+    except RuntimeError:
+        await update.message.reply_text("⏳ یک پروفایل دیگر در حال اجراست.")
+        return
+    await update.message.reply_text(f"🔬 نمونه‌برداری CPU به مدت {seconds:.0f} ثانیه شروع شد...")
+    report = await asyncio.wrap_future(future)
+    
+    if slow_handlers.recent:
+        report += f"\nslow handlers (over {slow_handlers.threshold:.1f}s), most recent last:\n"
+        for capture in slow_handlers.recent:
+            report += f"\n{capture['at']:%H:%M:%S} " + slow_handlers.format(capture) + "\n"
+    
+    await update.message.reply_document(
+        document=report.encode(),
+        filename=f"profile_{datetime.now():%Y%m%d_%H%M%S}.txt",
+        caption=f"🔬 پروفایل {seconds:.0f} ثانیه‌ای | هندلرهای کند اخیر: {len(slow_handlers.recent)}"
     )
 
+async def reload_events_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """بارگذاری مجدد کاتالوگ اجراها از دیتابیس (/reload_events)"""
+    user_id = update.message.from_user.id
+    if not is_admin(user_id):
+        return
+    
+    await run_in_thread(event_catalog.load, workload="admin")
+    schedule_on_sales()
+    await update.message.reply_text(f"✅ {len(event_catalog.all())} اجرا از دیتابیس بارگذاری شد.")
+
 # ----- توابع مدیریت ادمین -----
 async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """مدیریت callback های ادمین"""
@@ -1447,7 +5061,7 @@ async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TY
     
     if data == "admin_add":
         admin_add_wait[user_id] = True
-        save_user_state(user_id, "admin_add_wait")
+        await save_user_state(user_id, "admin_add_wait")
         await query.message.reply_text(
             "👤 لطفاً آیدی عددی کاربر مورد نظر را برای افزودن به ادمین‌ها ارسال کنید:\n\n"
             "⚠️ توجه: کاربر باید قبلاً با ربات استارت کرده باشد."
@@ -1455,7 +5069,7 @@ async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TY
     
     elif data == "admin_remove":
         admin_remove_wait[user_id] = True
-        save_user_state(user_id, "admin_remove_wait")
+        await save_user_state(user_id, "admin_remove_wait")
         admins = get_all_admins()
         admin_list = "👥 **لیست ادمین‌ها برای حذف:**\n\n"
         for admin_id, username, _ in admins:
@@ -1470,17 +5084,38 @@ async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TY
     elif data == "admin_back":
         await show_admin_panel_from_callback(update, context)
     
+    elif data == "admin_jobs":
+        await show_job_queue(query.message)
+    
+    elif data.startswith("admin_job_retry|"):
+        job_id = int(data.split("|")[1])
+        if await db_writer.run(retry_dead_job, job_id):
+            wake_job_workers()
+            await query.message.reply_text(f"🔁 کار #{job_id} دوباره در صف قرار گرفت.")
+        else:
+            await query.message.reply_text("❌ کار یافت نشد یا قبلاً در صف است.")
+    
     elif data.startswith("admin_price_event|"):
         event_id = int(data.split("|")[1])
         await show_seat_selection_for_price(update, context, event_id)
 
+    elif data.startswith("admin_price_block|"):
+        parts = data.split("|")
+        await show_seat_selection_for_price(update, context, int(parts[1]), int(parts[2]))
+
+    elif data.startswith("admin_price_page|"):
+        parts = data.split("|")
+        event = event_catalog.get(int(parts[1]))
+        if event:
+            await update_seat_keyboard_page(query, event, int(parts[2]), int(parts[3]), mode="price")
+
     elif data.startswith("admin_price_seat|"):
         parts = data.split("|")
         event_id = int(parts[1])
         seat_id = parts[2]
         
         admin_price_wait[user_id] = (event_id, seat_id)
-        save_user_state(user_id, "admin_price_wait", str((event_id, seat_id)))
+        await save_user_state(user_id, "admin_price_wait", str((event_id, seat_id)))
         await query.message.reply_text(
             f"💵 لطفاً قیمت جدید برای صندلی {seat_id} را (فقط عدد) ارسال کنید:\n\n"
             "مثال: 150000"
@@ -1504,9 +5139,9 @@ async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TY
         target_user_id = int(data.split("|")[1])
         
         admin_reply_wait[user_id] = target_user_id
-        save_user_state(user_id, "admin_reply_wait", str(target_user_id))
+        await save_user_state(user_id, "admin_reply_wait", str(target_user_id))
         
-        conn = sqlite3.connect(DB_FILE)
+        conn = connect_db()
         c = conn.cursor()
         c.execute('SELECT username, first_name, last_name FROM users WHERE user_id=?', (target_user_id,))
         user_info = c.fetchone()
@@ -1540,7 +5175,7 @@ async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TY
         
         if len(parts) > 2:
             message_id = int(parts[2])
-            await run_in_thread(delete_support_message, message_id)
+            await delete_support_message(message_id)
             await query.message.edit_text("✅ پیام پشتیبانی حذف شد.")
         else:
             try:
@@ -1561,10 +5196,10 @@ async def show_admin_panel_from_callback(update: Update, context: ContextTypes.D
     
     keyboard = [
         [KeyboardButton("👥 مدیریت ادمین‌ها"), KeyboardButton("💰 گزارش مالی")],
-        [KeyboardButton("🎯 مدیریت قیمت صندلی‌ها")],
+        [KeyboardButton("🎯 مدیریت قیمت صندلی‌ها"), KeyboardButton("🎭 مدیریت اجراها")],
         [KeyboardButton("📊 آمار لحظه‌ای")],
         [KeyboardButton("👤 لیست کاربران")],
-        [KeyboardButton("📞 پیام‌های پشتیبانی")],
+        [KeyboardButton("📞 پیام‌های پشتیبانی"), KeyboardButton("🧾 صف ارسال بلیت")],
         [KeyboardButton("🔙 بازگشت")]
     ]
     
@@ -1582,7 +5217,7 @@ async def show_user_support_history(update: Update, context: ContextTypes.DEFAUL
     if not is_admin(user_id):
         return
     
-    conn = sqlite3.connect(DB_FILE)
+    conn = connect_db()
     c = conn.cursor()
     
     c.execute('SELECT username, first_name, last_name FROM users WHERE user_id=?', (target_user_id,))
@@ -1648,12 +5283,12 @@ async def handle_admin_add_input(update: Update, context: ContextTypes.DEFAULT_T
             user = await context.bot.get_chat(new_admin_id)
             username = user.username or f"user_{new_admin_id}"
             
-            if add_admin(new_admin_id, user_id, username):
+            if await add_admin(new_admin_id, user_id, username):
                 await update.message.reply_text(
                     f"✅ کاربر @{username} (آیدی: `{new_admin_id}`) با موفقیت به ادمین‌ها اضافه شد."
                 )
                 admin_add_wait.pop(user_id, None)
-                clear_user_state(user_id)
+                await clear_user_state(user_id)
                 await show_admin_panel(update, context)
             else:
                 await update.message.reply_text("❌ خطا در اضافه کردن ادمین.")
@@ -1674,10 +5309,10 @@ async def handle_admin_remove_input(update: Update, context: ContextTypes.DEFAUL
         remove_admin_id = int(text)
         if remove_admin_id == config.ADMIN_CHAT_ID:
             await update.message.reply_text("❌ نمی‌توانید ادمین اصلی را حذف کنید.")
-        elif remove_admin(remove_admin_id):
+        elif await remove_admin(remove_admin_id):
             await update.message.reply_text(f"✅ ادمین با آیدی `{remove_admin_id}` حذف شد.")
             admin_remove_wait.pop(user_id, None)
-            clear_user_state(user_id)
+            await clear_user_state(user_id)
             await show_admin_panel(update, context)
         else:
             await update.message.reply_text("❌ خطا در حذف ادمین یا کاربر یافت نشد.")
@@ -1714,16 +5349,12 @@ async def handle_admin_price_input(update: Update, context: ContextTypes.DEFAULT
         await update.message.reply_text("❌ لطفاً یک عدد معتبر وارد کنید (مثال: 150000).")
         return
     
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("UPDATE seats SET price=? WHERE event_id=? AND seat_id=?", (price, event_id, seat_id))
-    conn.commit()
-    conn.close()
+    await set_seat_price(event_id, seat_id, price)
     
     del admin_price_wait[user_id]
-    clear_user_state(user_id)
+    await clear_user_state(user_id)
     
-    event = next((ev for ev in config.EVENTS if ev["id"] == event_id), None)
+    event = event_catalog.get(event_id)
     event_name = event['title'] if event else f"رویداد {event_id}"
     
     await update.message.reply_text(
@@ -1733,41 +5364,39 @@ async def handle_admin_price_input(update: Update, context: ContextTypes.DEFAULT
     
     await show_admin_panel(update, context)
 
-async def show_seat_selection_for_price(update: Update, context: ContextTypes.DEFAULT_TYPE, event_id: int):
+async def show_seat_selection_for_price(update: Update, context: ContextTypes.DEFAULT_TYPE, event_id: int, block_index: int = None):
     """نمایش صندلی‌ها برای تغییر قیمت"""
     query = update.callback_query
     user_id = query.from_user.id
     
-    seats = await get_seats(event_id)
-    
-    event = next((ev for ev in config.EVENTS if ev["id"] == event_id), None)
+    event = event_catalog.get(event_id)
     if not event:
         await query.message.reply_text("❌ رویداد یافت نشد.")
         return
     
-    keyboard = []
-    current_row = []
+    blocks = get_event_blocks(event)
     
-    for seat_id, r, c, status, _, price in seats:
-        seat_label = f"{r}-{c}"
-        current_row.append(InlineKeyboardButton(
-            seat_label, 
-            callback_data=f"admin_price_seat|{event_id}|{seat_id}"
-        ))
-        
-        if len(current_row) >= 5:
-            keyboard.append(current_row)
-            current_row = []
+    if block_index is None and len(blocks) > 1:
+        summary = await get_block_summary(event)
+        await query.message.reply_text(
+            f"💵 **مدیریت قیمت - {event['title']}**\n\n"
+            "لطفاً بلوک مورد نظر را انتخاب کنید:",
+            reply_markup=build_block_keyboard(event, summary, "admin_price_block", "admin_back"),
+            parse_mode='Markdown'
+        )
+        return
     
-    if current_row:
-        keyboard.append(current_row)
+    block_index = block_index or 0
+    if not 0 <= block_index < len(blocks):
+        await query.message.reply_text("❌ بلوک یافت نشد.")
+        return
     
-    keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data="admin_back")])
+    seats = await get_block_seats(event_id, blocks[block_index])
     
     await query.message.reply_text(
         f"💵 **مدیریت قیمت - {event['title']}**\n\n"
         "لطفاً صندلی مورد نظر برای تغییر قیمت را انتخاب کنید:",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=build_seat_keyboard(event, block_index, seats, mode="price"),
         parse_mode='Markdown'
     )
 
@@ -1821,18 +5450,24 @@ async def handle_admin_reply(update: Update, context: ContextTypes.DEFAULT_TYPE)
         logger.error(f"خطا در ارسال پاسخ ادمین به کاربر {target_user_id}: {e}")
     
     admin_reply_wait.pop(user_id, None)
-    clear_user_state(user_id)
+    await clear_user_state(user_id)
     
     await show_admin_panel(update, context)
 
 # ----- Callback Router اصلی -----
 async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
     data = query.data
+    if overload.should_shed(data):
+        await query.answer("⏳ سرور شلوغ است، چند ثانیه دیگر دوباره تلاش کنید.")
+        return
+    await query.answer()
     user_id = query.from_user.id
 
-    logger.info(f"Callback received: {data} from user: {user_id}")
+    logger.info("Callback received: %s from user: %s", data, user_id,
+                extra={"category": "callback", "user": user_id, "action": data.split("|", 1)[0]})
+    started = time.perf_counter()
+    slow_id = slow_handlers.begin(f"callback_router:{data.split('|', 1)[0]}")
 
     try:
         # هندلرهای پشتیبانی - اولویت اول
@@ -1847,125 +5482,91 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         elif data.startswith("stats|"):
             event_id = int(data.split("|")[1])
-            path = await generate_seat_map_image(event_id)
             
-            event = next((ev for ev in config.EVENTS if ev["id"] == event_id), None)
+            event = event_catalog.get(event_id)
             if not event:
                 await context.bot.send_message(chat_id=user_id, text="❌ رویداد یافت نشد.")
                 return
             
-            seats = await get_seats(event_id)
-            total_seats = len(seats)
-            free_seats = len([s for s in seats if s[3] == 'free'])
-            reserved_seats = len([s for s in seats if s[3] == 'reserved'])
-            sold_seats = len([s for s in seats if s[3] == 'sold'])
-            
-            stats_text = (
-                f"📊 **آمار صندلی‌ها - {event['title']}**\n\n"
-                f"🎫 **کل صندلی‌ها:** {total_seats}\n"
-                f"🟢 **آزاد:** {free_seats}\n"
-                f"🟡 **رزرو شده:** {reserved_seats}\n"
-                f"🔴 **فروخته شده:** {sold_seats}\n"
-                f"📈 **پرشدگی:** {((sold_seats + reserved_seats) / total_seats * 100):.1f}%"
-            )
-            
             try:
-                with open(path, "rb") as photo:
-                    await context.bot.send_photo(
-                        chat_id=user_id,
-                        photo=photo,
-                        caption=stats_text,
-                        parse_mode='Markdown'
-                    )
+                await send_live_map(context.bot, user_id, event, {'kind': 'stats'})
             except Exception as e:
                 await context.bot.send_message(
                     chat_id=user_id,
-                    text=f"📊 **آمار صندلی‌ها - {event['title']}**\n\n{stats_text}",
+                    text=build_stats_caption(event),
                     parse_mode='Markdown'
                 )
 
         elif data.startswith("map|"):
             event_id = int(data.split("|")[1])
-            path = await generate_seat_map_image(event_id)
-            with open(path, "rb") as photo:
-                await context.bot.send_photo(
-                    chat_id=user_id, 
-                    photo=photo, 
-                    caption="نقشه صندلی: 🟩آزاد 🟨رزرو شده 🟥فروخته شده 🟦وی‌آی‌پی"
-                )
+            event = event_catalog.get(event_id)
+            if event:
+                await send_live_map(context.bot, user_id, event, {'kind': 'map'})
 
-        elif data.startswith("event|"):
+        elif data.startswith("event|") or data.startswith("queue|"):
             event_id = int(data.split("|")[1])
-            path = await generate_seat_map_image(event_id)
-            seats = await get_seats(event_id)
             
-            event = next((ev for ev in config.EVENTS if ev["id"] == event_id), None)
+            event = event_catalog.get(event_id)
             if not event:
                 await context.bot.send_message(chat_id=user_id, text="❌ رویداد یافت نشد.")
                 return
             
-            keyboard = []
-            current_row = []
+            admitted, _ = waiting_room.enter(event, user_id)
+            if not admitted:
+                await send_queue_status(context.bot, user_id, event)
+                return
             
-            for seat_id, r, c, status, _, price in seats:
-                seat_label = f"{r}-{c}"
-                
-                if status == 'free':
-                    btn = InlineKeyboardButton(seat_label, callback_data=f"seat|{event_id}|{seat_id}")
-                elif status == 'reserved':
-                    btn = InlineKeyboardButton(f"⏳{seat_label}", callback_data="disabled")
-                else:
-                    btn = InlineKeyboardButton(f"❌{seat_label}", callback_data="disabled")
-                
-                current_row.append(btn)
-                
-                if len(current_row) >= 5:
-                    keyboard.append(current_row)
-                    current_row = []
+            await show_event_seats(context, user_id, event)
+
+        elif data.startswith("block|"):
+            parts = data.split("|")
+            event_id = int(parts[1])
+            block_index = int(parts[2])
             
-            if current_row:
-                keyboard.append(current_row)
+            event = event_catalog.get(event_id)
+            if not event:
+                await context.bot.send_message(chat_id=user_id, text="❌ رویداد یافت نشد.")
+                return
             
-            keyboard.append([InlineKeyboardButton("🔙 بازگشت به لیست اجراها", callback_data="back_to_events")])
+            admitted, _ = waiting_room.enter(event, user_id)
+            if not admitted:
+                await send_queue_status(context.bot, user_id, event)
+                return
             
-            with open(path, "rb") as photo:
-                await context.bot.send_photo(
-                    chat_id=user_id,
-                    photo=photo,
-                    caption=f"💺 **انتخاب صندلی - {event['title']}**\n\n"
-                           "🟩 آزاد 🟨 رزرو شده 🟥 فروخته شده\n\n"
-                           "لطفاً صندلی مورد نظر را انتخاب کنید:",
-                    reply_markup=InlineKeyboardMarkup(keyboard),
-                    parse_mode='Markdown'
-                )
+            await show_seat_block(context, user_id, event, block_index)
+
+        elif data.startswith("page|"):
+            parts = data.split("|")
+            event_id = int(parts[1])
+            block_index = int(parts[2])
+            page = int(parts[3])
+            
+            event = event_catalog.get(event_id)
+            if not event:
+                return
+            
+            waiting_room.touch(event_id, user_id)
+            await update_seat_keyboard_page(query, event, block_index, page)
 
         elif data.startswith("seat|"):
             parts = data.split("|")
             event_id = int(parts[1])
             seat_id = parts[2]
             
-            conn = sqlite3.connect(DB_FILE)
-            c = conn.cursor()
-            c.execute('SELECT status FROM seats WHERE event_id=? AND seat_id=?', (event_id, seat_id))
-            seat_status = c.fetchone()
-            conn.close()
+            event = event_catalog.get(event_id)
+            if event:
+                admitted, _ = waiting_room.enter(event, user_id)
+                if not admitted:
+                    await send_queue_status(context.bot, user_id, event)
+                    return
             
-            if not seat_status or seat_status[0] != 'free':
+            seat = await get_seat(event_id, seat_id)
+            if not seat or seat[0] != 'free':
                 await context.bot.send_message(chat_id=user_id, text="❌ این صندلی در دسترس نیست.")
                 return
-                
-            conn = sqlite3.connect(DB_FILE)
-            c = conn.cursor()
-            
-            c.execute('SELECT title, event_date FROM events WHERE id=?', (event_id,))
-            event_info = c.fetchone()
-            event_title = event_info[0] if event_info else "نامشخص"
-            
-            c.execute('SELECT price FROM seats WHERE event_id=? AND seat_id=?', (event_id, seat_id))
-            price_info = c.fetchone()
-            price = price_info[0] if price_info else 0
             
-            conn.close()
+            event_title = event['title'] if event else "نامشخص"
+            price = seat[1]
             
             confirmation_text = (
                 "🎯 **تأیید نهایی رزرو**\n\n"
@@ -1994,13 +5595,11 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
             event_id = int(parts[1])
             seat_id = parts[2]
             
-            ok, err = await set_reserved(event_id, seat_id, user_id)
-            if not ok:
+            price, err = await set_reserved(event_id, seat_id, user_id)
+            if price is None:
                 await context.bot.send_message(chat_id=user_id, text=err)
                 return
-                
-            seats = await get_seats(event_id)
-            price = next(p for s, r, c, st, uid, p in seats if s==seat_id)
+            waiting_room.leave(event_id, user_id)
             
             msg_user = (
                 f"✅ **صندلی {seat_id} برای شما رزرو شد!**\n\n"
@@ -2033,6 +5632,7 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         elif data.startswith("cancel|"):
             event_id = int(data.split("|")[1])
+            waiting_room.leave(event_id, user_id)
             await context.bot.send_message(
                 chat_id=user_id,
                 text="❌ رزرو لغو شد. می‌توانید اجرای دیگری را انتخاب کنید."
@@ -2047,43 +5647,57 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         elif data in ["users_stats", "refresh_users_stats"]:
             await show_users_stats(update, context)
 
+        elif data.startswith("export|"):
+            kind = data.split("|")[1]
+            if is_admin(user_id) and kind in EXPORTS:
+                context.application.create_task(run_export(query.message, kind))
+
         else:
             logger.warning(f"Unknown callback data: {data}")
             
+    except ExecutorBusy:
+        await context.bot.send_message(
+            chat_id=user_id,
+            text="⏳ سرور شلوغ است، چند ثانیه دیگر دوباره تلاش کنید."
+        )
     except Exception as e:
         logger.error(f"Error in callback router: {e}")
         await context.bot.send_message(
             chat_id=user_id,
             text="❌ خطایی در پردازش درخواست شما رخ داده است."
         )
+    finally:
+        slow_handlers.end(slow_id)
+        elapsed = time.perf_counter() - started
+        overload.observe(elapsed)
+        metrics.observe("handler_seconds", elapsed, handler="callback_router", action=data.split("|", 1)[0])
 
 # ----- هندلر پرداخت -----
+async def archive_receipt_photo(bot, file_id: str, path: str):
+    """بایگانی عکس رسید در پوشه receipts در پس‌زمینه"""
+    try:
+        file = await bot.get_file(file_id)
+        await file.download_to_drive(path)
+    except Exception as e:
+        logger.error(f"خطا در بایگانی رسید {path}: {e}")
+
+@timed_handler
 async def handle_payment_receipt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    seat_info = await get_reserved_seat_by_user(user_id)
-    if not seat_info:
-        await update.message.reply_text("ابتدا صندلی رزرو کنید.")
-        return
-    event_id, seat_id = seat_info
     if update.message.photo:
+        file_id = update.message.photo[-1].file_id
+        submitted = await submit_receipt(user_id, file_id)
+        if not submitted:
+            if await run_in_thread(has_pending_review, user_id):
+                await update.message.reply_text("⏳ رسید شما در حال بررسی است. لطفاً منتظر تایید ادمین بمانید.")
+            else:
+                await update.message.reply_text("ابتدا صندلی رزرو کنید.")
+            return
+        review_id, event_id, seat_id = submitted
         username = update.message.from_user.username or user_id
-        file = await update.message.photo[-1].get_file()
-        path = f"receipts/{username}_{seat_id}_{int(time.time())}.jpg"
-        await file.download_to_drive(path)
-        
-        receipt_path = await generate_beautiful_receipt(user_id, event_id, seat_id, username)
-        qr_path = await generate_qr_code(event_id, seat_id, user_id)
         
         await update.message.reply_text("✅ رسید دریافت شد و برای ادمین ارسال شد.")
         
-        with open(receipt_path, "rb") as photo:
-            await context.bot.send_photo(
-                chat_id=user_id,
-                photo=photo,
-                caption="🎫 **رسید پرداخت شما**\n\nاین رسید را تا زمان تأیید نهایی نگه دارید.",
-                parse_mode='Markdown'
-            )
-        
         admin_caption = (
             f"📸 **رسید پرداخت جدید**\n\n"
             f"👤 کاربر: @{username}\n"
@@ -2093,144 +5707,253 @@ async def handle_payment_receipt(update: Update, context: ContextTypes.DEFAULT_T
         )
         
         kb = InlineKeyboardMarkup([[
-            InlineKeyboardButton("✅ تایید پرداخت", callback_data=f"admin_approve|{event_id}|{seat_id}|{user_id}"),
-            InlineKeyboardButton("❌ رد پرداخت", callback_data=f"admin_reject|{event_id}|{seat_id}|{user_id}")
+            InlineKeyboardButton("✅ تایید پرداخت", callback_data=f"admin_approve|{review_id}"),
+            InlineKeyboardButton("❌ رد پرداخت", callback_data=f"admin_reject|{review_id}")
         ]])
         
+        # عکس اصلی با file_id برای ادمین‌ها فرستاده می‌شود؛ نیازی به دانلود و آپلود مجدد نیست
         admins = get_all_admins()
         for admin_id, _, _ in admins:
             try:
-                with open(path, "rb") as photo:
-                    await context.bot.send_photo(
-                        chat_id=admin_id,
-                        photo=photo,
-                        caption=admin_caption,
-                        reply_markup=kb,
+                message = await context.bot.send_photo(
+                    chat_id=admin_id,
+                    photo=file_id,
+                    caption=admin_caption,
+                    reply_markup=kb,
+                    parse_mode='Markdown'
+                )
+                decided = await db_writer.run(add_review_message, review_id, message.chat_id, message.message_id)
+                if decided is not None:
+                    await context.bot.edit_message_caption(
+                        chat_id=message.chat_id,
+                        message_id=message.message_id,
+                        caption=review_caption(decided, decided["decided_at"]),
+                        reply_markup=None,
                         parse_mode='Markdown'
                     )
             except Exception as e:
                 logger.error(f"خطا در ارسال رسید به ادمین {admin_id}: {e}")
+        
+        path = f"receipts/{username}_{seat_id}_{int(time.time())}.jpg"
+        context.application.create_task(archive_receipt_photo(context.bot, file_id, path))
+        
+        try:
+            receipt_path = await generate_beautiful_receipt(user_id, event_id, seat_id, username)
+        except ExecutorBusy:
+            # رسید نهایی پس از تایید همراه بلیت ارسال می‌شود
+            logger.warning(f"رسید اولیه کاربر {user_id} به دلیل شلوغی رندر ارسال نشد")
+            return
+        with open(receipt_path, "rb") as photo:
+            await context.bot.send_photo(
+                chat_id=user_id,
+                photo=photo,
+                caption="🎫 **رسید پرداخت شما**\n\nاین رسید را تا زمان تأیید نهایی نگه دارید.",
+                parse_mode='Markdown'
+            )
     else:
         await update.message.reply_text("لطفاً عکس رسید را ارسال کنید.")
 
+# ----- ارسال بلیت (کار صف) -----
+async def deliver_ticket_job(bot, payload: Dict):
+    """تولید و ارسال بلیت و QR Code پس از تایید پرداخت"""
+    event_id = payload["event_id"]
+    seat_id = payload["seat_id"]
+    customer_user_id = payload["user_id"]
+    
+    qr_path = await generate_qr_code(event_id, seat_id, customer_user_id)
+    receipt_path = await generate_beautiful_receipt(customer_user_id, event_id, seat_id)
+    
+    await bot.send_message(
+        chat_id=customer_user_id,
+        text="🎉 **پرداخت شما تأیید شد!**\n\nبلیت شما آماده است.",
+        parse_mode='Markdown'
+    )
+    
+    with open(receipt_path, "rb") as photo:
+        await bot.send_photo(
+            chat_id=customer_user_id,
+            photo=photo,
+            caption="🎫 **بلیت شما**\n\nاین بلیت را هنگام ورود نشان دهید.",
+            parse_mode='Markdown'
+        )
+    
+    with open(qr_path, "rb") as photo:
+        await bot.send_photo(
+            chat_id=customer_user_id,
+            photo=photo,
+            caption="📱 **QR Code بلیت**\n\nاین کد برای ورود اسکن خواهد شد.",
+            parse_mode='Markdown'
+        )
+    logger.info("بلیت برای کاربر %s ارسال شد", customer_user_id, extra={"user": customer_user_id})
+
+job_handlers["deliver_ticket"] = deliver_ticket_job
+
 # ----- هندلر تایید پرداخت توسط ادمین -----
+@timed_handler
 async def handle_admin_approval_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """مدیریت تایید/رد پرداخت توسط ادمین"""
     query = update.callback_query
-    await query.answer()
     data = query.data
     user_id = query.from_user.id
     
     if not is_admin(user_id):
+        await query.answer()
         await query.message.reply_text("❌ دسترسی denied.")
         return
         
-    logger.info(f"ادمین {user_id} دکمه {data} را زد")
+    logger.info("ادمین %s دکمه %s را زد", user_id, data, extra={"user": user_id, "action": data.split("|", 1)[0]})
     
-    if data.startswith("admin_approve|") or data.startswith("admin_reject|"):
-        parts = data.split("|")
-        action = "approve" if data.startswith("admin_approve") else "reject"
-        event_id = int(parts[1])
-        seat_id = parts[2]
-        customer_user_id = int(parts[3])
-        
-        logger.info(f"پردازش {action} برای صندلی {seat_id} کاربر {customer_user_id}")
-        
-        if action == "approve":
-            await mark_sold(event_id, seat_id)
-            await record_successful_payment(customer_user_id, event_id, seat_id)
-            
-            qr_path = await generate_qr_code(event_id, seat_id, customer_user_id)
-            receipt_path = await generate_beautiful_receipt(customer_user_id, event_id, seat_id)
-            
-            try:
-                await context.bot.send_message(
-                    chat_id=customer_user_id,
-                    text="🎉 **پرداخت شما تأیید شد!**\n\nبلیت شما آماده است.",
-                    parse_mode='Markdown'
-                )
-                
-                with open(receipt_path, "rb") as photo:
-                    await context.bot.send_photo(
-                        chat_id=customer_user_id,
-                        photo=photo,
-                        caption="🎫 **بلیت شما**\n\nاین بلیت را هنگام ورود نشان دهید.",
-                        parse_mode='Markdown'
-                    )
-                
-                with open(qr_path, "rb") as photo:
-                    await context.bot.send_photo(
-                        chat_id=customer_user_id,
-                        photo=photo,
-                        caption="📱 **QR Code بلیت**\n\nاین کد برای ورود اسکن خواهد شد.",
-                        parse_mode='Markdown'
-                    )
-                logger.info(f"پیام تایید به کاربر {customer_user_id} ارسال شد")
-            except Exception as e:
-                logger.error(f"خطا در ارسال پیام به کاربر: {e}")
-            
-            try:
-                await query.message.edit_reply_markup(reply_markup=None)
-                await query.message.edit_caption(
-                    caption=f"✅ **پرداخت تایید شد!**\n\n"
-                           f"👤 کاربر: {customer_user_id}\n"
-                           f"🎭 اجرا: {event_id}\n"
-                           f"💺 صندلی: {seat_id}\n"
-                           f"🕒 زمان: {datetime.now().strftime('%Y/%m/%d %H:%M')}",
-                    parse_mode='Markdown'
-                )
-                logger.info("پیام ادمین آپدیت شد")
-            except Exception as e:
-                logger.error(f"خطا در آپدیت پیام ادمین: {e}")
-                
-        else:
-            await release_seat(event_id, seat_id)
-            
-            try:
-                await context.bot.send_message(
-                    chat_id=customer_user_id,
-                    text="❌ پرداخت شما رد شد و صندلی آزاد گردید.\nلطفاً با پشتیبانی تماس بگیرید."
-                )
-                logger.info(f"پیام رد به کاربر {customer_user_id} ارسال شد")
-            except Exception as e:
-                logger.error(f"خطا در ارسال پیام به کاربر: {e}")
-            
-            try:
-                await query.message.edit_reply_markup(reply_markup=None)
-                await query.message.edit_caption(
-                    caption=f"❌ **پرداخت رد شد!**\n\n"
-                           f"👤 کاربر: {customer_user_id}\n"
-                           f"🎭 اجرا: {event_id}\n"
-                           f"💺 صندلی: {seat_id}\n"
-                           f"🕒 زمان: {datetime.now().strftime('%Y/%m/%d %H:%M')}",
-                    parse_mode='Markdown'
-                )
-                logger.info("پیام ادمین آپدیت شد")
-            except Exception as e:
-                logger.error(f"خطا در آپدیت پیام ادمین: {e}")
+    parts = data.split("|")
+    approve = parts[0] == "admin_approve"
+    if len(parts) != 2:
+        await query.answer("⚠️ این رسید مربوط به نسخه قبلی ربات است.", show_alert=True)
+        return
+    review_id = int(parts[1])
+    
+    outcome, review, admin_messages = await decide_review(review_id, user_id, approve)
+    
+    if outcome == "not_found":
+        await query.answer("❌ رسید یافت نشد.", show_alert=True)
+        return
+    
+    if outcome == "duplicate":
+        # تصمیم قبلاً گرفته شده؛ بدون هیچ رندر یا ارسال اضافه فقط اطلاع داده می‌شود
+        state = "تایید" if review["status"] == "approved" else "رد"
+        await query.answer(f"ℹ️ این رسید قبلاً توسط ادمین {review['decided_by']} {state} شده است.", show_alert=True)
+        try:
+            await query.message.edit_reply_markup(reply_markup=None)
+        except Exception:
+            pass
+        return
+    
+    if outcome == "conflict":
+        await query.answer("⚠️ وضعیت صندلی تغییر کرده و این رسید قابل اعمال نیست.", show_alert=True)
+        return
+    
+    await query.answer()
+    customer_user_id = review["user_id"]
+    event_id = review["event_id"]
+    seat_id = review["seat_id"]
+    
+    logger.info("پردازش %s برای صندلی %s کاربر %s", outcome, seat_id, customer_user_id,
+                extra={"user": customer_user_id, "event": event_id, "action": outcome})
+    
+    if outcome == "approved":
+        wake_job_workers()
+    else:
+        try:
+            await context.bot.send_message(
+                chat_id=customer_user_id,
+                text="❌ پرداخت شما رد شد و صندلی آزاد گردید.\nلطفاً با پشتیبانی تماس بگیرید."
+            )
+            logger.info("پیام رد به کاربر %s ارسال شد", customer_user_id,
+                        extra={"user": customer_user_id, "event": event_id})
+        except Exception as e:
+            logger.error(f"خطا در ارسال پیام به کاربر: {e}")
+    
+    caption = review_caption(review, int(time.time()))
+    
+    # پیام رسید نزد همه ادمین‌ها به‌روز می‌شود تا کسی دوباره روی آن اقدام نکند؛
+    # پیام‌هایی که بعد از این تصمیم ثبت شوند را handle_payment_receipt خودش به‌روز می‌کند
+    targets = set(admin_messages) or {(query.message.chat_id, query.message.message_id)}
+    for chat_id, message_id in targets:
+        try:
+            await context.bot.edit_message_caption(
+                chat_id=chat_id,
+                message_id=message_id,
+                caption=caption,
+                reply_markup=None,
+                parse_mode='Markdown'
+            )
+        except Exception as e:
+            logger.error(f"خطا در آپدیت پیام ادمین {chat_id}: {e}")
 
 # ----- راه‌اندازی -----
-def main():
-    global app
-    init_db()
-    app = ApplicationBuilder().token(config.BOT_TOKEN).build()
-
-    scheduler = BackgroundScheduler()
-    scheduler.add_job(release_expired_seats, 'interval', seconds=30)
+async def on_startup(application):
+    """اجرا پس از مقداردهی Application، داخل حلقه رویداد"""
+    live_maps.attach(application.bot, asyncio.get_running_loop())
+    start_job_workers(application)
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+    
+    waiting_room.attach(application.bot, asyncio.get_running_loop())
+    memory_monitor.attach(application.bot)
+    if MEMORY_TRACEMALLOC:
+        memory_monitor.start_tracing(MEMORY_TRACEMALLOC)
+    await memory_monitor.check()
+    
+    global scheduler
+    scheduler = AsyncIOScheduler()
+    scheduler.add_job(release_expired_seats, 'interval', seconds=EXPIRY_CHECK_INTERVAL)
+    scheduler.add_job(waiting_room.expire, 'interval', seconds=WAITING_ROOM_SNAPSHOT)
+    scheduler.add_job(waiting_room.persist, 'interval', seconds=WAITING_ROOM_SNAPSHOT)
+    scheduler.add_job(memory_monitor.check, 'interval', seconds=MEMORY_CHECK_INTERVAL)
     scheduler.start()
+    schedule_on_sales()
+    # شروع فروش‌هایی که هنگام خاموش بودن ربات فرا رسیده‌اند
+    for event_id in waiting_room.event_ids():
+        await waiting_room.open_gate(event_id)
+
+async def on_stop(application):
+    """اجرا پس از توقف Application (قبل از shutdown)"""
+    await stop_job_workers()
+
+def build_application(token: str, base_url: str = None, base_file_url: str = None):
+    """ساخت Application با همه هندلرها.
+
+    base_url و base_file_url برای اتصال به سرور Bot API دیگر (مثلاً سرور ساختگی
+    benchmarks/e2e.py) است؛ پیش‌فرض همان api.telegram.org است.
+    """
+    builder = (
+        ApplicationBuilder()
+        .token(token)
+        .application_class(TracedApplication)
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .concurrent_updates(True)
+        .post_init(on_startup)
+        .post_stop(on_stop)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    if base_file_url:
+        builder = builder.base_file_url(base_file_url)
+    app = builder.build()
+
+    if update_recorder is not None:
+        app.add_handler(TypeHandler(Update, record_update_handler), group=-2)
+
+    # محافظ ارسال پشت سر هم قبل از همه هندلرها
+    app.add_handler(TypeHandler(Update, flood_guard_handler), group=-1)
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("menu", start))
+    app.add_handler(CommandHandler("reload_events", reload_events_command))
+    app.add_handler(CommandHandler("status", status_command))
+    app.add_handler(CommandHandler("metrics", metrics_command))
+    app.add_handler(CommandHandler("profile", profile_command))
+    app.add_handler(CommandHandler("memory", memory_command))
+    app.add_handler(CommandHandler("slowsql", slowsql_command))
+    app.add_handler(CommandHandler("export", export_command))
 
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_all_text_messages))
 
     app.add_handler(MessageHandler(filters.PHOTO & ~filters.COMMAND, handle_payment_receipt))
 
+    # هندلر تایید پرداخت باید قبل از روتر عمومی ثبت شود تا callback های admin_approve به آن برسند
+    app.add_handler(CallbackQueryHandler(handle_admin_approval_callback, pattern="^admin_(approve|reject)\|"))
+
     app.add_handler(CallbackQueryHandler(callback_router))
+    return app
 
-    app.add_handler(CallbackQueryHandler(handle_admin_approval_callback, pattern="^admin_(approve|reject)\|"))
+def main():
+    global app
+    init_db()
+    event_catalog.load()
+    availability.load()
+    waiting_room.restore()
+    app = build_application(config.BOT_TOKEN)
 
-    print("🤖 Bot started with complete support system...")
+    logger.info("Bot started with complete support system...")
     app.run_polling()
 
 if __name__ == "__main__":